@@ -0,0 +1,960 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+##########################################
+########### POLYMATH BENCHMARKS ##########
+##########################################
+
+POLYMATH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+################## STARTUP ##################
+
+# writes a small library with precomputed features into the working directory
+SEED_SCRIPT = """
+import os, sys, pickle
+import numpy as np
+sys.path.insert(0, {polymath_dir!r})
+import __main__, polymath
+# the library is pickled by polymath.py running as __main__
+__main__.Video = polymath.Video
+os.makedirs("library", exist_ok=True)
+videos = []
+store = polymath.FeatureStore()
+for i in range(2):
+    vid = polymath.Video("benchmark track %d" % i, "", "library/benchmark_track_%d.wav" % i)
+    vid.id = "benchmark_track_%d" % i
+    videos.append(vid)
+    features = {{
+        "id": vid.id, "tempo": 120.0 + i, "duration": 60.0, "timbre": 0.1 * i, "pitch": 0.5,
+        "intensity": -20.0, "frequency": 440.0 + i, "key": "A4", "loudness": 0.2, "avg_volume": 0.1,
+        "timbre_frames": np.zeros((120, 39)), "pitch_frames": np.zeros((120, 12)), "intensity_frames": np.zeros((120, 84)),
+        "frequency_frames": np.zeros((6000, 3)), "volume": np.zeros(2584), "beats": np.arange(120) * 0.5,
+        "segments_boundaries": np.arange(4), "segments_labels": np.arange(4),
+    }}
+    store.put(vid.id, features)
+store.save()
+polymath.write_library(videos)
+"""
+
+# runs polymath.main() in a fresh interpreter and reports which heavy modules got imported
+STARTUP_SCRIPT = """
+import sys, time, json
+start = time.perf_counter()
+sys.path.insert(0, {polymath_dir!r})
+import __main__, polymath
+__main__.Video = polymath.Video
+sys.argv = ["polymath.py"] + {argv!r}
+polymath.main()
+elapsed = time.perf_counter() - start
+loaded = [m for m in polymath.HEAVY_MODULES if m in sys.modules]
+print("__BENCHMARK__" + json.dumps({{"seconds": elapsed, "heavy_modules": loaded}}))
+"""
+
+LIGHT_COMMANDS = [
+    ["-s", "benchmark_track_0", "-sa", "1"],
+    ["-v", "benchmark_track_0"],
+    ["-r", "benchmark_track_1"],
+]
+
+def benchmark_startup(commands=LIGHT_COMMANDS):
+    results = []
+    failed = False
+    for argv in commands:
+        with tempfile.TemporaryDirectory() as workdir:
+            subprocess.run([sys.executable, "-c", SEED_SCRIPT.format(polymath_dir=POLYMATH_DIR)], cwd=workdir, check=True)
+            script = STARTUP_SCRIPT.format(polymath_dir=POLYMATH_DIR, argv=argv)
+            proc = subprocess.run([sys.executable, "-c", script], cwd=workdir, capture_output=True, text=True)
+        line = [l for l in proc.stdout.splitlines() if l.startswith("__BENCHMARK__")]
+        if proc.returncode != 0 or not line:
+            print("startup", " ".join(argv), "FAILED")
+            print(proc.stderr)
+            failed = True
+            continue
+        result = json.loads(line[0][len("__BENCHMARK__"):])
+        result["command"] = " ".join(argv)
+        results.append(result)
+        print("startup", result["command"], "seconds", round(result["seconds"], 3), "heavy modules", result["heavy_modules"])
+        if result["heavy_modules"]:
+            failed = True
+    return results, failed
+
+
+################## FIXTURES ##################
+
+# deterministic test audio: clicks at a known tempo, chords in a known key, no downloads
+
+NOTE_NAMES = ("C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B")
+
+def note_frequency(note, octave=4):
+    return 440.0 * 2 ** ((NOTE_NAMES.index(note) - 9) / 12 + octave - 4)
+
+def click_track(seconds, sr=44100, bpm=120):
+    import numpy as np
+    y = np.zeros(int(seconds * sr))
+    click = np.exp(-np.arange(int(0.02 * sr)) / (0.002 * sr)) * np.sin(2 * np.pi * 2000 * np.arange(int(0.02 * sr)) / sr)
+    for start in np.arange(0, seconds, 60.0 / bpm):
+        i = int(start * sr)
+        y[i:i + len(click)] += click[:len(y) - i]
+    return y
+
+def key_tone(seconds, sr=44100, key="A", offset=0):
+    # major triad on the key, offset in samples keeps the phase continuous across blocks
+    import numpy as np
+    t = (offset + np.arange(int(seconds * sr))) / sr
+    root = note_frequency(key)
+    return sum(0.1 * np.sin(2 * np.pi * root * ratio * t) for ratio in (1.0, 2 ** (4 / 12), 2 ** (7 / 12)))
+
+def synthetic_track(seconds=60, sr=44100, bpm=120, freq=440.0):
+    # click track at a known tempo over a sustained tone
+    import numpy as np
+    t = np.arange(int(seconds * sr)) / sr
+    y = 0.3 * np.sin(2 * np.pi * freq * t) + 0.1 * np.sin(2 * np.pi * freq * 1.5 * t)
+    y += click_track(seconds, sr, bpm)
+    return y.astype(np.float32), sr
+
+def synthetic_mix(seconds=180, sr=44100, bpm=120, key="A", seed=0):
+    # multi-minute song: clicks, a I-IV-V-I progression changing every 8 beats and a quiet noise bed
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    root = NOTE_NAMES.index(key)
+    progression = [NOTE_NAMES[(root + step) % 12] for step in (0, 5, 7, 0)]
+    bar = 8 * 60.0 / bpm
+    y = click_track(seconds, sr, bpm)
+    for i, start in enumerate(np.arange(0, seconds, bar)):
+        a, b = int(start * sr), min(int((start + bar) * sr), len(y))
+        y[a:b] += key_tone((b - a) / sr, sr, progression[i % len(progression)], offset=a)
+    y += 0.01 * rng.standard_normal(len(y))
+    return y.astype(np.float32), sr
+
+def write_stub_stems(directory, y, sr, stems):
+    # stands in for demucs: every stem is a scaled copy of the mix
+    import soundfile as sf
+    os.makedirs(directory, exist_ok=True)
+    for i, stem in enumerate(stems):
+        sf.write(os.path.join(directory, stem + ".wav"), y * (0.3 + 0.1 * i), sr, subtype="PCM_16")
+
+
+################## SEARCH ##################
+
+def synthetic_library(size, seed=0):
+    import numpy as np
+    import polymath
+    rng = np.random.default_rng(seed)
+    videos = []
+    for i in range(size):
+        vid = polymath.Video(f"synthetic {i}", "", "")
+        vid.id = f"synthetic_{i:07d}"
+        vid.audio_features = {
+            "id": vid.id,
+            "tempo": float(rng.uniform(70, 180)),
+            "frequency": float(rng.uniform(50, 1000)),
+            "timbre": float(rng.normal(0, 5)),
+            "intensity": float(rng.normal(-30, 5)),
+            "pitch": float(rng.uniform(0, 1)),
+            "loudness": float(rng.uniform(0, 1)),
+            "key": "A4",
+        }
+        videos.append(vid)
+    return videos
+
+def legacy_nearest(query, videos, querybpm, searchforbpm, previous_list):
+    # the original per-track scan of get_nearest, used as reference
+    nearest = None
+    smallest = 1000000000
+    smallestBPM = 1000000000
+    for vid in videos:
+        if vid.id != query.id:
+            comp_bpm = abs(querybpm - vid.audio_features['tempo'])
+            comp = abs(query.audio_features["frequency"] - vid.audio_features['frequency'])
+            if searchforbpm:
+                if vid.id not in previous_list and comp < smallest and comp_bpm < smallestBPM:
+                    smallest = comp
+                    smallestBPM = comp_bpm
+                    nearest = vid
+            else:
+                if vid.id not in previous_list and comp < smallest:
+                    smallest = comp
+                    nearest = vid
+    previous_list.append(nearest.id)
+    if len(previous_list) >= len(videos)-1:
+        previous_list.pop(0)
+    return nearest
+
+def benchmark_search(sizes=(1000, 10000, 100000), searchamount=20, querybpm=120):
+    import polymath
+    results = []
+    failed = False
+    for size in sizes:
+        videos = synthetic_library(size)
+        for searchforbpm in (False, True):
+            start = time.perf_counter()
+            index = polymath.FeatureIndex(videos)
+            build = time.perf_counter() - start
+            history = polymath.SearchHistory()
+            query = videos[0]
+            chain = []
+            start = time.perf_counter()
+            for _ in range(searchamount):
+                query = polymath.get_nearest(query, videos, querybpm, searchforbpm, index=index, history=history)
+                chain.append(query.id)
+            search = time.perf_counter() - start
+
+            previous_list = []
+            query = videos[0]
+            legacy_chain = []
+            start = time.perf_counter()
+            for _ in range(searchamount):
+                query = legacy_nearest(query, videos, querybpm, searchforbpm, previous_list)
+                legacy_chain.append(query.id)
+            legacy = time.perf_counter() - start
+
+            result = {"size": size, "searchbpm": searchforbpm, "index_build_seconds": build, "search_seconds": search, "legacy_search_seconds": legacy, "identical": chain == legacy_chain}
+            results.append(result)
+            print("search", size, "tracks", "searchbpm", searchforbpm, "build", round(build, 3), "search", round(search, 3), "legacy", round(legacy, 3), "identical", result["identical"])
+            if not result["identical"]:
+                failed = True
+    return results, failed
+
+
+def benchmark_playlist(sizes=(100, 1000, 2000), time_budget=2.0, max_tempo_change=8.0):
+    # greedy order against the improved one, and the get_nearest chain over the same tracks
+    import numpy as np
+    import polymath
+    results = []
+    failed = False
+    for size in sizes:
+        videos = synthetic_library(size)
+        index = polymath.FeatureIndex(videos)
+        planner = polymath.PlaylistPlanner(index)
+        start = time.perf_counter()
+        greedy = np.array(planner.greedy(0, size))
+        D = planner.costs(greedy, greedy)
+        greedy_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        path = polymath.improve_path(D, time.perf_counter() + time_budget)
+        improve_seconds = time.perf_counter() - start
+
+        history = polymath.SearchHistory()
+        chain = [0]
+        for _ in range(size - 1):
+            chain.append(index.rows[polymath.get_nearest(index.videos[chain[-1]], videos, 120, False, index=index, weights=polymath.DEFAULT_SEARCH_WEIGHTS, history=history).id])
+        chain_cost = polymath.path_cost(planner.costs(np.array(chain), np.array(chain)), np.arange(size))
+
+        constrained = polymath.PlaylistPlanner(index, max_tempo_change=max_tempo_change)
+        rows, costs = constrained.plan(videos[0].id, time_budget=time_budget)
+        result = {"size": size, "chain_cost": chain_cost, "greedy_cost": polymath.path_cost(D, np.arange(size)), "improved_cost": polymath.path_cost(D, path),
+                  "greedy_seconds": greedy_seconds, "improve_seconds": improve_seconds,
+                  "tempo_violations": int(np.count_nonzero(costs >= polymath.PLAYLIST_PENALTY)), "complete": sorted(rows.tolist()) == list(range(size))}
+        results.append(result)
+        print("playlist", size, "tracks", "chain", round(chain_cost, 1), "greedy", round(result["greedy_cost"], 1), "improved", round(result["improved_cost"], 1),
+              "greedy seconds", round(greedy_seconds, 3), "improve seconds", round(improve_seconds, 3), "tempo violations", result["tempo_violations"])
+        if result["improved_cost"] > result["greedy_cost"] + 1e-6 or sorted(path.tolist()) != list(range(size)) or path[0] != 0 or not result["complete"]:
+            failed = True
+    return results, failed
+
+def benchmark_filter(sizes=(1000, 10000, 100000), k=20, queries=20, tempo=(124.0, 130.0), duration=(120.0, 360.0)):
+    # ranking only the tracks that pass tempo, key and duration filters against ranking all of them
+    import numpy as np
+    import polymath
+    results = []
+    failed = False
+    for size in sizes:
+        videos = synthetic_library(size)
+        rng = np.random.default_rng(size)
+        for vid in videos:
+            vid.audio_features["key"] = polymath.NOTE_NAMES[int(rng.integers(12))] + "4"
+            vid.audio_features["duration"] = float(rng.uniform(60, 600))
+        index = polymath.FeatureIndex(videos)
+        start = time.perf_counter()
+        ranges = polymath.RangeIndex(index)
+        build = time.perf_counter() - start
+        tempos = index.column("tempo")
+        durations = np.array([vid.audio_features["duration"] for vid in videos])
+        classes = np.array([polymath.key_class(vid.audio_features["key"]) for vid in videos])
+
+        identical = True
+        filtered_seconds = full_seconds = 0.0
+        passed = 0
+        for query in videos[:queries]:
+            start = time.perf_counter()
+            rows = ranges.filter(tempo=tempo, duration=duration, key=query.audio_features["key"])
+            filtered = index.query(query, k=k, rows=rows)
+            filtered_seconds += time.perf_counter() - start
+            passed += len(rows)
+
+            # brute force: every track ranked, the ones failing a filter masked afterwards
+            start = time.perf_counter()
+            dist = index.distances(query)
+            keep = np.zeros(size, dtype=bool)
+            for f in (0.5, 1.0, 2.0):
+                keep |= (tempos >= tempo[0] * f) & (tempos <= tempo[1] * f)
+            keep &= (durations >= duration[0]) & (durations <= duration[1])
+            keep &= np.isin(classes, polymath.compatible_keys(query.audio_features["key"]))
+            dist = np.where(keep, dist, np.inf)
+            order = np.argsort(dist, kind="stable")[:k]
+            full = [videos[i] for i in order if np.isfinite(dist[i])]
+            full_seconds += time.perf_counter() - start
+            identical = identical and [vid.id for vid in filtered] == [vid.id for vid in full]
+
+        result = {"size": size, "build_seconds": build, "filtered_seconds": filtered_seconds / queries, "full_seconds": full_seconds / queries,
+                  "candidates": passed / queries, "identical": identical}
+        results.append(result)
+        print("filter", size, "tracks", "build", round(build, 3), "candidates", int(result["candidates"]), "filtered query", round(result["filtered_seconds"], 5),
+              "full query", round(result["full_seconds"], 5), "identical", identical)
+        if not identical:
+            failed = True
+    return results, failed
+
+class SyntheticFrames(dict):
+    # beat-synced frame features generated on first access, like AudioFeatures loading them from disk
+    def __missing__(self, name):
+        import numpy as np
+        dims = {"timbre_frames": 39, "pitch_frames": 12, "intensity_frames": 84}
+        rng = np.random.default_rng([int(self["id"].split("_")[1]), len(name)])
+        beats = 200 + int(self["id"].split("_")[1]) % 300
+        if name == "beats":
+            # 120 bpm, the frames have one row more than there are beats
+            value = 0.5 * np.arange(1, beats)
+        elif name == "segments_boundaries":
+            import polymath
+            n_frames = int(beats * 0.5 / polymath.SEGMENT_HOP_SECONDS)
+            value = np.unique(np.concatenate([[0], np.sort(rng.choice(np.arange(1, n_frames - 1), 7, replace=False)), [n_frames - 1]]))
+        elif name == "segments_labels":
+            value = rng.integers(0, 4, len(self["segments_boundaries"]) - 1)
+        elif name not in dims:
+            raise KeyError(name)
+        if name not in dims:
+            self[name] = value
+            return value
+        # a slow random walk, so neighbouring beats look alike as in real songs
+        value = np.cumsum(rng.normal(0, 0.3, (beats, dims[name])), axis=0).astype(np.float32)
+        self[name] = value
+        return value
+
+def brute_force_sequence(index, query, querybpm=None):
+    # every candidate through the exact DTW, no pruning
+    import numpy as np
+    import polymath
+    q = index.sequence(index.scalar_index.rows[query.id], "tail")
+    scalar = index.scalar_index.distances(query, index.weights, querybpm)
+    rows = [row for row in np.flatnonzero(np.isfinite(scalar)) if index.sequence(row, "head") is not None]
+    C = np.stack([index.sequence(row, "head") for row in rows])
+    dist = scalar[rows] + polymath.dtw_distances(q, C, index.band)
+    return index.videos[rows[int(np.argmin(dist))]]
+
+def benchmark_sequence(sizes=(1000, 10000), queries=5, verify_size=1000):
+    import polymath
+    results = []
+    failed = False
+    for size in sizes:
+        videos = synthetic_library(size)
+        for vid in videos:
+            vid.audio_features = SyntheticFrames(vid.audio_features)
+        for mode in polymath.SEQUENCE_MODES:
+            start = time.perf_counter()
+            index = polymath.SequenceIndex(videos, mode=mode)
+            build = time.perf_counter() - start
+            start = time.perf_counter()
+            found = [index.query(videos[i], k=1)[0] for i in range(queries)]
+            search = time.perf_counter() - start
+            result = {"size": size, "mode": mode, "index_build_seconds": build, "search_seconds": search / queries, "sequences_loaded": len(index.sequences)}
+            if size <= verify_size:
+                result["identical"] = found == [brute_force_sequence(index, videos[i]) for i in range(queries)]
+                failed = failed or not result["identical"]
+            results.append(result)
+            print("sequence", size, "tracks", mode, "build", round(build, 3), "search per query", round(search / queries, 3), "sequences loaded", result["sequences_loaded"], "identical", result.get("identical", "-"))
+    return results, failed
+
+
+def benchmark_segments(tracks=2000, segments=300000, queries=100, k=10, seed=0):
+    import numpy as np
+    import polymath
+    results = {}
+    # the full path on synthetic songs: embed every segment, train the cells, save and load again
+    videos = synthetic_library(tracks)
+    for vid in videos:
+        vid.audio_features = SyntheticFrames(vid.audio_features)
+    # a track without segments must not count as new on every update
+    videos[-1].audio_features.update(segments_boundaries=np.zeros(0), segments_labels=np.zeros(0))
+    with tempfile.TemporaryDirectory() as workdir:
+        index = polymath.SegmentIndex(workdir)
+        start = time.perf_counter()
+        index.update(videos)
+        results["build_seconds"] = time.perf_counter() - start
+        repeated = index.update(videos)
+        start = time.perf_counter()
+        index = polymath.SegmentIndex(workdir)
+        unchanged = index.update(videos)
+        results["load_seconds"] = time.perf_counter() - start
+        results["tracks"], results["track_segments"] = tracks, len(index.meta)
+        hits = index.query(videos[0].id, 0, k=k)
+    print("segments", tracks, "tracks", results["track_segments"], "segments", "build", round(results["build_seconds"], 3), "load", round(results["load_seconds"], 3),
+          "re-embedded on update", repeated, "after load", unchanged, "first hit", hits[0][:3] if hits else None)
+    failed = repeated != 0 or unchanged != 0 or len(hits) == 0
+
+    # search at scale on clustered embeddings, recall against an exact scan
+    rng = np.random.default_rng(seed)
+    dims = polymath.SEGMENT_TIMBRE_DIMS + 12 + 7
+    centers = rng.normal(0, 1, (500, dims))
+    raw = (centers[rng.integers(0, len(centers), segments)] + rng.normal(0, 1, (segments, dims))).astype(np.float32)
+    meta = np.zeros(segments, dtype=polymath.SEGMENT_META_DTYPE)
+    meta["track"] = np.arange(segments) // 10
+    index = polymath.SegmentIndex(os.devnull)
+    start = time.perf_counter()
+    index.set_segments([f"synthetic_{i:07d}" for i in range(segments // 10)], [0] * (segments // 10), raw, meta)
+    results["train_seconds"] = time.perf_counter() - start
+    recall = []
+    start = time.perf_counter()
+    found = [index.search(index.embeddings[row], k=k, exclude_track=int(meta["track"][row])) for row in range(0, segments, segments // queries)]
+    results["query_seconds"] = (time.perf_counter() - start) / len(found)
+    for row, hits in zip(range(0, segments, segments // queries), found):
+        dist = np.sum((index.embeddings - index.embeddings[row]) ** 2, axis=1)
+        dist[meta["track"] == meta["track"][row]] = np.inf
+        exact = set(np.argsort(dist)[:k].tolist())
+        recall.append(len(exact & {hit for hit, _ in hits}) / k)
+    results["segments"], results["recall"] = segments, float(np.mean(recall))
+    print("segments", segments, "segments", "train", round(results["train_seconds"], 3), "query", round(results["query_seconds"] * 1000, 3), "ms", f"recall@{k}", round(results["recall"], 3))
+    return results, failed
+
+
+################## SPECTRAL FRONT-END ##################
+
+# features from the shared STFT may differ from the separate librosa calls by this much,
+# relative to the value range of each feature
+SPECTRAL_TOLERANCE = 0.05
+
+def timed(timings, stage, fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    timings[stage] = time.perf_counter() - start
+    return result
+
+def relative_error(a, b):
+    import numpy as np
+    a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+    if a.shape != b.shape:
+        return float("inf")
+    scale = max(float(np.max(a) - np.min(a)), 1e-9)
+    return float(np.max(np.abs(a - b)) / scale)
+
+def benchmark_spectral(seconds=60):
+    import polymath
+    try:
+        import librosa
+    except ImportError:
+        print("spectral: librosa not installed, skipped")
+        return {}, False
+    y, sr = synthetic_track(seconds)
+    # warm up numba/fft caches so neither path pays for them
+    librosa.effects.hpss(y[:sr])
+    librosa.cqt(y[:5 * sr], sr=sr)
+
+    legacy = {}
+    y_harmonic, y_percussive = timed(legacy, "hpss", librosa.effects.hpss, y)
+    onset = timed(legacy, "onset", librosa.onset.onset_strength, y=y_percussive, sr=sr)
+    tempo, beats = timed(legacy, "beat_track", librosa.beat.beat_track, sr=sr, onset_envelope=onset, trim=False)
+    intensity = timed(legacy, "intensity", polymath.get_intensity, y, sr, beats)
+    pitch = timed(legacy, "pitch", polymath.get_pitch, y_harmonic, sr, beats)
+    timbre = timed(legacy, "timbre", polymath.get_timbre, y, sr, beats)
+
+    shared = {}
+    frontend = timed(shared, "stft", polymath.SpectralFrontEnd, y, sr)
+    timed(shared, "hpss", frontend.hpss)
+    onset_shared = timed(shared, "onset", frontend.onset_envelope)
+    tempo_shared, beats_shared = timed(shared, "beat_track", librosa.beat.beat_track, sr=sr, onset_envelope=onset_shared, trim=False)
+    intensity_shared = timed(shared, "intensity", lambda: polymath.get_intensity(y, sr, beats_shared, CQT=frontend.cqt()))
+    pitch_shared = timed(shared, "pitch", lambda: polymath.get_pitch(frontend.harmonic(), sr, beats_shared))
+    timbre_shared = timed(shared, "timbre", lambda: polymath.get_timbre(y, sr, beats_shared, S=frontend.mel()))
+
+    errors = {
+        "tempo": relative_error(tempo, tempo_shared),
+        "beats": relative_error(beats, beats_shared),
+        "intensity": relative_error(intensity, intensity_shared),
+        "pitch": relative_error(pitch, pitch_shared),
+        "timbre": relative_error(timbre, timbre_shared),
+    }
+    failed = any(error > SPECTRAL_TOLERANCE for error in errors.values())
+    for stage in legacy:
+        print("spectral", stage, "legacy", round(legacy[stage], 3), "shared", round(shared[stage], 3))
+    print("spectral stft (shared only)", round(shared["stft"], 3), "total legacy", round(sum(legacy.values()), 3), "shared", round(sum(shared.values()), 3))
+    print("spectral relative errors", {k: round(v, 5) for k, v in errors.items()}, "tolerance", SPECTRAL_TOLERANCE)
+    return {"seconds": seconds, "legacy": legacy, "shared": shared, "errors": errors, "tolerance": SPECTRAL_TOLERANCE}, failed
+
+
+################## INGESTION ##################
+
+INGEST_SCRIPT = """
+import sys, json
+sys.path.insert(0, {polymath_dir!r})
+import polymath, benchmark
+polymath.stream_convert({src!r}, {dst!r})
+print("__BENCHMARK__" + json.dumps({{"max_rss_kb": benchmark.peak_rss_kb()}}))
+"""
+
+def peak_rss_kb():
+    # VmHWM is reset on exec, ru_maxrss on linux is inherited from the forking parent
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# peak memory of a multi-hour conversion may exceed a one minute conversion by at most this much
+INGEST_RSS_TOLERANCE_KB = 64 * 1024
+
+def write_long_wav(path, seconds, sr=22050, block_seconds=60):
+    # mono tone sweep written block by block, so generating it stays cheap too
+    import numpy as np
+    import soundfile as sf
+    with sf.SoundFile(path, "w", samplerate=sr, channels=1, subtype="PCM_16") as f:
+        for start in range(0, int(seconds), block_seconds):
+            n = int(min(block_seconds, seconds - start) * sr)
+            t = start + np.arange(n) / sr
+            f.write(0.3 * np.sin(2 * np.pi * (220 + (t % 60) * 5) * t))
+
+def benchmark_ingest(hours=2.0):
+    import shutil
+    if shutil.which("ffmpeg") is None:
+        print("ingest: ffmpeg not found, skipped")
+        return {}, False
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for seconds in (60, hours * 3600):
+            src = os.path.join(workdir, "synthetic.wav")
+            dst = os.path.join(workdir, "converted.wav")
+            write_long_wav(src, seconds)
+            start = time.perf_counter()
+            script = INGEST_SCRIPT.format(polymath_dir=POLYMATH_DIR, src=src, dst=dst)
+            proc = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True)
+            elapsed = time.perf_counter() - start
+            line = [l for l in proc.stdout.splitlines() if l.startswith("__BENCHMARK__")]
+            if proc.returncode != 0 or not line:
+                print("ingest FAILED", proc.stderr)
+                return results, True
+            result = json.loads(line[0][len("__BENCHMARK__"):])
+            result.update({"audio_seconds": seconds, "seconds": elapsed})
+            results.append(result)
+            print("ingest", round(seconds / 3600, 2), "hours", "seconds", round(elapsed, 2), "peak rss MB", round(result["max_rss_kb"] / 1024, 1))
+            os.remove(src)
+            os.remove(dst)
+    failed = results[-1]["max_rss_kb"] - results[0]["max_rss_kb"] > INGEST_RSS_TOLERANCE_KB
+    return results, failed
+
+
+STREAM_SCRIPT = """
+import sys, json
+sys.path.insert(0, {polymath_dir!r})
+import polymath, benchmark
+audio = polymath.StreamedAudio({src!r})
+tempo, beats, sr, duration = polymath.stream_beats(audio)
+CQT_sync, C_sync, M_sync = polymath.stream_features(audio, beats)
+volume, avg_volume, loudness = polymath.stream_volume(audio)
+print("__BENCHMARK__" + json.dumps({{"max_rss_kb": benchmark.peak_rss_kb(), "beats": len(beats), "frames": [CQT_sync.shape[1], C_sync.shape[1], M_sync.shape[1]]}}))
+"""
+
+def benchmark_stream(minutes=10.0):
+    # streamed beats, features and volume of a one minute and a long recording, peak memory should not grow
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for seconds in (60, minutes * 60):
+            src = os.path.join(workdir, "synthetic.wav")
+            write_long_wav(src, seconds)
+            start = time.perf_counter()
+            script = STREAM_SCRIPT.format(polymath_dir=POLYMATH_DIR, src=src)
+            proc = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True)
+            elapsed = time.perf_counter() - start
+            line = [l for l in proc.stdout.splitlines() if l.startswith("__BENCHMARK__")]
+            if proc.returncode != 0 or not line:
+                print("stream FAILED", proc.stderr[-2000:])
+                return results, True
+            result = json.loads(line[0][len("__BENCHMARK__"):])
+            result.update({"audio_seconds": seconds, "seconds": elapsed})
+            results.append(result)
+            print("stream", round(seconds / 60, 1), "minutes", "seconds", round(elapsed, 2), "peak rss MB", round(result["max_rss_kb"] / 1024, 1), "beats", result["beats"])
+            os.remove(src)
+    failed = results[-1]["max_rss_kb"] - results[0]["max_rss_kb"] > INGEST_RSS_TOLERANCE_KB
+    failed = failed or any(len(set(result["frames"])) != 1 for result in results)
+    return results, failed
+
+
+def benchmark_scan(files=100000, per_directory=500, touched=0.01):
+    # recursive scan of a nested share of empty audio files, then rescans against the manifest
+    import polymath
+    with tempfile.TemporaryDirectory() as workdir:
+        root = os.path.join(workdir, "share")
+        paths = []
+        for i in range(files):
+            directory = os.path.join(root, "artist%d" % (i // (per_directory * 10)), "album%d" % (i // per_directory))
+            if i % per_directory == 0:
+                os.makedirs(directory)
+            path = os.path.join(directory, "track%d%s" % (i, polymath.AUDIO_EXTENSIONS[i % 3]))
+            open(path, "wb").close()
+            paths.append(path)
+        manifest = polymath.ScanManifest(os.path.join(workdir, "manifest.json"))
+
+        def rescan():
+            start = time.perf_counter()
+            changed = [entry for entry in polymath.scan_audio(root) if manifest.unchanged(*entry) is None]
+            return changed, time.perf_counter() - start
+
+        changed, scan_seconds = rescan()
+        for path, mtime, size in changed:
+            manifest.put(path, mtime, size, os.path.basename(path))
+        start = time.perf_counter()
+        manifest.save()
+        manifest = polymath.ScanManifest(manifest.filename)
+        manifest_seconds = time.perf_counter() - start
+        unchanged, rescan_seconds = rescan()
+        for path in paths[::int(1 / touched)]:
+            with open(path, "ab") as f:
+                f.write(b"0")
+        modified, modified_seconds = rescan()
+    dedup = scan_edited_duplicate()
+    result = {"files": files, "scan_seconds": scan_seconds, "manifest_seconds": manifest_seconds,
+              "rescan_seconds": rescan_seconds, "modified_rescan_seconds": modified_seconds, "modified": len(modified),
+              "edited_duplicate_ok": dedup}
+    print("scan", files, "files", "first", round(scan_seconds, 2), "manifest save+load", round(manifest_seconds, 2),
+          "rescan", round(rescan_seconds, 2), "after touching", len(modified), round(modified_seconds, 2), "edited duplicate ok", dedup)
+    failed = len(changed) != files or len(unchanged) != 0 or len(modified) != len(paths[::int(1 / touched)]) or not dedup
+    return result, failed
+
+def scan_edited_duplicate():
+    # two identical files share one track, editing the second must not remove the first one's track
+    import numpy as np
+    import soundfile as sf
+    import polymath
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            os.makedirs("library")
+            y = 0.3 * np.sin(2 * np.pi * 440 * np.arange(polymath.INGEST_SR) / polymath.INGEST_SR)
+            for name in ("a", "b"):
+                os.makedirs(os.path.join("share", name))
+                sf.write(os.path.join(workdir, "share", name, "x.wav"), y, polymath.INGEST_SR, subtype="PCM_16")
+            library = polymath.Library()
+            manifest = polymath.ScanManifest()
+            first = polymath.audio_directory_process([os.path.join(workdir, "share")], library, manifest=manifest)
+            ids = {vid.id for vid in first}
+            original = [path for path in manifest.files if manifest.recorded(path) == polymath.audio_id(path)]
+            duplicate = [path for path in manifest.files if path not in original]
+            if len(ids) != 1 or len(original) != 1 or len(duplicate) != 1:
+                return False
+            sf.write(duplicate[0], 0.5 * y, polymath.INGEST_SR, subtype="PCM_16")
+            os.utime(duplicate[0], ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+            polymath.audio_directory_process([os.path.join(workdir, "share")], library, manifest=manifest)
+            return polymath.audio_id(original[0]) in library and polymath.audio_id(duplicate[0]) in library
+        finally:
+            os.chdir(cwd)
+
+################## ANALYSIS STAGES ##################
+
+# each run gets a fresh interpreter and working directory, so the stage cache is empty
+# and peak memory is that of the run alone; cuda is hidden so results compare across machines
+STAGES_SCRIPT = """
+import os, sys, json
+sys.path.insert(0, {polymath_dir!r})
+import polymath, benchmark
+os.chdir({workdir!r})
+polymath.profiler.start(run="benchmark")
+{call}
+print("__BENCHMARK__" + json.dumps({{"stages": polymath.profiler.rows, "max_rss_kb": benchmark.peak_rss_kb()}}))
+"""
+
+FEATURES_CALL = "polymath.get_audio_features(file={file!r}, file_id={file_id!r})"
+
+QUANTIZE_CALL = """
+vid = polymath.Video({file_id!r}, "", {file!r})
+vid.id = {file_id!r}
+vid.audio_features = {features!r}
+vid.audio_features["beats"] = benchmark.click_times({seconds!r}, {bpm!r})
+polymath.quantizeAudio(vid, bpm={target_bpm!r})
+"""
+
+FEATURES_MODULES = ("librosa", "crepe", "tensorflow", "sf_segmenter", "numba")
+QUANTIZE_MODULES = ("librosa", "pyrubberband")
+
+def missing_modules(modules, programs=()):
+    import shutil
+    import importlib.util
+    missing = [name for name in modules if importlib.util.find_spec(name) is None]
+    return missing + [name for name in programs if shutil.which(name) is None]
+
+def click_times(seconds, bpm):
+    import numpy as np
+    return np.arange(0, seconds, 60.0 / bpm)
+
+def run_stages(workdir, call):
+    script = STAGES_SCRIPT.format(polymath_dir=POLYMATH_DIR, workdir=workdir, call=call)
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES="")
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, env=env)
+    elapsed = time.perf_counter() - start
+    line = [l for l in proc.stdout.splitlines() if l.startswith("__BENCHMARK__")]
+    if proc.returncode != 0 or not line:
+        print(proc.stderr[-2000:])
+        return None
+    result = json.loads(line[0][len("__BENCHMARK__"):])
+    result["seconds"] = elapsed
+    return result
+
+def print_stages(name, result):
+    for row in result["stages"]:
+        print(name, row["stage"], "wall", row["wall_s"], "cpu", row["cpu_s"], "peak rss MB", row["peak_rss_mb"])
+    print(name, "total seconds", round(result["seconds"], 2), "peak rss MB", round(result["max_rss_kb"] / 1024, 1))
+
+def benchmark_features(minutes=3.0, bpm=120, key="A"):
+    import soundfile as sf
+    import polymath
+    missing = missing_modules(FEATURES_MODULES)
+    if missing:
+        print("features: missing", ", ".join(missing), "skipped")
+        return {}, False
+    with tempfile.TemporaryDirectory() as workdir:
+        file_id = "benchmark_mix"
+        y, sr = synthetic_mix(minutes * 60, bpm=bpm, key=key)
+        file = os.path.join(workdir, "library", file_id + ".wav")
+        os.makedirs(os.path.dirname(file))
+        sf.write(file, y, sr, subtype="PCM_16")
+        write_stub_stems(os.path.join(workdir, "separated", polymath.DEMUCS_MODEL, file_id), y, sr, polymath.STEMS)
+        result = run_stages(workdir, FEATURES_CALL.format(file=file, file_id=file_id))
+    if result is None:
+        print("features FAILED")
+        return {}, True
+    result.update({"minutes": minutes, "bpm": bpm, "key": key})
+    print_stages("features", result)
+    return result, False
+
+def benchmark_quantize(minutes=3.0, bpm=120, key="A", target_bpm=128):
+    import soundfile as sf
+    import polymath
+    missing = missing_modules(QUANTIZE_MODULES, programs=("rubberband",))
+    if missing:
+        print("quantize: missing", ", ".join(missing), "skipped")
+        return {}, False
+    with tempfile.TemporaryDirectory() as workdir:
+        file_id = "benchmark_mix"
+        y, sr = synthetic_mix(minutes * 60, bpm=bpm, key=key)
+        file = os.path.join(workdir, "library", file_id + ".wav")
+        os.makedirs(os.path.dirname(file))
+        os.makedirs(os.path.join(workdir, "processed"))
+        sf.write(file, y, sr, subtype="PCM_16")
+        write_stub_stems(os.path.join(workdir, "separated", polymath.DEMUCS_MODEL, file_id), y, sr, polymath.STEMS)
+        # the known click grid stands in for the beats get_audio_features would store
+        features = {"tempo": float(bpm), "frequency": note_frequency(key), "key": key + "4", "timbre": 0.0, "beats_sr": sr, "beats_hop_length": polymath.BEAT_HOP_LENGTH}
+        call = QUANTIZE_CALL.format(file_id=file_id, file=file, features=features, seconds=minutes * 60, bpm=bpm, target_bpm=target_bpm)
+        result = run_stages(workdir, call)
+    if result is None:
+        print("quantize FAILED")
+        return {}, True
+    result.update({"minutes": minutes, "bpm": bpm, "target_bpm": target_bpm})
+    print_stages("quantize", result)
+    return result, False
+
+
+################## MIDI ##################
+
+class StubTensor:
+    def __init__(self, value):
+        self.value = value
+
+    def numpy(self):
+        return self.value
+
+class StubMidiModel:
+    """Stands in for basic pitch: one output row per window, holding the window's first sample"""
+    def __call__(self, batch):
+        return {"note": StubTensor(batch[:, :1, 0].copy())}
+
+def benchmark_midi(files=20, max_windows=40, batch_windows=16, seed=0):
+    # batched transcription with a stub model, every window must come back to the file it was cut from
+    import numpy as np
+    import polymath
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(1, max_windows, files)
+    written = {}
+    def midi_windows(path):
+        i = int(os.path.basename(path))
+        return np.full((counts[i], 8, 1), i, dtype=np.float32), counts[i] * 8
+    def write_midi(outputs, length, path):
+        written[path] = (np.concatenate(outputs["note"]), length)
+        return path
+    saved = polymath.midi_windows, polymath.write_midi
+    polymath.midi_windows, polymath.write_midi = midi_windows, write_midi
+    try:
+        transcriber = polymath.MidiTranscriber(batch_windows=batch_windows)
+        transcriber.model = StubMidiModel()
+        jobs = [(str(i), "midi_%d" % i) for i in range(files)]
+        start = time.perf_counter()
+        paths = transcriber.transcribe_jobs(jobs)
+        seconds = time.perf_counter() - start
+    finally:
+        polymath.midi_windows, polymath.write_midi = saved
+    ok = paths == [midi for _, midi in jobs] and all(
+        len(written[midi]) == 2 and np.all(written[midi][0] == i) and len(written[midi][0]) == counts[i] and written[midi][1] == counts[i] * 8
+        for i, (_, midi) in enumerate(jobs))
+    print("midi", files, "files", int(counts.sum()), "windows", "batches of", batch_windows, "seconds", round(seconds, 4), "ok", ok)
+    return {"files": files, "windows": int(counts.sum()), "seconds": seconds, "ok": ok}, not ok
+
+
+################## LIBRARY LOAD ##################
+
+LIBRARY_SCRIPT = """
+import os, sys, json, time
+sys.path.insert(0, {polymath_dir!r})
+import polymath, benchmark
+os.chdir({workdir!r})
+start = time.perf_counter()
+library = polymath.read_library()
+videos = list(library)
+read = time.perf_counter() - start
+store = polymath.FeatureStore()
+for vid in videos:
+    vid.audio_features = store.get(vid.id)
+index = polymath.FeatureIndex(videos)
+total = time.perf_counter() - start
+print("__BENCHMARK__" + json.dumps({{"tracks": len(videos), "read_seconds": read, "load_seconds": total, "max_rss_kb": benchmark.peak_rss_kb()}}))
+"""
+
+def seed_library(workdir, size, seed=0):
+    # database snapshot and scalar feature table of a synthetic library, written in one go
+    import numpy as np
+    import polymath
+    videos = synthetic_library(size, seed)
+    for vid in videos:
+        vid.url = "library/" + vid.id + ".wav"
+        vid.audio = vid.url
+    library_file = os.path.join(workdir, polymath.LIBRARY_FILENAME)
+    os.makedirs(os.path.dirname(library_file), exist_ok=True)
+    polymath.write_library(videos, library_file)
+    store = polymath.FeatureStore(os.path.join(workdir, polymath.FEATURES_DIRECTORY))
+    store.ids = [vid.id for vid in videos]
+    store.table = np.zeros(size, dtype=polymath.SCALAR_DTYPE)
+    for name in polymath.SCALAR_FEATURES:
+        store.table[name] = [vid.audio_features.get(name, np.nan) for vid in videos]
+    store.table["key"] = [vid.audio_features["key"] for vid in videos]
+    store.dirty = True
+    store.save()
+
+def benchmark_library(sizes=(1000, 10000, 100000)):
+    results = []
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as workdir:
+            seed_library(workdir, size)
+            script = LIBRARY_SCRIPT.format(polymath_dir=POLYMATH_DIR, workdir=workdir)
+            proc = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True)
+        line = [l for l in proc.stdout.splitlines() if l.startswith("__BENCHMARK__")]
+        if proc.returncode != 0 or not line:
+            print("library", size, "FAILED", proc.stderr[-2000:])
+            return results, True
+        result = json.loads(line[0][len("__BENCHMARK__"):])
+        result["size"] = size
+        results.append(result)
+        print("library", size, "tracks", "read", round(result["read_seconds"], 3), "load", round(result["load_seconds"], 3), "peak rss MB", round(result["max_rss_kb"] / 1024, 1))
+    return results, False
+
+
+################## BASELINE ##################
+
+# a timing may grow by this factor over the baseline before it counts as a regression
+BASELINE_SLOWDOWN = 1.5
+# timings below this are too noisy to compare
+BASELINE_MIN_SECONDS = 0.05
+
+def flatten_timings(results, prefix=""):
+    # "suite/label/metric" -> seconds, list entries are labelled by what they measured
+    timings = {}
+    if isinstance(results, dict):
+        for key, value in results.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and (key.endswith("seconds") or key == "wall_s"):
+                timings[prefix + key] = float(value)
+            elif isinstance(value, (dict, list)):
+                timings.update(flatten_timings(value, prefix + key + "/"))
+    elif isinstance(results, list):
+        for i, item in enumerate(results):
+            label = i
+            if isinstance(item, dict):
+                label = "-".join(str(item[key]) for key in ("command", "size", "mode", "searchbpm", "audio_seconds", "stage", "track") if key in item) or i
+            timings.update(flatten_timings(item, prefix + str(label) + "/"))
+    return timings
+
+def compare_baseline(results, baseline, slowdown=BASELINE_SLOWDOWN):
+    current, previous = flatten_timings(results), flatten_timings(baseline)
+    regressions = []
+    for name in sorted(current.keys() & previous.keys()):
+        if previous[name] < BASELINE_MIN_SECONDS and current[name] < BASELINE_MIN_SECONDS:
+            continue
+        ratio = current[name] / max(previous[name], 1e-9)
+        if ratio > slowdown:
+            regressions.append(name)
+            print("baseline", name, "was", round(previous[name], 3), "now", round(current[name], 3), f"x{ratio:.2f}")
+    print("baseline", len(current.keys() & previous.keys()), "timings compared,", len(regressions), "slower than", f"x{slowdown}")
+    return regressions
+
+
+################## MAIN ##################
+
+SUITES = ("startup", "search", "filter", "playlist", "sequence", "segments", "library", "spectral", "features", "quantize", "midi", "ingest", "stream", "scan")
+
+def main():
+    parser = argparse.ArgumentParser(description='polymath benchmarks')
+    parser.add_argument('-o', '--output', help='write results as json to this file', required=False)
+    parser.add_argument('-b', '--baseline', help='compare timings with the json of an earlier run', required=False)
+    parser.add_argument('-s', '--suites', help='comma separated subset of ' + ",".join(SUITES), required=False, default=",".join(SUITES))
+    parser.add_argument('--sizes', help='synthetic library sizes for search and library load', required=False, default="1000,10000,100000")
+    parser.add_argument('--track-minutes', help='length of the synthetic song for the features and quantize benchmarks', required=False, type=float, default=3.0)
+    parser.add_argument('--stream-minutes', help='length of the long synthetic recording for the streaming analysis benchmark', required=False, type=float, default=10.0)
+    parser.add_argument('--ingest-hours', help='length of the synthetic recording for the ingestion benchmark', required=False, type=float, default=2.0)
+    args = parser.parse_args()
+    suites = args.suites.split(",")
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    benchmarks = {
+        "startup": lambda: benchmark_startup(),
+        "search": lambda: benchmark_search(sizes),
+        "filter": lambda: benchmark_filter(sizes),
+        "playlist": lambda: benchmark_playlist(),
+        "sequence": lambda: benchmark_sequence([size for size in sizes if size <= 10000]),
+        "segments": lambda: benchmark_segments(),
+        "library": lambda: benchmark_library(sizes),
+        "spectral": lambda: benchmark_spectral(),
+        "features": lambda: benchmark_features(args.track_minutes),
+        "quantize": lambda: benchmark_quantize(args.track_minutes),
+        "midi": lambda: benchmark_midi(),
+        "ingest": lambda: benchmark_ingest(args.ingest_hours),
+        "stream": lambda: benchmark_stream(args.stream_minutes),
+        "scan": lambda: benchmark_scan(),
+    }
+    results = {}
+    failed = False
+    sys.path.insert(0, POLYMATH_DIR)
+    for suite in SUITES:
+        if suite in suites:
+            results[suite], suite_failed = benchmarks[suite]()
+            failed = failed or suite_failed
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            if compare_baseline(results, json.load(f)):
+                failed = True
+    if failed:
+        print("benchmark: FAILED")
+        sys.exit(1)
+    print("benchmark: OK")
+
+if __name__ == "__main__":
+    main()
@@ -6,23 +6,26 @@ import sys
 import pickle
 import argparse
 import subprocess
-import fnmatch
 import hashlib
 import shutil
+import time
+import json
+import csv
+import threading
+import socket
+import socketserver
+import queue
+import traceback
+from contextlib import contextmanager
 from math import log2, pow
 
-from numba import cuda
 import numpy as np 
-import librosa
-import crepe
 import soundfile as sf
-import pyrubberband as pyrb
-from yt_dlp import YoutubeDL
-from sf_segmenter.segmenter import Segmenter
-import tensorflow as tf
-from basic_pitch import ICASSP_2022_MODEL_PATH
-from basic_pitch.inference import predict_and_save
-from basic_pitch.inference import predict
+
+# Heavy modules (librosa, crepe, tensorflow, basic_pitch, numba, yt_dlp,
+# sf_segmenter, pyrubberband) are imported inside the functions that need them,
+# so commands like search, remove and list start without loading them.
+HEAVY_MODULES = ("librosa", "crepe", "tensorflow", "basic_pitch", "numba", "yt_dlp", "sf_segmenter", "pyrubberband")
 
 ##########################################
 ################ POLYMATH ################
@@ -38,35 +41,369 @@ class Video:
         self.audio = audio
         self.video_features = []
         self.audio_features = []
+        self.content_hash = ""
 
 ### Library
 
 LIBRARY_FILENAME = "library/database.p"
+LIBRARY_JOURNAL = "library/database.journal"
+JOURNAL_COMPACT_MIN = 100
 basic_pitch_model = ""
 
-def write_library(videos):
-    with open(LIBRARY_FILENAME, "wb") as lib:
+def write_library(videos, filename=LIBRARY_FILENAME):
+    # written next to the old file and renamed, a crash never leaves half a database
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "wb") as lib:
         pickle.dump(videos, lib)
+    os.replace(tmp_filename, filename)
 
 
 def read_library():
-    try:
-        with open(LIBRARY_FILENAME, "rb") as lib:
-            return pickle.load(lib)
-    except:
-        print("No Database file found:", LIBRARY_FILENAME)
-    return []
+    return Library()
+
+class Library:
+    """Videos by id: the database.p snapshot plus an append-only journal of adds and removes"""
+    def __init__(self, filename=LIBRARY_FILENAME, journal=LIBRARY_JOURNAL):
+        self.filename = filename
+        self.journal = journal
+        self.videos = {}
+        self.journal_records = 0
+        self.load()
+
+    def load(self):
+        videos = []
+        try:
+            with open(self.filename, "rb") as lib:
+                videos = pickle.load(lib)
+        except:
+            print("No Database file found:", self.filename)
+        self.videos = {vid.id: vid for vid in videos}
+        self.load_journal()
+        # videos pickled before content hashes existed have no content_hash
+        self.hashes = {vid.content_hash: vid.id for vid in self.videos.values() if getattr(vid, "content_hash", "")}
+
+    def load_journal(self):
+        if not os.path.isfile(self.journal):
+            return
+        with open(self.journal, "rb") as f:
+            good_offset = 0
+            while True:
+                try:
+                    op, value = pickle.load(f)
+                except EOFError:
+                    break
+                except Exception:
+                    # a record cut short by a crash, drop it so later appends stay readable
+                    print("Dropping incomplete library journal record at", good_offset)
+                    break
+                if op == "add":
+                    self.videos[value.id] = value
+                elif op == "remove":
+                    self.videos.pop(value, None)
+                self.journal_records += 1
+                good_offset = f.tell()
+        if good_offset < os.path.getsize(self.journal):
+            with open(self.journal, "r+b") as f:
+                f.truncate(good_offset)
+
+    def append_journal(self, op, value):
+        with open(self.journal, "ab") as f:
+            pickle.dump((op, value), f)
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal_records += 1
+        if self.journal_records >= max(JOURNAL_COMPACT_MIN, len(self.videos)):
+            self.compact()
+
+    def add(self, video):
+        self.videos[video.id] = video
+        if getattr(video, "content_hash", ""):
+            self.hashes[video.content_hash] = video.id
+        self.append_journal("add", video)
+
+    def remove(self, file_id):
+        if file_id not in self.videos:
+            return False
+        video = self.videos.pop(file_id)
+        self.hashes.pop(getattr(video, "content_hash", ""), None)
+        self.append_journal("remove", file_id)
+        return True
+
+    def get(self, file_id):
+        return self.videos.get(file_id)
+
+    def find_content(self, content_hash):
+        # video with the same audio content, None if there is none
+        return self.videos.get(self.hashes.get(content_hash))
+
+    def __contains__(self, file_id):
+        return file_id in self.videos
+
+    def __iter__(self):
+        return iter(list(self.videos.values()))
+
+    def __len__(self):
+        return len(self.videos)
+
+    def compact(self):
+        # fold the journal into a fresh snapshot
+        write_library(list(self.videos.values()), self.filename)
+        if os.path.isfile(self.journal):
+            os.remove(self.journal)
+        self.journal_records = 0
+
+### Feature Store
+
+# Scalar features of all tracks live in one compact table, frame-level features
+# in per-track float32 .npy files that are memory-mapped on first access.
+FEATURES_DIRECTORY = "library/features"
+SCALAR_FEATURES = ("tempo", "duration", "timbre", "pitch", "intensity", "frequency", "loudness", "avg_volume", "beats_sr", "beats_hop_length")
+FRAME_FEATURES = ("timbre_frames", "pitch_frames", "intensity_frames", "frequency_frames", "volume")
+ARRAY_FEATURES = ("beats", "segments_boundaries", "segments_labels")
+SCALAR_DTYPE = np.dtype([(name, np.float64) for name in SCALAR_FEATURES] + [("key", "U8"), ("segments", np.int32)])
+
+class AudioFeatures(dict):
+    """Features of one track: scalars are held in memory, arrays load from disk when first accessed"""
+    def __init__(self, scalars, frames_dir):
+        super().__init__(scalars)
+        self.frames_dir = frames_dir
+
+    def __missing__(self, name):
+        if name not in FRAME_FEATURES + ARRAY_FEATURES:
+            raise KeyError(name)
+        value = np.load(os.path.join(self.frames_dir, name + ".npy"), mmap_mode="r")
+        self[name] = value
+        return value
+
+    def __reduce__(self):
+        scalars = {k: v for k, v in self.items() if k in ("id", "key", "segments") or k in SCALAR_FEATURES}
+        return (AudioFeatures, (scalars, self.frames_dir))
+
+class FeatureStore:
+    def __init__(self, directory=FEATURES_DIRECTORY):
+        self.directory = directory
+        self.table_path = os.path.join(directory, "scalars.npy")
+        self.ids_path = os.path.join(directory, "ids.txt")
+        self.ids = []
+        self.table = np.zeros(0, dtype=SCALAR_DTYPE)
+        self.dirty = False
+        if os.path.isfile(self.table_path) and os.path.isfile(self.ids_path):
+            self.table = np.load(self.table_path)
+            with open(self.ids_path) as f:
+                self.ids = f.read().splitlines()
+        self.rows = {file_id: i for i, file_id in enumerate(self.ids)}
+        self.version = 0 # bumped on every change, tells cached search indexes they are stale
+
+    def __contains__(self, file_id):
+        return file_id in self.rows
+
+    def __len__(self):
+        return len(self.ids)
+
+    def frames_dir(self, file_id):
+        return os.path.join(self.directory, "frames", file_id)
+
+    def get(self, file_id):
+        row = self.table[self.rows[file_id]]
+        scalars = {name: float(row[name]) for name in SCALAR_FEATURES}
+        scalars["key"] = str(row["key"])
+        scalars["segments"] = int(row["segments"])
+        scalars["id"] = file_id
+        return AudioFeatures(scalars, self.frames_dir(file_id))
+
+    def put(self, file_id, audio_features):
+        # frame arrays first, so a track is never in the table without its frames
+        self.put_frames(file_id, audio_features)
+        return self.put_scalars(file_id, audio_features)
+
+    def put_frames(self, file_id, audio_features):
+        # every array is written to a temp file and renamed, safe to run from worker processes
+        frames_dir = self.frames_dir(file_id)
+        os.makedirs(frames_dir, exist_ok=True)
+        for name in FRAME_FEATURES + ARRAY_FEATURES:
+            value = np.asarray(audio_features[name])
+            if name == "frequency_frames":
+                value = as_pitch_array(audio_features[name])
+            elif name in FRAME_FEATURES:
+                value = value.astype(np.float32)
+            tmp_path = os.path.join(frames_dir, name + ".tmp.npy")
+            np.save(tmp_path, value, allow_pickle=False)
+            os.replace(tmp_path, os.path.join(frames_dir, name + ".npy"))
+
+    def put_scalars(self, file_id, audio_features):
+        row = np.zeros(1, dtype=SCALAR_DTYPE)
+        for name in SCALAR_FEATURES:
+            # features from older versions may miss some scalars
+            row[name] = float(np.squeeze(audio_features.get(name, np.nan)))
+        row["key"] = audio_features["key"]
+        row["segments"] = len(audio_features["segments_boundaries"])
+        if file_id in self.rows:
+            self.table[self.rows[file_id]] = row[0]
+        else:
+            self.rows[file_id] = len(self.ids)
+            self.ids.append(file_id)
+            self.table = np.concatenate([self.table, row])
+        self.dirty = True
+        self.version += 1
+        return self.get(file_id)
+
+    def remove(self, file_id):
+        # the row and the track's frame files
+        shutil.rmtree(self.frames_dir(file_id), ignore_errors=True)
+        if file_id not in self.rows:
+            return
+        self.table = np.delete(self.table, self.rows[file_id])
+        self.ids.remove(file_id)
+        self.rows = {file_id: i for i, file_id in enumerate(self.ids)}
+        self.dirty = True
+        self.version += 1
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_table = self.table_path + ".tmp.npy"
+        np.save(tmp_table, self.table, allow_pickle=False)
+        tmp_ids = self.ids_path + ".tmp"
+        with open(tmp_ids, "w") as f:
+            f.write("\n".join(self.ids))
+        os.replace(tmp_table, self.table_path)
+        os.replace(tmp_ids, self.ids_path)
+        self.dirty = False
+
+def migrate_feature_pickles(videos, store):
+    # one-shot import of the old per-track library/<id>.a pickles
+    migrated = 0
+    for vid in videos:
+        feature_file = f"library/{vid.id}.a"
+        if vid.id not in store and os.path.isfile(feature_file):
+            with open(feature_file, "rb") as f:
+                store.put(vid.id, pickle.load(f))
+            migrated += 1
+    if migrated > 0:
+        store.save()
+        print("Migrated", migrated, "feature files to", store.directory)
+    return migrated
+
 
+### Metrics
+
+METRICS_DIRECTORY = "metrics"
+METRICS_FIELDS = ("run", "pid", "track", "stage", "wall_s", "cpu_s", "peak_rss_mb")
+
+def read_peak_rss():
+    # peak resident memory of this process in MB
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def reset_peak_rss():
+    # linux lets a process restart its peak memory counter, elsewhere peaks are since process start
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+class Profiler:
+    """Wall time, cpu time and peak memory per analysis stage and track, written to metrics/<run>.json and .csv"""
+    def __init__(self):
+        self.enabled = False
+        self.run = None
+        self.rows = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.open = 0
+        self.cprofile = None
+
+    @property
+    def stack(self):
+        # open stages of the calling thread, server jobs profile side by side
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def start(self, run=None, cprofile=False):
+        self.enabled = True
+        self.run = run or time.strftime("%Y%m%d-%H%M%S")
+        if cprofile:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    @contextmanager
+    def stage(self, name, track=""):
+        if not self.enabled:
+            yield
+            return
+        # the peak before a nested stage belongs to the enclosing one, since the counter is reset here.
+        # the counter is process-wide: while stages of other threads are open it is left alone, and the
+        # peaks of stages running side by side are those of the whole process
+        peak = read_peak_rss()
+        if self.stack:
+            self.stack[-1]["peak"] = max(self.stack[-1]["peak"], peak)
+        with self.lock:
+            if self.open == len(self.stack):
+                reset_peak_rss()
+            self.open += 1
+        frame = {"name": name, "peak": 0.0}
+        self.stack.append(frame)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            with self.lock:
+                self.open -= 1
+            self.stack.pop()
+            peak = max(frame["peak"], read_peak_rss())
+            if self.stack:
+                self.stack[-1]["peak"] = max(self.stack[-1]["peak"], peak)
+            self.rows.append({
+                "run": self.run,
+                "pid": os.getpid(),
+                "track": track,
+                "stage": "/".join([parent["name"] for parent in self.stack] + [name]),
+                "wall_s": round(wall, 4),
+                "cpu_s": round(cpu, 4),
+                "peak_rss_mb": round(peak, 1),
+            })
+
+    def save(self, directory=METRICS_DIRECTORY):
+        if not self.enabled:
+            return None
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, self.run)
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(path + ".prof")
+        with open(path + ".json", "w") as f:
+            json.dump({"run": self.run, "argv": sys.argv[1:], "stages": self.rows}, f, indent=1)
+        with open(path + ".csv", "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=METRICS_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.rows)
+        print(f"Metrics of {len(self.rows)} stages written to {path}.json/.csv")
+        return path
+
+profiler = Profiler()
 
 ################## VIDEO PROCESSING ##################
 
 def audio_extract(vidobj,file):
     print("audio_extract",file)
-    command = "ffmpeg -hide_banner -loglevel panic -i "+file+" -ab 160k -ac 2 -ar 44100 -vn -y " + vidobj.audio
-    subprocess.call(command,shell=True)
+    stream_convert(file, vidobj.audio)
     return vidobj.audio
 
 def video_download(vidobj,url):
+    from yt_dlp import YoutubeDL
     print("video_download",url)
     ydl_opts = {
     'outtmpl': 'library/%(id)s',
@@ -88,105 +425,395 @@ def video_download(vidobj,url):
     vidobj.url = url
     return vidobj
 
-def video_process(vids,videos):
+def video_process(vids,library):
+    processed = []
     for vid in vids:
         print('------ process video',vid)
         # check if id already in db
-        download_vid = True
-        for video in videos:
-            if video.id == vid:
-                print("already in db",vid)
-                download_vid = False
-                break
+        if vid in library:
+            print("already in db",vid)
+            processed.append(library.get(vid))
+            continue
 
         # analyse videos and save to disk
-        if download_vid:
-            video = Video(vid,vid,f"library/{vid}.wav")
-            video = video_download(video,f"https://www.youtube.com/watch?v={vid}")
-            audio_extract(video,video.video)
-            videos.append(video)
-            print("NAME",video.name,"VIDEO",video.video,"AUDIO",video.audio)
-            write_library(videos)
-            print("video_process DONE",len(videos))
-    return videos
+        video = Video(vid,vid,f"library/{vid}.wav")
+        video = video_download(video,f"https://www.youtube.com/watch?v={vid}")
+        audio_extract(video,video.video)
+        library.add(video)
+        processed.append(video)
+        print("NAME",video.name,"VIDEO",video.video,"AUDIO",video.audio)
+        print("video_process DONE",len(library))
+    return processed
 
 ################## AUDIO PROCESSING ##################
 
-def audio_directory_process(vids, videos):
-    filesToProcess = []
-    for vid in vids:
-        path = vid
-        pattern = "*.mp3"
-        for filename in fnmatch.filter(os.listdir(path), pattern):
-            filepath = os.path.join(path, filename)
-            print(filepath)
-            if os.path.isfile(filepath):
-                filesToProcess.append(filepath)
-
-    print('Found', len(filesToProcess), 'wav or mp3 files')
-    if len(filesToProcess) > 0:
-        videos = audio_process(filesToProcess, videos)
-    return videos
-
-def audio_process(vids, videos):
+INGEST_SR = 44100
+INGEST_CHANNELS = 2
+INGEST_BLOCK_FRAMES = 65536
+
+def stream_convert(src, dst, sr=INGEST_SR, channels=INGEST_CHANNELS, blocksize=INGEST_BLOCK_FRAMES):
+    # ffmpeg decodes and resamples into a pipe, written to wav block by block,
+    # so memory use does not grow with the length of the track
+    command = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", src, "-vn",
+               "-f", "f32le", "-acodec", "pcm_f32le", "-ac", str(channels), "-ar", str(sr), "-"]
+    frame_bytes = 4 * channels
+    tmp_path = dst + ".tmp"
+    with subprocess.Popen(command, stdout=subprocess.PIPE) as proc:
+        with sf.SoundFile(tmp_path, "w", samplerate=sr, channels=channels, subtype="PCM_16", format="WAV") as out:
+            rest = b""
+            while True:
+                data = proc.stdout.read(blocksize * frame_bytes)
+                if not data:
+                    break
+                data = rest + data
+                usable = len(data) - len(data) % frame_bytes
+                rest = data[usable:]
+                out.write(np.frombuffer(data[:usable], dtype=np.float32).reshape(-1, channels))
+    if proc.returncode != 0:
+        os.remove(tmp_path)
+        raise RuntimeError(f"ffmpeg failed to convert {src} (exit code {proc.returncode})")
+    os.replace(tmp_path, dst)
+    return dst
+
+HASH_CHUNK_BYTES = 1024 * 1024
+
+def content_hash(path, pcm=False):
+    # sha256 of the file bytes, or of the decoded pcm samples so retagged files match too,
+    # read in chunks so memory does not grow with the file size
+    hash_object = hashlib.sha256()
+    if not pcm:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+                hash_object.update(chunk)
+        return "file:" + hash_object.hexdigest()
+    command = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", path, "-vn", "-map", "0:a:0", "-f", "s16le", "-acodec", "pcm_s16le", "-"]
+    with subprocess.Popen(command, stdout=subprocess.PIPE) as proc:
+        for chunk in iter(lambda: proc.stdout.read(HASH_CHUNK_BYTES), b""):
+            hash_object.update(chunk)
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to decode {path} (exit code {proc.returncode})")
+    return "pcm:" + hash_object.hexdigest()
+
+### Directory Scan
+
+AUDIO_EXTENSIONS = (".wav", ".mp3", ".flac")
+SCAN_MANIFEST = "library/scan_manifest.json"
+SCAN_SAVE_EVERY = 256
+WATCH_INTERVAL = 10
+WATCH_QUEUE = 64
+
+def is_audio_file(path):
+    return path.lower().endswith(AUDIO_EXTENSIONS)
+
+def scan_audio(directory):
+    # walks the tree with os.scandir, yields (path, mtime_ns, size) of every audio file,
+    # symlinked folders are not followed so links back up the tree cannot loop
+    stack = [directory]
+    while stack:
+        path = stack.pop()
+        try:
+            entries = os.scandir(path)
+        except OSError as e:
+            print("cannot read directory", path, e)
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif is_audio_file(entry.name) and entry.is_file():
+                        stat = entry.stat()
+                        yield entry.path, stat.st_mtime_ns, stat.st_size
+                except OSError:
+                    # removed while scanning
+                    continue
+
+class ScanManifest:
+    """mtime, size and library id of every scanned audio file, rescans only look at new or changed files"""
+    def __init__(self, filename=SCAN_MANIFEST):
+        self.filename = filename
+        self.files = {}
+        self.dirty = False
+        if os.path.isfile(filename):
+            with open(filename) as f:
+                self.files = json.load(f)
+
+    def unchanged(self, path, mtime, size):
+        # library id recorded for the file, None if it is new or was modified since
+        entry = self.files.get(path)
+        if entry is None or entry[0] != mtime or entry[1] != size:
+            return None
+        return entry[2]
+
+    def recorded(self, path):
+        entry = self.files.get(path)
+        return entry[2] if entry is not None else None
+
+    def put(self, path, mtime, size, file_id):
+        self.files[path] = [mtime, size, file_id]
+        self.dirty = True
+
+    def prune(self, directory, seen):
+        # forget files under directory that were not found by the last scan
+        prefix = os.path.join(directory, "")
+        for path in [path for path in self.files if path.startswith(prefix) and path not in seen]:
+            del self.files[path]
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "w") as f:
+            json.dump(self.files, f)
+        os.replace(tmp_filename, self.filename)
+        self.dirty = False
+
+def ingest_files(files, library, manifest, store=None, pcmhash=False):
+    # adds scanned (path, mtime, size) files to the library and records them in the manifest
+    processed = []
+    for count, (path, mtime, size) in enumerate(files, 1):
+        # modified in place: same path and id, but the old features no longer match. a file found to be
+        # a duplicate of another path's track is recorded with that track's id, which is left alone
+        old_id = manifest.recorded(path)
+        if old_id is not None and old_id == audio_id(path) and old_id in library:
+            print("changed on disk", path)
+            library.remove(old_id)
+            if store is not None:
+                store.remove(old_id)
+        try:
+            added = audio_process([path], library, pcmhash=pcmhash)
+        except Exception as e:
+            sys.stderr.write(f"Failed to add {path}: {e}\n")
+            continue
+        manifest.put(path, mtime, size, added[0].id)
+        processed += added
+        if count % SCAN_SAVE_EVERY == 0:
+            manifest.save()
+    if store is not None:
+        store.save()
+    manifest.save()
+    return processed
+
+def audio_directory_process(vids, library, pcmhash=False, manifest=None, store=None):
+    manifest = manifest if manifest is not None else ScanManifest()
+    processed = []
+    changed = []
+    for directory in vids:
+        seen = set()
+        for path, mtime, size in scan_audio(directory):
+            seen.add(path)
+            file_id = manifest.unchanged(path, mtime, size)
+            if file_id is not None and file_id in library:
+                processed.append(library.get(file_id))
+            else:
+                changed.append((path, mtime, size))
+        manifest.prune(directory, seen)
+
+    print('Found', len(processed) + len(changed), 'audio files,', len(changed), 'new or changed')
+    processed += ingest_files(changed, library, manifest, store=store, pcmhash=pcmhash)
+    return processed
+
+class FolderWatcher:
+    """Rescans folders in a thread and queues new or changed audio files, waits while the queue is full"""
+    def __init__(self, directories, library, manifest, interval=WATCH_INTERVAL, queue_size=WATCH_QUEUE):
+        self.directories = directories
+        self.library = library
+        self.manifest = manifest
+        self.interval = interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.pending = set()
+        self.pending_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.scan, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def scan(self):
+        while not self.stopped.is_set():
+            for directory in self.directories:
+                for path, mtime, size in scan_audio(directory):
+                    if self.stopped.is_set():
+                        return
+                    file_id = self.manifest.unchanged(path, mtime, size)
+                    if file_id is not None and file_id in self.library:
+                        continue
+                    # still being copied, picked up by a later scan
+                    if time.time() - mtime / 1e9 < self.interval:
+                        continue
+                    with self.pending_lock:
+                        if path in self.pending:
+                            continue
+                        self.pending.add(path)
+                    self.queue.put((path, mtime, size))
+            self.stopped.wait(self.interval)
+
+    def batches(self, size):
+        # blocks for the first file, then takes whatever else is already queued
+        while not self.stopped.is_set():
+            batch = [self.queue.get()]
+            while len(batch) < size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            yield batch
+            with self.pending_lock:
+                self.pending.difference_update(path for path, _, _ in batch)
+
+def audio_id(path):
+    # unique ID based on file path and name
+    audioname = os.path.splitext(os.path.basename(path))[0]
+    return f"{audioname}_{hashlib.sha256(path.encode()).hexdigest()}"
+
+def audio_process(vids, library, pcmhash=False):
+    processed = []
     for vid in vids:
         print('------ process audio',vid)
         # extract file name
-        audioname = vid.split("/")[-1]
-        audioname, _ = audioname.split(".")
+        audioname = os.path.splitext(os.path.basename(vid))[0]
 
         # generate a unique ID based on file path and name
-        hash_object = hashlib.sha256(vid.encode())
-        audioid = hash_object.hexdigest()
-        audioid = f"{audioname}_{audioid}"
+        audioid = audio_id(vid)
 
         # check if id already in db
-        process_audio = True
-        for video in videos:
-            if video.id == audioid:
-                print("already in db",vid)
-                process_audio = False
-                break
-
-        # check if is mp3 and convert it to wav
-        if vid.endswith(".mp3"):
-            # convert mp3 to wav and save it
-            print('converting mp3 to wav:', vid)
-            y, sr = librosa.load(path=vid, sr=None, mono=False)
+        if audioid in library:
+            print("already in db",vid)
+            processed.append(library.get(audioid))
+            continue
+
+        # same audio under another path (moved, re-mounted or copied), reuse its features, stems and midi
+        audiohash = content_hash(vid, pcm=pcmhash)
+        duplicate = library.find_content(audiohash)
+        if duplicate is not None:
+            print("already in db as",duplicate.id,vid)
+            processed.append(duplicate)
+            continue
+
+        # check if is mp3 or flac and convert it to wav
+        if vid.lower().endswith((".mp3", ".flac")):
+            # convert to wav and save it
+            print('converting to wav:', vid)
             path = os.path.join(os.getcwd(), 'library', audioid+'.wav')
-            # resample to 44100k if required
-            if sr != 44100:
-                print('converting audio file to 44100:', vid)
-                y = librosa.resample(y, orig_sr=sr, target_sr=44100)
-            sf.write(path, np.ravel(y), 44100)
+            stream_convert(vid, path)
             vid = path
 
         # check if is wav and copy it to local folder
-        elif vid.endswith(".wav"):
+        elif vid.lower().endswith(".wav"):
             path1 = vid
             path2 = os.path.join(os.getcwd(), 'library', audioid+'.wav')
-            y, sr = librosa.load(path=vid, sr=None, mono=False)
-            if sr != 44100:
+            if sf.info(vid).samplerate != INGEST_SR:
                 print('converting audio file to 44100:', vid)
-                y = librosa.resample(y, orig_sr=sr, target_sr=44100)
-                sf.write(path2, y, 44100)
+                stream_convert(path1, path2)
             else:
                 shutil.copy2(path1, path2)
             vid = path2
 
         # analyse videos and save to disk
-        if process_audio:
-            video = Video(audioname,'',vid)
-            video.id = audioid
-            video.url = vid
-            videos.append(video)
-            write_library(videos)
-            print("Finished procesing files:",len(videos))
+        video = Video(audioname,'',vid)
+        video.id = audioid
+        video.url = vid
+        video.content_hash = audiohash
+        library.add(video)
+        processed.append(video)
+        print("Finished procesing files:",len(library))
             
-    return videos
+    return processed
 
 ################## AUDIO FEATURES ##################
 
+class DecodedAudio:
+    """A track decoded once to mono at its native rate, resampled variants are cached"""
+    def __init__(self, file, y=None, sr=None):
+        import librosa
+        self.file = file
+        if y is None:
+            y, sr = librosa.load(file, sr=None)
+        self.y = y
+        self.sr = sr
+        self.variants = {sr: y}
+        self.lock = threading.Lock()
+
+    def resampled(self, sr):
+        # stages running side by side share one resampled copy
+        import librosa
+        with self.lock:
+            if sr not in self.variants:
+                self.variants[sr] = librosa.resample(self.y, orig_sr=self.sr, target_sr=sr)
+            return self.variants[sr]
+
+    def read(self, sr, start, stop):
+        return self.resampled(sr)[start:stop]
+
+    def __str__(self):
+        return str(self.file)
+
+STREAM_READ_SAMPLES = 1 << 20 # samples read from the file at a time
+
+class StreamedAudio:
+    """A track decoded block by block to mono float32 files on disk, used like DecodedAudio through memmaps"""
+    def __init__(self, file):
+        self.file = file
+        self.sr = sf.info(file).samplerate
+        self.variants = {}
+        self.files = {}
+        self.lock = threading.Lock()
+
+    @property
+    def y(self):
+        return self.resampled(self.sr)
+
+    def resampled(self, sr):
+        # same samples as librosa.load(sr=None) and the soxr_hq resampler librosa.resample uses since 0.10,
+        # without holding the track in memory. the pinned librosa 0.9 resamples with resampy instead,
+        # so streamed and in-memory features of the same track differ slightly there
+        import soxr
+        import tempfile
+        with self.lock:
+            if sr not in self.variants:
+                length = int(np.ceil(sf.info(self.file).frames * sr / self.sr))
+                f = tempfile.TemporaryFile()
+                resampler = soxr.ResampleStream(self.sr, sr, 1, dtype="float32", quality="HQ") if sr != self.sr else None
+                written = 0
+                for block in sf.blocks(self.file, blocksize=STREAM_READ_SAMPLES, dtype="float32", always_2d=True):
+                    block = np.mean(block, axis=1)
+                    if resampler is not None:
+                        block = resampler.resample_chunk(block)
+                    block = block[:max(length - written, 0)]
+                    f.write(block.astype(np.float32).tobytes())
+                    written += len(block)
+                if resampler is not None and written < length:
+                    block = resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True)[:length - written]
+                    f.write(block.astype(np.float32).tobytes())
+                    written += len(block)
+                # padded to the length librosa.resample returns
+                f.write(np.zeros(length - written, dtype=np.float32).tobytes())
+                self.files[sr] = f
+                self.variants[sr] = np.memmap(f, dtype=np.float32, mode="r", shape=(length,)) if length > 0 else np.zeros(0, dtype=np.float32)
+            return self.variants[sr]
+
+    def read(self, sr, start, stop):
+        # samples start..stop read from the file, pages of the memmap would stay in memory once touched
+        length = len(self.resampled(sr))
+        start, stop = min(max(start, 0), length), min(max(stop, 0), length)
+        with self.lock:
+            f = self.files[sr]
+            f.seek(start * 4)
+            return np.frombuffer(f.read((stop - start) * 4), dtype=np.float32)
+
+    def __str__(self):
+        return str(self.file)
+
+def decode_audio(audio):
+    # stages accept a file path or an already decoded track
+    if isinstance(audio, (DecodedAudio, StreamedAudio)):
+        return audio
+    return DecodedAudio(audio)
+
 def root_mean_square(data):
     return float(np.sqrt(np.mean(np.square(data))))
 
@@ -232,10 +859,10 @@ def trim_data(
     return data[start:end]
 
 def load_and_trim(file):
-    y, rate = librosa.load(file, mono=True)
-    y = normalized(y)
+    audio = decode_audio(file)
+    y = normalized(audio.resampled(22050))
     trimmed = trim_data(y)
-    return trimmed, rate
+    return trimmed, 22050
 
 def get_loudness(file):
     loudness = -1
@@ -247,8 +874,10 @@ def get_loudness(file):
     return loudness
 
 def get_volume(file):
+    import librosa
     volume = -1
     avg_volume = -1
+    loudness = -1
     try:
         audio, rate = load_and_trim(file)
         volume = librosa.feature.rms(y=audio)[0]
@@ -258,49 +887,127 @@ def get_volume(file):
         sys.stderr.write(f"Failed to get Volume and Loudness on {file}: {e}\n")
     return volume, avg_volume, loudness
 
+NOTE_NAMES = ("C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B")
+
 def get_key(freq):
     A4 = 440
     C0 = A4*pow(2, -4.75)
-    name = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
     h = round(12*log2(freq/C0))
     octave = h // 12
     n = h % 12
-    return name[n] + str(octave)
+    return NOTE_NAMES[n] + str(octave)
+
+def key_class(key):
+    # pitch class 0-11 of a key like "C#4", -1 if unknown
+    name = str(key).rstrip("-0123456789")
+    return NOTE_NAMES.index(name) if name in NOTE_NAMES else -1
+
+# camelot wheel numbers of each tonic, B for major keys and A for minor keys
+CAMELOT_MAJOR = {"B":1, "F#":2, "C#":3, "G#":4, "D#":5, "A#":6, "F":7, "C":8, "G":9, "D":10, "A":11, "E":12}
+CAMELOT_MINOR = {"G#":1, "D#":2, "A#":3, "F":4, "C":5, "G":6, "D":7, "A":8, "E":9, "B":10, "F#":11, "C#":12}
+
+def camelot_codes(key):
+    # get_key has no mode, so a key is read both as major and as minor: [(number, letter), ...]
+    name = str(key).rstrip("-0123456789")
+    if name not in NOTE_NAMES:
+        return []
+    return [(CAMELOT_MAJOR[name], "B"), (CAMELOT_MINOR[name], "A")]
+
+def compatible_keys(key, steps=1):
+    # pitch classes a mix into key works with: up to steps around the wheel and the relative key
+    tonics = {"B": {n: name for name, n in CAMELOT_MAJOR.items()}, "A": {n: name for name, n in CAMELOT_MINOR.items()}}
+    classes = set()
+    for number, letter in camelot_codes(key):
+        codes = [((number - 1 + step) % 12 + 1, letter) for step in range(-steps, steps + 1)]
+        codes.append((number, "A" if letter == "B" else "B"))
+        classes.update(NOTE_NAMES.index(tonics[l][n]) for n, l in codes)
+    return sorted(classes)
 
 def get_average_pitch(pitch):
-    pitches = []
     confidences_thresh = 0.8
-    i = 0
-    while i < len(pitch):
-        if(pitch[i][2] > confidences_thresh):
-            pitches.append(pitch[i][1])
-        i += 1
+    pitch = as_pitch_array(pitch)
+    pitches = pitch["frequency"][pitch["confidence"] > confidences_thresh].astype(np.float64)
     if len(pitches) > 0:
-        average_frequency = np.array(pitches).mean()
+        average_frequency = pitches.mean()
         average_key = get_key(average_frequency)
     else:
         average_frequency = 0
         average_key = "A0"
     return average_frequency,average_key
 
-def get_intensity(y, sr, beats):
+class SpectralFrontEnd:
+    """STFT of a track computed once: HPSS, onset and mel features are derived from it"""
+    def __init__(self, y, sr, n_fft=2048, hop_length=512):
+        import librosa
+        self.y = y
+        self.sr = sr
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.D = librosa.stft(y, n_fft=n_fft, hop_length=hop_length)
+        self.D_harmonic = None
+        self.D_percussive = None
+        self.y_harmonic = None
+        self.CQT = None
+
+    def hpss(self):
+        # same as librosa.effects.hpss, but stays in the spectral domain
+        import librosa
+        if self.D_harmonic is None:
+            self.D_harmonic, self.D_percussive = librosa.decompose.hpss(self.D)
+        return self.D_harmonic, self.D_percussive
+
+    def harmonic(self):
+        # time domain harmonic part, only needed for the chroma CQT
+        import librosa
+        if self.y_harmonic is None:
+            D_harmonic, _ = self.hpss()
+            self.y_harmonic = librosa.istft(D_harmonic, hop_length=self.hop_length, dtype=self.y.dtype, length=len(self.y))
+        return self.y_harmonic
+
+    def power(self):
+        return np.abs(self.D)**2
+
+    def mel(self, D=None, n_mels=128):
+        import librosa
+        S = self.power() if D is None else np.abs(D)**2
+        return librosa.feature.melspectrogram(S=S, sr=self.sr, n_fft=self.n_fft, hop_length=self.hop_length, n_mels=n_mels)
+
+    def onset_envelope(self):
+        # onset strength of the percussive part, from its STFT instead of a resynthesized signal
+        import librosa
+        _, D_percussive = self.hpss()
+        S = librosa.power_to_db(self.mel(D_percussive))
+        return librosa.onset.onset_strength(S=S, sr=self.sr, hop_length=self.hop_length)
+
+    def cqt(self):
+        import librosa
+        if self.CQT is None:
+            self.CQT = librosa.cqt(self.y, sr=self.sr, hop_length=self.hop_length, fmin=librosa.note_to_hz('A1'))
+        return self.CQT
+
+def get_intensity(y, sr, beats, CQT=None):
+    import librosa
     # Beat-synchronous Loudness - Intensity
-    CQT = librosa.cqt(y, sr=sr, fmin=librosa.note_to_hz('A1'))
+    if CQT is None:
+        CQT = librosa.cqt(y, sr=sr, fmin=librosa.note_to_hz('A1'))
     freqs = librosa.cqt_frequencies(CQT.shape[0], fmin=librosa.note_to_hz('A1'))
     perceptual_CQT = librosa.perceptual_weighting(CQT**2, freqs, ref=np.max)
     CQT_sync = librosa.util.sync(perceptual_CQT, beats, aggregate=np.median)
     return CQT_sync
 
 def get_pitch(y_harmonic, sr, beats):
+    import librosa
     # Chromagram
     C = librosa.feature.chroma_cqt(y=y_harmonic, sr=sr)
     # Beat-synchronous Chroma - Pitch
     C_sync = librosa.util.sync(C, beats, aggregate=np.median)
     return C_sync
 
-def get_timbre(y, sr, beats):
+def get_timbre(y, sr, beats, S=None):
+    import librosa
     # Mel spectogram
-    S = librosa.feature.melspectrogram(y, sr=sr, n_mels=128)
+    if S is None:
+        S = librosa.feature.melspectrogram(y=y, sr=sr, n_mels=128)
     log_S = librosa.power_to_db(S, ref=np.max)
     # MFCC - Timbre
     mfcc = librosa.feature.mfcc(S=log_S, n_mfcc=13)
@@ -312,40 +1019,433 @@ def get_timbre(y, sr, beats):
     return M_sync
 
 def get_segments(audio_file):
+    from sf_segmenter.segmenter import Segmenter
+    from sf_segmenter.feature import audio_extract_pcp
+    # same as Segmenter.proc_audio, without decoding the file again
+    audio = decode_audio(audio_file)
     segmenter = Segmenter()
-    boundaries, labs = segmenter.proc_audio(audio_file)
+    boundaries, labs = segmenter.process(audio_extract_pcp(audio.resampled(22050), 22050), is_label=True)
     return boundaries,labs 
 
-def get_pitch_dnn(audio_file):
+### Pitch Tracking
+
+PITCH_DTYPE = np.dtype([("time", np.float32), ("frequency", np.float32), ("confidence", np.float32)])
+CREPE_SR = 16000
+CREPE_FRAME = 1024
+CREPE_BINS = 360
+
+def as_pitch_array(pitch):
+    # structured (time, frequency, confidence) array, also from the old list of [time, freq, conf]
+    if isinstance(pitch, np.ndarray) and pitch.dtype.names is not None:
+        return pitch
+    pitch = np.asarray(pitch, dtype=np.float32).reshape(-1, 3)
+    result = np.zeros(len(pitch), dtype=PITCH_DTYPE)
+    result["time"], result["frequency"], result["confidence"] = pitch[:, 0], pitch[:, 1], pitch[:, 2]
+    return result
+
+def local_average_cents(salience, center):
+    # crepe's to_local_average_cents, vectorized over frames
+    cents_mapping = np.linspace(0, 7180, CREPE_BINS) + 1997.3794084376191
+    bins = center[:, None] + np.arange(-4, 5)[None, :]
+    valid = (bins >= 0) & (bins < CREPE_BINS)
+    bins = np.clip(bins, 0, CREPE_BINS - 1)
+    weights = np.take_along_axis(salience, bins, axis=1) * valid
+    return np.sum(weights * cents_mapping[bins], axis=1) / np.sum(weights, axis=1)
+
+class PitchViterbi:
+    """crepe's viterbi smoothing (hmmlearn CategoricalHMM) decoded frame by frame, backpointers kept on disk"""
+    band = 11
+
+    def __init__(self, n_frames):
+        import tempfile
+        # transition probabilities inducing continuous pitch, only |i - j| <= 11 is non-zero
+        xx, yy = np.meshgrid(range(CREPE_BINS), range(CREPE_BINS))
+        transition = np.maximum(12 - abs(xx - yy), 0)
+        transition = transition / np.sum(transition, axis=1)[:, None]
+        offsets = np.arange(-self.band, self.band + 1)
+        # row k holds the transition from state j + offsets[k] into state j
+        previous = np.arange(CREPE_BINS)[None, :] + offsets[:, None]
+        valid = (previous >= 0) & (previous < CREPE_BINS)
+        self.previous = np.clip(previous, 0, CREPE_BINS - 1)
+        with np.errstate(divide="ignore"):
+            self.log_transition = np.where(valid, np.log(transition[self.previous, np.arange(CREPE_BINS)[None, :]]), -np.inf)
+        self.log_self = np.log(0.1 + 0.9 / CREPE_BINS)
+        self.log_other = np.log(0.9 / CREPE_BINS)
+        self.backpointers = np.memmap(tempfile.TemporaryFile(), dtype=np.int8, mode="w+", shape=(max(n_frames, 1), CREPE_BINS))
+        self.delta = None
+        self.t = 0
+
+    def update(self, observations):
+        columns = np.arange(CREPE_BINS)
+        for observation in observations:
+            log_emission = np.full(CREPE_BINS, self.log_other)
+            log_emission[observation] = self.log_self
+            if self.delta is None:
+                self.delta = np.log(1.0 / CREPE_BINS) + log_emission
+            else:
+                scores = self.delta[self.previous] + self.log_transition
+                best = np.argmax(scores, axis=0)
+                self.backpointers[self.t] = best
+                self.delta = scores[best, columns] + log_emission
+            self.t += 1
+
+    def path(self):
+        path = np.zeros(self.t, dtype=np.int64)
+        if self.t == 0:
+            return path
+        path[-1] = np.argmax(self.delta)
+        for t in range(self.t - 1, 0, -1):
+            path[t - 1] = path[t] + self.backpointers[t, path[t]] - self.band
+        return path
+
+class PitchTracker:
+    """Chunked crepe pitch tracking, frames of several tracks can share one model batch"""
+    def __init__(self, model_capacity="tiny", viterbi=True, step_size=10, chunk_seconds=60, batch_size=512, verbose=0):
+        self.model_capacity = model_capacity # tiny|small|medium|large|full
+        self.viterbi = viterbi
+        self.step_size = step_size
+        self.hop_length = int(CREPE_SR * step_size / 1000)
+        self.chunk_frames = max(1, int(chunk_seconds * 1000 / step_size))
+        self.batch_size = batch_size
+        self.verbose = verbose
+
+    def n_frames(self, y):
+        # crepe pads 512 samples on both sides (center=True)
+        return 1 + len(y) // self.hop_length
+
+    def frames(self, y, start, stop):
+        # normalized 1024-sample frames start..stop, read from the unpadded signal
+        from numpy.lib.stride_tricks import as_strided
+        pad = CREPE_FRAME // 2
+        first = start * self.hop_length - pad
+        last = (stop - 1) * self.hop_length + CREPE_FRAME - pad
+        audio = np.zeros(last - first, dtype=np.float32)
+        lo, hi = max(first, 0), min(last, len(y))
+        if hi > lo:
+            audio[lo - first:hi - first] = y[lo:hi]
+        frames = as_strided(audio, shape=(stop - start, CREPE_FRAME), strides=(self.hop_length * audio.itemsize, audio.itemsize)).copy()
+        frames -= np.mean(frames, axis=1)[:, np.newaxis]
+        frames /= np.clip(np.std(frames, axis=1)[:, np.newaxis], 1e-8, None)
+        return frames
+
+    def track(self, y):
+        return self.track_many([y])[0]
+
+    def track_many(self, signals):
+        # signals are mono 16kHz, each round runs the next chunk of every unfinished track in one predict call
+        import tempfile
+        import crepe
+        model = crepe.core.build_and_load_model(self.model_capacity)
+        n_frames = [self.n_frames(y) for y in signals]
+        done = [0] * len(signals)
+        confidence = [np.zeros(n, dtype=np.float32) for n in n_frames]
+        cents = [np.zeros(n, dtype=np.float64) for n in n_frames]
+        activations = [np.memmap(tempfile.TemporaryFile(), dtype=np.float32, mode="w+", shape=(n, CREPE_BINS)) if self.viterbi else None for n in n_frames]
+        decoders = [PitchViterbi(n) if self.viterbi else None for n in n_frames]
+
+        while any(done[i] < n_frames[i] for i in range(len(signals))):
+            batch, owners = [], []
+            for i, y in enumerate(signals):
+                if done[i] < n_frames[i]:
+                    stop = min(done[i] + self.chunk_frames, n_frames[i])
+                    batch.append(self.frames(y, done[i], stop))
+                    owners.append((i, done[i], stop))
+                    done[i] = stop
+            activation = model.predict(np.concatenate(batch), batch_size=self.batch_size, verbose=self.verbose)
+            offset = 0
+            for i, start, stop in owners:
+                chunk = activation[offset:offset + stop - start]
+                offset += stop - start
+                confidence[i][start:stop] = chunk.max(axis=1)
+                if self.viterbi:
+                    activations[i][start:stop] = chunk
+                    decoders[i].update(np.argmax(chunk, axis=1))
+                else:
+                    cents[i][start:stop] = local_average_cents(chunk, np.argmax(chunk, axis=1))
+
+        results = []
+        for i in range(len(signals)):
+            if self.viterbi:
+                path = decoders[i].path()
+                for start in range(0, n_frames[i], self.chunk_frames):
+                    stop = min(start + self.chunk_frames, n_frames[i])
+                    cents[i][start:stop] = local_average_cents(np.asarray(activations[i][start:stop]), path[start:stop])
+            pitch = np.zeros(n_frames[i], dtype=PITCH_DTYPE)
+            pitch["time"] = np.arange(n_frames[i]) * self.step_size / 1000.0
+            frequency = 10 * 2 ** (cents[i] / 1200)
+            frequency[np.isnan(frequency)] = 0
+            pitch["frequency"] = frequency
+            pitch["confidence"] = confidence[i]
+            results.append(pitch)
+        return results
+
+def get_pitch_dnn(audio_file, tracker=None):
     # DNN Pitch Detection
-    pitch = []
-    audio, sr = librosa.load(audio_file)
-    time, frequency, confidence, activation = crepe.predict(audio, sr, model_capacity="tiny", viterbi=True, center=True, step_size=10, verbose=1) # tiny|small|medium|large|full
-    i = 0
-    while i < len(time):
-        pitch.append([time[i],frequency[i],confidence[i]])
-        i += 1
-    return pitch
-
-def stemsplit(destination, demucsmodel):
-    subprocess.run(["demucs", destination, "-n", demucsmodel]) #  '--mp3'
-
-def extractMIDI(audio_paths, output_dir):
-    print('- Extract Midi')
-    save_midi = True
-    sonify_midi = False
-    save_model_outputs = False
-    save_notes = False
-
-    predict_and_save(audio_path_list=audio_paths, 
-                  output_directory=output_dir, 
-                  save_midi=save_midi, 
-                  sonify_midi=sonify_midi, 
-                  save_model_outputs=save_model_outputs, 
-                  save_notes=save_notes)
-
-
-def quantizeAudio(vid, bpm=120, keepOriginalBpm = False, pitchShiftFirst = False, extractMidi = False):
+    # crepe works at 16kHz, hand it the resampled signal directly
+    audio = decode_audio(audio_file)
+    if tracker is None:
+        tracker = PitchTracker()
+    return tracker.track(audio.resampled(CREPE_SR))
+
+### Source Separation
+
+class SeparationEngine:
+    """Demucs model loaded once per process, separates a queue of tracks into separated/<model>/<id>/<stem>.wav"""
+    def __init__(self, model_name, segment=None, overlap=0.25, shifts=1, threads=None, batch_size=1, device=None):
+        self.model_name = model_name
+        self.segment = segment # seconds per chunk, None uses the model's default
+        self.overlap = overlap
+        self.shifts = shifts
+        self.threads = threads
+        self.batch_size = batch_size # tracks padded to the same length and separated together
+        self.device = device
+        self.model = None
+
+    def load(self):
+        import torch
+        from demucs.pretrained import get_model
+        if self.model is None:
+            if self.threads:
+                torch.set_num_threads(self.threads)
+            if self.device is None:
+                self.device = "cuda" if torch.cuda.is_available() else "cpu"
+            print("- Separation: loading", self.model_name, "on", self.device)
+            self.model = get_model(self.model_name)
+            self.model.to(self.device)
+            self.model.eval()
+        return self.model
+
+    def output_dir(self, file_id):
+        return os.path.join(os.getcwd(), 'separated', self.model_name, file_id)
+
+    def separate(self, file, file_id):
+        return self.separate_many([(file, file_id)])[0]
+
+    def separate_many(self, tracks):
+        # tracks: list of (audio file, id), returns the stem paths of every track
+        results = []
+        for start in range(0, len(tracks), self.batch_size):
+            results += self.separate_batch(tracks[start:start + self.batch_size])
+        return results
+
+    def separate_batch(self, tracks):
+        import torch
+        from demucs.apply import apply_model
+        from demucs.audio import save_audio
+        from demucs.separate import load_track
+        model = self.load()
+        mixes, refs = [], []
+        for file, file_id in tracks:
+            print("- Separation:", file_id)
+            wav = load_track(file, model.audio_channels, model.samplerate)
+            # same normalization as the demucs command line
+            ref = wav.mean(0)
+            mixes.append((wav - ref.mean()) / ref.std())
+            refs.append(ref)
+        length = max(mix.shape[-1] for mix in mixes)
+        batch = torch.stack([torch.nn.functional.pad(mix, (0, length - mix.shape[-1])) for mix in mixes])
+        with torch.no_grad():
+            sources = apply_model(model, batch, device=self.device, shifts=self.shifts, split=True, overlap=self.overlap, progress=False, num_workers=0, segment=self.segment)
+
+        results = []
+        for (file, file_id), mix, ref, track_sources in zip(tracks, mixes, refs, sources):
+            track_sources = track_sources[..., :mix.shape[-1]] * ref.std() + ref.mean()
+            output_dir = self.output_dir(file_id)
+            os.makedirs(output_dir, exist_ok=True)
+            paths = []
+            for source, name in zip(track_sources, model.sources):
+                path = os.path.join(output_dir, name + '.wav')
+                save_audio(source.cpu(), path, samplerate=model.samplerate, clip='rescale', bits_per_sample=16, as_float=False)
+                paths.append(path)
+            results.append(paths)
+        return results
+
+separation_engines = {}
+
+def get_separation_engine(model_name, **options):
+    # one resident engine per model and options in this process
+    key = (model_name, tuple(sorted(options.items())))
+    if key not in separation_engines:
+        separation_engines[key] = SeparationEngine(model_name, **options)
+    return separation_engines[key]
+
+def gpu_models_resident():
+    # whether a model kept loaded in this process may live on the gpu: a demucs engine on cuda,
+    # crepe or basic pitch. resetting the device would destroy the context they run in
+    if any(engine.model is not None and engine.device != "cpu" for engine in separation_engines.values()):
+        return True
+    if midi_transcriber is not None and midi_transcriber.model is not None:
+        return True
+    crepe = sys.modules.get("crepe.core")
+    return crepe is not None and any(model is not None for model in crepe.models.values())
+
+def stemsplit(destination, demucsmodel, file_id=None, separation=None):
+    # stems land where the demucs command line puts them: separated/<model>/<file name>/
+    if file_id is None:
+        file_id = os.path.splitext(os.path.basename(destination))[0]
+    engine = get_separation_engine(demucsmodel, **(separation or {}))
+    return engine.separate(destination, file_id)
+
+### Midi Transcription
+
+MIDI_BATCH_WINDOWS = 64 # basic pitch windows per model call, shared across stems and tracks
+MIDI_OVERLAP_FRAMES = 30
+MIDI_MIN_NOTE_MS = 58
+
+def midi_path(audio_path, output_dir):
+    return os.path.join(output_dir, os.path.splitext(os.path.basename(audio_path))[0] + '_basic_pitch.mid')
+
+def midi_windows(audio_path):
+    # same framing as basic_pitch.inference.get_audio_input, without tensorflow
+    import librosa
+    from basic_pitch.constants import AUDIO_SAMPLE_RATE, AUDIO_N_SAMPLES, FFT_HOP
+    overlap_len = MIDI_OVERLAP_FRAMES * FFT_HOP
+    hop_size = AUDIO_N_SAMPLES - overlap_len
+    audio, _ = librosa.load(str(audio_path), sr=AUDIO_SAMPLE_RATE, mono=True)
+    length = len(audio)
+    audio = np.concatenate([np.zeros(overlap_len // 2, dtype=np.float32), audio])
+    n_windows = -(-len(audio) // hop_size)
+    padded = np.zeros((n_windows - 1) * hop_size + AUDIO_N_SAMPLES, dtype=np.float32)
+    padded[:len(audio)] = audio
+    windows = np.lib.stride_tricks.sliding_window_view(padded, AUDIO_N_SAMPLES)[::hop_size]
+    return windows[..., None], length
+
+def write_midi(outputs, length, path):
+    # unwraps the windowed model output and writes the notes, runs next to inference in a thread
+    from basic_pitch import note_creation
+    from basic_pitch.constants import AUDIO_SAMPLE_RATE, ANNOTATIONS_FPS, FFT_HOP
+    n_olap = MIDI_OVERLAP_FRAMES // 2
+    n_frames = int(np.floor(length * (ANNOTATIONS_FPS / AUDIO_SAMPLE_RATE)))
+    unwrapped = {}
+    for name, windows in outputs.items():
+        windows = np.stack(windows)[:, n_olap:-n_olap, :]
+        unwrapped[name] = windows.reshape(-1, windows.shape[-1])[:n_frames]
+    midi_data, _ = note_creation.model_output_to_notes(
+        unwrapped,
+        onset_thresh=0.5,
+        frame_thresh=0.3,
+        min_note_len=int(np.round(MIDI_MIN_NOTE_MS / 1000 * (AUDIO_SAMPLE_RATE / FFT_HOP))),
+        min_freq=None,
+        max_freq=None,
+        multiple_pitch_bends=False,
+        melodia_trick=True,
+    )
+    midi_data.write(path)
+    return path
+
+class MidiTranscriber:
+    """Basic Pitch with one loaded model: queued audio files are windowed and run through the model in shared batches"""
+    def __init__(self, batch_windows=MIDI_BATCH_WINDOWS):
+        self.batch_windows = batch_windows
+        self.model = None
+        self.pending = [] # (audio path, midi path)
+
+    def load(self):
+        global basic_pitch_model
+        if self.model is None:
+            # main() preloads the model with --midi, worker processes load it here once
+            if basic_pitch_model == "":
+                import tensorflow as tf
+                from basic_pitch import ICASSP_2022_MODEL_PATH
+                basic_pitch_model = tf.saved_model.load(str(ICASSP_2022_MODEL_PATH))
+            self.model = basic_pitch_model
+        return self.model
+
+    def add(self, audio_paths, output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+        self.pending += [(path, midi_path(path, output_dir)) for path in audio_paths]
+
+    def transcribe(self, audio_paths, output_dir):
+        self.add(audio_paths, output_dir)
+        return self.flush()
+
+    def flush(self):
+        # the next file decodes and finished files are written while the model runs
+        jobs, self.pending = self.pending, []
+        if len(jobs) == 0:
+            return []
+        with profiler.stage("midi", f"{len(jobs)} files"):
+            return self.transcribe_jobs(jobs)
+
+    def transcribe_jobs(self, jobs):
+        from concurrent.futures import ThreadPoolExecutor
+        model = self.load()
+        print(f'- Extract Midi: {len(jobs)} files')
+        outputs = [{} for _ in jobs]
+        remaining = [0] * len(jobs)
+        lengths = [0] * len(jobs)
+        written = []
+        batch, owners = [], []
+
+        def run_batch():
+            results = {name: value.numpy() for name, value in model(np.stack(batch)).items()}
+            for row, owner in enumerate(owners):
+                for name, value in results.items():
+                    outputs[owner].setdefault(name, []).append(value[row])
+                remaining[owner] -= 1
+                if remaining[owner] == 0:
+                    written.append(writer.submit(write_midi, outputs[owner], lengths[owner], jobs[owner][1]))
+                    outputs[owner] = None
+            batch.clear()
+            owners.clear()
+
+        with ThreadPoolExecutor(max_workers=1) as loader, ThreadPoolExecutor(max_workers=1) as writer:
+            loading = loader.submit(midi_windows, jobs[0][0])
+            for i in range(len(jobs)):
+                windows, lengths[i] = loading.result()
+                if i + 1 < len(jobs):
+                    loading = loader.submit(midi_windows, jobs[i + 1][0])
+                remaining[i] = len(windows)
+                for window in windows:
+                    batch.append(window)
+                    owners.append(i)
+                    if len(batch) == self.batch_windows:
+                        run_batch()
+            if len(batch) > 0:
+                run_batch()
+            return [future.result() for future in written]
+
+midi_transcriber = None
+
+def get_midi_transcriber():
+    global midi_transcriber
+    if midi_transcriber is None:
+        midi_transcriber = MidiTranscriber()
+    return midi_transcriber
+
+def extractMIDI(audio_paths, output_dir, transcriber=None):
+    # with a transcriber the files are only queued, they are transcribed together on its flush()
+    if transcriber is not None:
+        transcriber.add(audio_paths, output_dir)
+        return []
+    return get_midi_transcriber().transcribe(audio_paths, output_dir)
+
+
+BEAT_HOP_LENGTH = 512
+
+def get_beat_grid(audio_features, sr, hop_length=BEAT_HOP_LENGTH):
+    # beat frames stored with the features, None if missing or tracked with other parameters
+    try:
+        beat_times = np.asarray(audio_features["beats"], dtype=np.float64)
+    except (KeyError, OSError):
+        return None
+    # features from before the grid parameters were stored were tracked at the native rate with hop 512
+    beats_sr = audio_features.get("beats_sr", np.nan)
+    beats_hop_length = audio_features.get("beats_hop_length", np.nan)
+    if np.isnan(beats_sr) or np.isnan(beats_hop_length):
+        beats_sr, beats_hop_length = sr, BEAT_HOP_LENGTH
+    if beats_sr != sr or beats_hop_length != hop_length:
+        return None
+    return np.round(beat_times * sr / hop_length).astype(int)
+
+### Quantize Engine
+
+# one report per run, named after the server job or the process that quantized
+QUANTIZE_REPORT = "processed/quantize_report_{run}.json"
+
+def quantize_jobs(vid, bpm=120, keepOriginalBpm = False, pitchShiftFirst = False):
+    # one stretch job for the mix and each stem, all sharing the time map of the mix
+    import librosa
     print("Quantize Audio: Target BPM", bpm, 
         "-- id:",vid.id,
         "bpm:",round(vid.audio_features["tempo"],2),
@@ -356,8 +1456,9 @@ def quantizeAudio(vid, bpm=120, keepOriginalBpm = False, pitchShiftFirst = False
         'keepOriginalBpm:', keepOriginalBpm
         )
 
-    # load audio file
-    y, sr = librosa.load(vid.audio, sr=None)
+    # the mix is only decoded here if it is changed before stretching or has no stored beat grid
+    info = sf.info(vid.audio)
+    y, sr, length = None, info.samplerate, info.frames
 
     # Keep Original Song BPM
     if keepOriginalBpm:
@@ -366,6 +1467,7 @@ def quantizeAudio(vid, bpm=120, keepOriginalBpm = False, pitchShiftFirst = False
     # Pitch Shift audio file to desired BPM first
     elif pitchShiftFirst: # WORK IN PROGRESS
         print('Pitch Shifting audio to desired BPM', bpm)
+        y, sr = librosa.load(vid.audio, sr=None)
         # Desired tempo in bpm
         original_tempo = vid.audio_features['tempo']
         speed_factor = bpm / original_tempo
@@ -373,10 +1475,22 @@ def quantizeAudio(vid, bpm=120, keepOriginalBpm = False, pitchShiftFirst = False
         sr_stretched = int(sr / speed_factor)
         y = librosa.resample(y=y, orig_sr=sr, target_sr=sr_stretched) #,  res_type='linear'
         y = librosa.resample(y, orig_sr=sr, target_sr=44100)
+        length = len(y)
 
-    # extract beat
-    y_harmonic, y_percussive = librosa.effects.hpss(y)
-    tempo, beats = librosa.beat.beat_track(sr=sr, onset_envelope=librosa.onset.onset_strength(y=y_percussive, sr=sr), trim=False)
+    # extract beat, the grid stored by get_audio_features is reused when it matches this audio
+    beats = None if pitchShiftFirst else get_beat_grid(vid.audio_features, sr)
+    if beats is not None:
+        tempo = vid.audio_features['tempo']
+    else:
+        print('- Quantize Audio: beat tracking')
+        with profiler.stage("beats", vid.id):
+            if y is None:
+                y, sr = librosa.load(vid.audio, sr=None)
+            frontend = SpectralFrontEnd(y, sr, hop_length=BEAT_HOP_LENGTH)
+            tempo, beats = librosa.beat.beat_track(sr=sr, onset_envelope=frontend.onset_envelope(), hop_length=BEAT_HOP_LENGTH, trim=False)
+            del frontend
+        if not pitchShiftFirst:
+            y = None
     beat_frames = librosa.frames_to_samples(beats)
 
     # generate metronome
@@ -392,16 +1506,12 @@ def quantizeAudio(vid, bpm=120, keepOriginalBpm = False, pitchShiftFirst = False
         time_map.append(new_member)
 
     # add ending to time map
-    original_length = len(y+1)
+    original_length = length
     orig_end_diff = original_length - time_map[i][0]
     new_ending = int(round(time_map[i][1] + orig_end_diff * (tempo / bpm)))
     new_member = (original_length, new_ending)
     time_map.append(new_member)
 
-    # time strech audio
-    print('- Quantize Audio: source')
-    strechedaudio = pyrb.timemap_stretch(y, sr, time_map)
-
     path_suffix = (
         f"Key {vid.audio_features['key']} - "
         f"Freq {round(vid.audio_features['frequency'], 2)} - "
@@ -413,146 +1523,1412 @@ def quantizeAudio(vid, bpm=120, keepOriginalBpm = False, pitchShiftFirst = False
         f"{vid.id} - {vid.name}"
     )
 
-    audiofilepaths = []
-    # save audio to disk
-    path = os.path.join(os.getcwd(), 'processed', path_prefix + " - " + path_suffix +'.wav')
-    sf.write(path, strechedaudio, sr)
-    audiofilepaths.append(path)
-
-    # process stems
-    stems = ['bass', 'drums', 'guitar', 'other', 'piano', 'vocals']
-    for stem in stems:
-        path = os.path.join(os.getcwd(), 'separated', 'htdemucs_6s', vid.id, stem +'.wav')
-        print(f"- Quantize Audio: {stem}")
-        y, sr = librosa.load(path, sr=None)
-        strechedaudio = pyrb.timemap_stretch(y, sr, time_map)
-        # save stems to disk
-        path = os.path.join(os.getcwd(), 'processed', path_prefix + " - Stem " + stem + " - " + path_suffix +'.wav')
-        sf.write(path, strechedaudio, sr)
-        audiofilepaths.append(path)
-
-    # metronome click (optinal)
-    click = False
-    if click:
-        clicks_audio = librosa.clicks(times=fixed_beat_times, sr=sr)
-        print(len(clicks_audio), len(strechedaudio))
-        clicks_audio = clicks_audio[:len(strechedaudio)] 
-        path = os.path.join(os.getcwd(), 'processed', vid.id + '- click.wav')
-        sf.write(path, clicks_audio, sr)
-
+    jobs = [{"track": vid.id, "part": "source", "src": vid.audio, "audio": y, "sr": sr, "time_map": time_map,
+             "dst": os.path.join(os.getcwd(), 'processed', path_prefix + " - " + path_suffix +'.wav')}]
+    for stem, path in zip(STEMS, stem_paths(vid.id)):
+        jobs.append({"track": vid.id, "part": stem, "src": path, "audio": None, "sr": None, "time_map": time_map,
+                     "dst": os.path.join(os.getcwd(), 'processed', path_prefix + " - Stem " + stem + " - " + path_suffix +'.wav')})
+    return jobs
+
+def stretch(job):
+    import librosa
+    import pyrubberband as pyrb
+    start = time.perf_counter()
+    with profiler.stage("stretch" if job["part"] == "source" else "stretch_" + job["part"], job["track"]):
+        if job["audio"] is None:
+            y, sr = librosa.load(job["src"], sr=None)
+        else:
+            y, sr = job["audio"], job["sr"]
+        strechedaudio = pyrb.timemap_stretch(y, sr, job["time_map"])
+    return strechedaudio, sr, time.perf_counter() - start
+
+def stretch_job(job, profile_run=None):
+    # runs in a pool worker: loads and stretches one file, the parent writes the result
+    if profile_run is not None and not profiler.enabled:
+        profiler.start(run=profile_run)
+    profiler.rows = []
+    return stretch(job) + (profiler.rows,)
+
+class QuantizeEngine:
+    """Stretches the mix and stems of many tracks in a process pool, a writer thread saves each result as it comes in"""
+    def __init__(self, workers=None):
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.jobs = []
+        self.tracks = []
+
+    def add(self, vid, bpm=120, keepOriginalBpm = False, pitchShiftFirst = False):
+        if vid.id in self.tracks:
+            return
+        with profiler.stage("quantize_plan", vid.id):
+            self.jobs += quantize_jobs(vid, bpm=bpm, keepOriginalBpm=keepOriginalBpm, pitchShiftFirst=pitchShiftFirst)
+        self.tracks.append(vid.id)
+
+    def run(self, extractMidi = False, transcriber = None, report_path = None):
+        if len(self.jobs) == 0:
+            return []
+        if report_path is None:
+            job = current_job()
+            report_path = QUANTIZE_REPORT.format(run=time.strftime("%Y%m%d-%H%M%S") + (f"-job{job.id}" if job is not None else f"-{os.getpid()}"))
+        jobs, self.jobs, tracks, self.tracks = self.jobs, [], self.tracks, []
+        workers = min(self.workers, len(jobs))
+        print(f"Quantizing {len(tracks)} files, {len(jobs)} stretch jobs with {workers} workers")
+        report = [{"track": job["track"], "part": job["part"], "output": job["dst"], "state": "queued", "seconds": None, "error": None} for job in jobs]
+        finished = []
+        start = time.perf_counter()
+
+        def finish(i, state, error=None, seconds=None):
+            report[i].update({"state": state, "error": error, "seconds": round(seconds, 2) if seconds is not None else None})
+            finished.append(i)
+            print(f"[{len(finished)}/{len(jobs)}] {jobs[i]['track']} {jobs[i]['part']} {state}" + (f": {error}" if error else f" ({report[i]['seconds']}s)"))
+
+        # results wait here while the writer is busy, so at most a few stretched files are held in memory
+        writes = queue.Queue(maxsize=workers)
+        def write():
+            while True:
+                item = writes.get()
+                if item is None:
+                    break
+                i, strechedaudio, sr, seconds = item
+                try:
+                    write_start = time.perf_counter()
+                    with profiler.stage("write", jobs[i]["track"]):
+                        sf.write(jobs[i]["dst"], strechedaudio, sr)
+                    finish(i, "done", seconds=seconds + time.perf_counter() - write_start)
+                except Exception as e:
+                    finish(i, "failed", str(e))
+        writer = threading.Thread(target=carry_job(write), daemon=True)
+        writer.start()
+
+        collected = set()
+        def collect(i, result):
+            collected.add(i)
+            try:
+                strechedaudio, sr, seconds, rows = result()
+            except Exception as e:
+                finish(i, "failed", str(e))
+                return
+            profiler.rows += rows
+            writes.put((i, strechedaudio, sr, seconds))
+
+        try:
+            if workers == 1:
+                for i, job in enumerate(jobs):
+                    collect(i, lambda: stretch(job) + ([],))
+            else:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+                # rubberband runs as a subprocess per job, the workers only need one thread each
+                with thread_limits(1), ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+                    pending = {}
+                    next_job = 0
+                    while next_job < len(jobs) or pending:
+                        # a couple of jobs per worker in flight, the rest are submitted as these finish
+                        while next_job < len(jobs) and len(pending) < 2 * workers:
+                            pending[executor.submit(stretch_job, jobs[next_job], profiler.run if profiler.enabled else None)] = next_job
+                            next_job += 1
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            collect(pending.pop(future), future.result)
+        except Exception as e:
+            # a broken pool fails the jobs it did not finish, the report still covers them
+            for i in range(len(jobs)):
+                if i not in collected:
+                    finish(i, "failed", str(e))
+        finally:
+            writes.put(None)
+            writer.join()
+
+        failed = [entry for entry in report if entry["state"] != "done"]
+        print(f"Quantized {len(jobs) - len(failed)} of {len(jobs)} files in {time.perf_counter() - start:.1f}s, {len(failed)} failed")
+        for entry in failed:
+            print(f"- failed: {entry['track']} {entry['part']}: {entry['error']}")
+        os.makedirs(os.path.dirname(report_path), exist_ok=True)
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=1)
+        print("Quantize report written to", report_path)
+
+        # midi of the quantized mix and stems, for tracks whose files were all written
+        if extractMidi:
+            output_dir = os.path.join(os.getcwd(), 'processed')
+            for track in tracks:
+                entries = [entry for entry in report if entry["track"] == track]
+                if all(entry["state"] == "done" for entry in entries):
+                    extractMIDI([entry["output"] for entry in entries], output_dir, transcriber)
+        return report
+
+def quantizeAudio(vid, bpm=120, keepOriginalBpm = False, pitchShiftFirst = False, extractMidi = False, transcriber = None, workers = None):
+    engine = QuantizeEngine(workers)
+    engine.add(vid, bpm=bpm, keepOriginalBpm=keepOriginalBpm, pitchShiftFirst=pitchShiftFirst)
+    return engine.run(extractMidi=extractMidi, transcriber=transcriber)
+
+def get_audio_file(vid):
+    # Is audio file from disk
+    if len(vid.id) > 12: 
+        print('is audio', vid.id, vid.name, vid.url)
+        file = vid.url
+        # if is mp3 file
+        if vid.url[-3:] == "mp3":
+            file = os.path.join(os.getcwd(), 'library', vid.id + '.wav')
+    # Is audio file extracted from downloaded video
+    else:
+        file = os.path.join(os.getcwd(), 'library', vid.id + '.wav')
+    return file
+
+### Stage Cache
+
+# bump a version when a stage's code changes, its cached results (and everything downstream) are recomputed
+STAGE_VERSIONS = {"segments": 1, "pitch": 1, "beats": 1, "features": 1, "volume": 1, "stems": 1, "midi": 1}
+STAGE_DEPENDENCIES = {"features": ("beats",), "midi": ("stems",)}
+STAGE_CACHE_DIRECTORY = "library/cache"
+CREPE_CAPACITY = "tiny" # tiny|small|medium|large|full
+DEMUCS_MODEL = "htdemucs_6s"
+STEMS = ['bass', 'drums', 'guitar', 'other', 'piano', 'vocals']
+
+class StageCache:
+    """Results of one track's analysis stages, keyed by input content, stage version and parameters"""
+    def __init__(self, file, file_id, directory=STAGE_CACHE_DIRECTORY):
+        self.file = str(file)
+        self.directory = os.path.join(directory, file_id)
+        self.keys = {}
+        self._input_hash = None
+
+    def input_hash(self):
+        # content hash of the audio file, rehashed only when its size or mtime change
+        if self._input_hash is None:
+            stat = os.stat(self.file)
+            manifest_path = os.path.join(self.directory, "input.p")
+            manifest = {}
+            if os.path.isfile(manifest_path):
+                with open(manifest_path, "rb") as f:
+                    manifest = pickle.load(f)
+            if manifest.get("size") == stat.st_size and manifest.get("mtime") == stat.st_mtime:
+                self._input_hash = manifest["hash"]
+            else:
+                self._input_hash = content_hash(self.file)
+                self.write("input.p", {"size": stat.st_size, "mtime": stat.st_mtime, "hash": self._input_hash})
+        return self._input_hash
+
+    def key(self, stage, params):
+        upstream = [self.keys[dependency] for dependency in STAGE_DEPENDENCIES.get(stage, ())]
+        text = repr((stage, STAGE_VERSIONS[stage], self.input_hash(), sorted(params.items()), upstream))
+        self.keys[stage] = hashlib.sha256(text.encode()).hexdigest()
+        return self.keys[stage]
+
+    def load(self, stage, key):
+        path = os.path.join(self.directory, stage + ".p")
+        if not os.path.isfile(path):
+            return None
+        with open(path, "rb") as f:
+            stored_key, value = pickle.load(f)
+        return value if stored_key == key else None
+
+    def save(self, stage, key, value):
+        self.write(stage + ".p", (key, value))
+
+    def write(self, name, value):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, name)
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(value, f)
+        os.replace(path + ".tmp", path)
+
+    def run(self, stage, params, compute, valid=None, adopt=False):
+        # cached result if the key matches (and its outputs still exist), else compute and store it
+        key = self.key(stage, params)
+        value = self.load(stage, key)
+        if value is not None and (valid is None or valid()):
+            print(f'- {stage}: cached')
+            return value
+        # outputs written before the stage cache existed are taken over instead of recomputed
+        if adopt and not os.path.isfile(os.path.join(self.directory, stage + ".p")) and valid():
+            print(f'- {stage}: using existing outputs')
+            self.save(stage, key, True)
+            return True
+        value = compute()
+        self.save(stage, key, value)
+        return value
+
+def stem_directory(file_id, demucs_model=DEMUCS_MODEL):
+    return os.path.join(os.getcwd(), 'separated', demucs_model, file_id)
+
+def stem_paths(file_id, demucs_model=DEMUCS_MODEL):
+    return [os.path.join(stem_directory(file_id, demucs_model), stem +'.wav') for stem in STEMS]
+
+SEPARATION_DEFAULTS = {"segment": None, "overlap": 0.25, "shifts": 1}
+
+def separation_params(demucs_model, separation=None):
+    # options that change the separated audio, left out at their defaults so older caches stay valid
+    params = {"model": demucs_model}
+    for name, default in SEPARATION_DEFAULTS.items():
+        value = (separation or {}).get(name, default)
+        if value != default:
+            params[name] = value
+    return params
+
+def stems_valid(file_id, demucs_model=DEMUCS_MODEL):
+    return all(os.path.isfile(path) for path in stem_paths(file_id, demucs_model))
+
+def midi_valid(file_id, demucs_model=DEMUCS_MODEL):
+    output_dir = stem_directory(file_id, demucs_model)
+    return all(os.path.isfile(midi_path(path, output_dir)) for path in stem_paths(file_id, demucs_model))
+
+def split_stems(file, file_id, cache, demucs_model=DEMUCS_MODEL, separation=None):
+    def split():
+        stemsplit(file, demucs_model, file_id=file_id, separation=separation)
+        return True
+    with profiler.stage("stems", file_id):
+        cache.run("stems", separation_params(demucs_model, separation), split, valid=lambda: stems_valid(file_id, demucs_model), adopt=True)
+
+def transcribe_stems(file_id, cache, demucs_model=DEMUCS_MODEL):
+    def transcribe():
+        extractMIDI(stem_paths(file_id, demucs_model), stem_directory(file_id, demucs_model))
+        return True
+    with profiler.stage("midi", file_id):
+        cache.run("midi", {}, transcribe, valid=lambda: midi_valid(file_id, demucs_model), adopt=True)
+
+def get_stems(file, file_id, cache, extractMidi=False, demucs_model=DEMUCS_MODEL, separation=None):
+    split_stems(file, file_id, cache, demucs_model=demucs_model, separation=separation)
     if extractMidi:
-        output_dir = os.path.join(os.getcwd(), 'processed')
-        extractMIDI(audiofilepaths, output_dir)
-
+        transcribe_stems(file_id, cache, demucs_model=demucs_model)
+
+### Streaming Analysis
+
+# long recordings are analysed in blocks of frames, each read with context frames on both sides so the
+# STFT, the HPSS median filters, the CQT filters and the MFCC deltas at its edges see the audio around it
+STREAM_BLOCK_FRAMES = 2048 # about 24s at 44.1kHz
+STREAM_CONTEXT_FRAMES = 64
+STREAM_VOLUME_SR = 22050
+STREAM_MEMORY = 512 * 1024 * 1024 # rough working memory of a streamed stage, whatever the length of the track
+STREAM_STAGES = ("pitch", "beats", "features", "volume")
+TOP_DB = 80.0 # librosa.power_to_db's default clipping below the loudest value
+
+def stream_blocks(audio, sr, hop_length, context=STREAM_CONTEXT_FRAMES, block=STREAM_BLOCK_FRAMES):
+    # (f0, f1, segment, offset): frames f0..f1 of the track are frames offset..offset + f1 - f0 of
+    # a centered transform of segment, which starts on a frame boundary
+    length = len(audio.resampled(sr))
+    n_frames = frame_count(length, hop_length)
+    for f0 in range(0, n_frames, block):
+        f1 = min(f0 + block, n_frames)
+        g0, g1 = max(f0 - context, 0), min(f1 + context, n_frames)
+        stop = g1 * hop_length if g1 < n_frames else length
+        yield f0, f1, np.asarray(audio.read(sr, g0 * hop_length, stop), dtype=np.float32), f0 - g0
+
+def frame_count(length, hop_length):
+    # frames of a centered librosa transform of length samples
+    return 1 + length // hop_length
+
+class BeatSync:
+    """librosa.util.sync for frames arriving block by block, only the frames of the current beat are kept"""
+    def __init__(self, beats, n_frames, aggregate=np.mean):
+        import librosa
+        self.bounds = librosa.util.fix_frames(beats, x_min=0, x_max=n_frames)
+        self.aggregate = aggregate
+        self.pending = None
+        self.start = 0 # frame the pending frames start at
+        self.segment = 0
+        self.values = []
+
+    def add(self, frames):
+        # the next frames of the track, features x time
+        self.pending = frames if self.pending is None else np.concatenate([self.pending, frames], axis=1)
+        end = self.start + self.pending.shape[1]
+        while self.segment + 1 < len(self.bounds) and self.bounds[self.segment + 1] <= end:
+            lo, hi = self.bounds[self.segment] - self.start, self.bounds[self.segment + 1] - self.start
+            self.values.append(self.aggregate(self.pending[:, lo:hi], axis=1))
+            self.segment += 1
+        cut = self.bounds[self.segment] - self.start
+        self.pending = self.pending[:, cut:]
+        self.start += cut
+
+    def result(self):
+        return np.stack(self.values, axis=-1)
+
+def middle_pair(data, axis=1):
+    # the two middle values of each row, the median is their mean
+    k = data.shape[axis]
+    part = np.partition(data, ((k - 1) // 2, k // 2), axis=axis)
+    return np.stack([part[:, (k - 1) // 2], part[:, k // 2]])
+
+def stream_beats(audio, hop_length=BEAT_HOP_LENGTH):
+    # same as the beats stage: beats tracked on the onset envelope of the percussive part, built block by block
+    import librosa
+    sr, length = audio.sr, len(audio.y)
+    onset = np.zeros(frame_count(length, hop_length), dtype=np.float32)
+    for f0, f1, segment, offset in stream_blocks(audio, sr, hop_length):
+        # top_db clipping is relative to the loudest frame of the block instead of the track
+        frontend = SpectralFrontEnd(segment, sr, hop_length=hop_length)
+        onset[f0:f1] = frontend.onset_envelope()[offset:offset + f1 - f0]
+    tempo, beats = librosa.beat.beat_track(sr=sr, onset_envelope=onset, hop_length=hop_length, trim=False, bpm=stream_tempo(onset, sr, hop_length))
+    return tempo, beats, sr, length / sr
+
+def stream_tempo(onset, sr, hop_length, ac_size=8.0, start_bpm=120, std_bpm=1.0, max_tempo=320.0):
+    # librosa's tempo estimate from the mean tempogram, summed block by block instead of holding
+    # the whole tempogram, its autocorrelation windows reach ac_size seconds around each frame
+    import librosa
+    win_length = librosa.time_to_frames(ac_size, sr=sr, hop_length=hop_length).item()
+    total = np.zeros(win_length)
+    for f0 in range(0, len(onset), STREAM_BLOCK_FRAMES):
+        f1 = min(f0 + STREAM_BLOCK_FRAMES, len(onset))
+        g0, g1 = max(f0 - win_length, 0), min(f1 + win_length, len(onset))
+        tg = librosa.feature.tempogram(onset_envelope=onset[g0:g1], sr=sr, hop_length=hop_length, win_length=win_length)
+        total += tg[:, f0 - g0:f1 - g0].sum(axis=1)
+    # the prior and argmax of librosa.beat.tempo, which only takes a tempogram from librosa 0.10 on
+    tg = total / max(len(onset), 1)
+    bpms = librosa.tempo_frequencies(win_length, hop_length=hop_length, sr=sr)
+    with np.errstate(divide="ignore"):
+        logprior = -0.5 * ((np.log2(bpms) - np.log2(start_bpm)) / std_bpm) ** 2
+    logprior[:int(np.argmax(bpms < max_tempo))] = -np.inf
+    return np.atleast_1d(bpms[np.argmax(np.log1p(1e6 * tg) + logprior)])
+
+def stream_features(audio, beats, hop_length=BEAT_HOP_LENGTH):
+    # same as get_intensity, get_pitch and get_timbre, aggregated per beat as the blocks go by
+    import librosa
+    sr = audio.sr
+    n_frames = frame_count(len(audio.y), hop_length)
+    # power_to_db(ref=np.max) needs the loudest mel frame of the whole track up front
+    mel_max = 0.0
+    for f0, f1, segment, offset in stream_blocks(audio, sr, hop_length, context=4):
+        mel_max = max(mel_max, float(np.max(SpectralFrontEnd(segment, sr, hop_length=hop_length).mel()[:, offset:offset + f1 - f0], initial=0.0)))
+    amin = 1e-10
+    intensity = BeatSync(beats, n_frames, aggregate=middle_pair)
+    pitch = BeatSync(beats, n_frames, aggregate=np.median)
+    timbre = BeatSync(beats, n_frames)
+    cqt_max = 0.0
+    for f0, f1, segment, offset in stream_blocks(audio, sr, hop_length):
+        frontend = SpectralFrontEnd(segment, sr, hop_length=hop_length)
+        keep = slice(offset, offset + f1 - f0)
+        # intensity: the median of each beat is clipped relative to the loudest CQT bin of the track at the end
+        power = np.abs(frontend.cqt()[:, keep])**2
+        cqt_max = max(cqt_max, float(np.max(power, initial=0.0)))
+        intensity.add(10.0 * np.log10(np.maximum(amin, power)))
+        pitch.add(librosa.feature.chroma_cqt(y=frontend.harmonic(), sr=sr, hop_length=hop_length)[:, keep])
+        log_S = np.maximum(librosa.power_to_db(frontend.mel(), ref=mel_max, top_db=None), -TOP_DB)
+        mfcc = librosa.feature.mfcc(S=log_S, n_mfcc=13)
+        M = np.vstack([mfcc, librosa.feature.delta(mfcc), librosa.feature.delta(mfcc, order=2)])
+        timbre.add(M[:, keep])
+    freqs = librosa.cqt_frequencies(84, fmin=librosa.note_to_hz('A1'))
+    middle = np.maximum(intensity.result() - 10.0 * np.log10(max(amin, cqt_max)), -TOP_DB)
+    CQT_sync = librosa.A_weighting(freqs)[:, None] + np.mean(middle, axis=0)
+    return CQT_sync, pitch.result(), timbre.result()
+
+def stream_volume(audio, sr=STREAM_VOLUME_SR, frame_length=2048, hop_length=512):
+    # same as get_volume: rms frames of the peak normalized signal, trim_data leaves it as is
+    # since its threshold is above full scale
+    import librosa
+    length = len(audio.resampled(sr))
+    peak, square_sum = 0.0, 0.0
+    for start in range(0, length, STREAM_READ_SAMPLES):
+        block = np.asarray(audio.read(sr, start, start + STREAM_READ_SAMPLES), dtype=np.float64)
+        peak = max(peak, float(np.max(np.abs(block))))
+        square_sum += float(np.sum(block * block))
+    n_frames = frame_count(length, hop_length)
+    volume = np.zeros(n_frames, dtype=np.float32)
+    pad = frame_length // 2
+    for f0 in range(0, n_frames, STREAM_BLOCK_FRAMES):
+        f1 = min(f0 + STREAM_BLOCK_FRAMES, n_frames)
+        # samples of frames f0..f1, zeros outside the track like the centered rms
+        first, last = f0 * hop_length - pad, (f1 - 1) * hop_length + frame_length - pad
+        block = np.zeros(last - first, dtype=np.float32)
+        lo, hi = max(first, 0), min(last, length)
+        block[lo - first:hi - first] = audio.read(sr, lo, hi)
+        volume[f0:f1] = librosa.feature.rms(y=block, frame_length=frame_length, hop_length=hop_length, center=False)[0] / peak
+    loudness = float(np.sqrt(square_sum / length) / peak)
+    return volume, np.mean(volume), loudness
+
+### Stage Scheduler
+
+# stages run in threads as soon as their inputs are ready, at most this many per library at a time:
+# one tensorflow model (crepe, basic pitch), two numpy/librosa stages and one demucs separation.
+# stream=1 analyses every track in blocks, stream=0 none, by default the ones too long for the memory budget
+STAGE_BUDGETS = {"tf": 1, "blas": 2, "demucs": 1, "stages": None, "memory": None, "stream": None}
+# rough working memory of each stage, in multiples of the decoded mono track
+STAGE_MEMORY = {"segments": 3, "pitch": 4, "beats": 5, "features": 12, "volume": 2, "stems": 16, "midi": 4}
+STAGE_RESOURCES = {"segments": "blas", "pitch": "tf", "beats": "blas", "features": "blas", "volume": "blas", "stems": "demucs", "midi": "tf"}
+# a "gpu" stage resets the device: it waits for every stage of these resources in flight, and none of them
+# start while it is ready or running
+GPU_RESOURCES = ("tf", "demucs")
+
+def parse_stage_budgets(text):
+    # "tf=1,blas=2,demucs=1,stages=4,memory=8192", memory in MB
+    budgets = {}
+    for item in text.split(","):
+        name, _, value = item.partition("=")
+        name = name.strip()
+        if name not in STAGE_BUDGETS:
+            raise ValueError(f"unknown stage budget {name}, use {', '.join(STAGE_BUDGETS)}")
+        budgets[name] = int(value) * 1024 * 1024 if name == "memory" else int(value)
+    return budgets
+
+def available_memory():
+    # MemAvailable in bytes, None where /proc/meminfo does not exist
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def decoded_size(file, audio=None):
+    # bytes of the track decoded to mono float32, from the header so nothing is decoded yet
+    if audio is not None:
+        return audio.y.nbytes
+    try:
+        return sf.info(file).frames * 4
+    except Exception:
+        return 0
 
-def get_audio_features(file,file_id,extractMidi = False):
+class Stage:
+    """One scheduled stage, result() waits for it and raises its error"""
+    def __init__(self, name, compute, deps, resource, memory):
+        self.name = name
+        self.compute = compute
+        self.deps = deps
+        self.resource = resource
+        self.memory = memory
+        self.value = None
+        self.error = None
+        self.done = threading.Event()
+
+    def result(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class StageScheduler:
+    """Runs stages in threads once their dependencies are done, within per-resource and memory budgets"""
+    def __init__(self, budgets=None):
+        self.budgets = dict(STAGE_BUDGETS, **(budgets or {}))
+        if self.budgets["memory"] is None:
+            available = available_memory()
+            self.budgets["memory"] = int(available * 0.75) if available is not None else None
+        self.lock = threading.Lock()
+        self.waiting = []
+        self.busy = {}
+        self.running = 0
+        self.memory = 0
+
+    def streams(self, size):
+        # whether a track of this decoded size is analysed in blocks
+        if self.budgets["stream"] is not None:
+            return bool(self.budgets["stream"])
+        return self.budgets["memory"] is not None and STAGE_MEMORY["features"] * size > self.budgets["memory"]
+
+    def submit(self, name, compute, deps=(), resource=None, memory=0):
+        # the stage prints to the server job that submitted it, whichever thread runs it
+        stage = Stage(name, carry_job(compute), deps, resource, memory)
+        with self.lock:
+            self.waiting.append(stage)
+            self.dispatch()
+        return stage
+
+    def fits(self, stage, gpu_ready=False):
+        if stage.resource == "gpu":
+            return not any(self.busy.get(resource, 0) for resource in GPU_RESOURCES)
+        if stage.resource in GPU_RESOURCES and (gpu_ready or self.busy.get("gpu", 0)):
+            return False
+        if self.running == 0:
+            # a stage over the memory budget still runs, alone
+            return True
+        if self.budgets["stages"] is not None and self.running >= self.budgets["stages"]:
+            return False
+        if stage.resource is not None and self.busy.get(stage.resource, 0) >= self.budgets.get(stage.resource, 1):
+            return False
+        return self.budgets["memory"] is None or self.memory + stage.memory <= self.budgets["memory"]
+
+    def dispatch(self):
+        # called with the lock held, starts waiting stages in submission order
+        changed = True
+        while changed:
+            changed = False
+            gpu_ready = any(stage.resource == "gpu" and all(dep.done.is_set() for dep in stage.deps) for stage in self.waiting)
+            for stage in list(self.waiting):
+                if not all(dep.done.is_set() for dep in stage.deps):
+                    continue
+                failed = [dep for dep in stage.deps if dep.error is not None]
+                if failed:
+                    # skipped with the error of its input, which may settle stages after it
+                    self.waiting.remove(stage)
+                    stage.error = failed[0].error
+                    stage.done.set()
+                    changed = True
+                    continue
+                if not self.fits(stage, gpu_ready):
+                    continue
+                self.waiting.remove(stage)
+                self.running += 1
+                self.busy[stage.resource] = self.busy.get(stage.resource, 0) + 1
+                self.memory += stage.memory
+                threading.Thread(target=self.run, args=(stage,), daemon=True).start()
+
+    def run(self, stage):
+        try:
+            stage.value = stage.compute()
+        except BaseException as e:
+            stage.error = e
+        with self.lock:
+            self.running -= 1
+            self.busy[stage.resource] -= 1
+            self.memory -= stage.memory
+            stage.done.set()
+            self.dispatch()
+
+def submit_audio_features(scheduler, file, file_id, extractMidi = False, audio = None, crepe_capacity = CREPE_CAPACITY, demucs_model = DEMUCS_MODEL, separation = None):
+    # queues the stages of one track, the returned stage's result() is its audio features
+    import librosa
+    from numba import cuda
     print("------------------------------ get_audio_features:",file_id,"------------------------------")
-    print('1/8 segementation')
-    segments_boundaries,segments_labels = get_segments(file)
-   
-    print('2/8 pitch tracking')
-    frequency_frames = get_pitch_dnn(file)
-    average_frequency,average_key = get_average_pitch(frequency_frames)
-    
-    print('3/8 load sample')
-    y, sr = librosa.load(file, sr=None)
-    song_duration = librosa.get_duration(y=y, sr=sr)
-    
-    print('4/8 sample separation')
-    y_harmonic, y_percussive = librosa.effects.hpss(y)
-    
-    print('5/8 beat tracking')
-    tempo, beats = librosa.beat.beat_track(sr=sr, onset_envelope=librosa.onset.onset_strength(y=y_percussive, sr=sr), trim=False)
-
-    print('6/8 feature extraction')
-    CQT_sync = get_intensity(y, sr, beats)
-    C_sync = get_pitch(y_harmonic, sr, beats)
-    M_sync = get_timbre(y, sr, beats)
-    volume, avg_volume, loudness = get_volume(file)
-   
-    print('7/8 feature aggregation')
-    intensity_frames = np.matrix(CQT_sync).getT()
-    pitch_frames = np.matrix(C_sync).getT()
-    timbre_frames = np.matrix(M_sync).getT()
-
-    if cuda.is_available():
-        print('Cleaning up GPU memory')
-        device = cuda.get_current_device()
-        device.reset()
-
-    print('8/8 split stems')
-    stemsplit(file, 'htdemucs_6s')
-
+    cache = StageCache(file, file_id)
+    # every stage key includes the input hash, computed once before they run side by side
+    cache.input_hash()
+    # decoded once, and only if a stage is not cached
+    decoded = []
+    decode_lock = threading.Lock()
+    def load():
+        with decode_lock:
+            if not decoded:
+                print('- load sample')
+                with profiler.stage("decode", file_id):
+                    # streamed tracks are decoded to disk and read back as memmaps
+                    decoded.append(StreamedAudio(file) if stream and audio is None else decode_audio(file if audio is None else audio))
+        return decoded[0]
+    size = decoded_size(file, audio)
+    stream = scheduler.streams(size)
+    if stream:
+        print('- streaming analysis in blocks of', STREAM_BLOCK_FRAMES, 'frames')
+    # streamed stages are cached apart from the ones computed on the whole track
+    stream_params = {"block": STREAM_BLOCK_FRAMES, "context": STREAM_CONTEXT_FRAMES} if stream else {}
+    def submit(stage, compute, deps=()):
+        memory = STREAM_MEMORY if stream and stage in STREAM_STAGES else STAGE_MEMORY[stage] * size
+        return scheduler.submit(stage, compute, deps, resource=STAGE_RESOURCES[stage], memory=memory)
+
+    def segments():
+        print('1/8 segementation')
+        with profiler.stage("segments", file_id):
+            return cache.run("segments", {"sr": 22050}, lambda: get_segments(load()))
+    segments_stage = submit("segments", segments)
+
+    def pitch():
+        print('2/8 pitch tracking')
+        with profiler.stage("pitch", file_id):
+            return cache.run("pitch", {"capacity": crepe_capacity, "viterbi": True, "step_size": 10}, lambda: get_pitch_dnn(load(), PitchTracker(model_capacity=crepe_capacity)))
+    pitch_stage = submit("pitch", pitch)
+
+    def track_beats():
+        y, sr = load().y, load().sr
+        frontend = SpectralFrontEnd(y, sr, hop_length=BEAT_HOP_LENGTH)
+        tempo, beats = librosa.beat.beat_track(sr=sr, onset_envelope=frontend.onset_envelope(), hop_length=BEAT_HOP_LENGTH, trim=False)
+        return tempo, beats, sr, librosa.get_duration(y=y, sr=sr)
+    def beats():
+        print('3/8 beat tracking')
+        with profiler.stage("beats", file_id):
+            return cache.run("beats", dict({"hop_length": BEAT_HOP_LENGTH}, **stream_params), (lambda: stream_beats(load())) if stream else track_beats)
+    beats_stage = submit("beats", beats)
+
+    def extract_features():
+        _, beats, _, _ = beats_stage.result()
+        y, sr = load().y, load().sr
+        frontend = SpectralFrontEnd(y, sr, hop_length=BEAT_HOP_LENGTH)
+        with profiler.stage("cqt", file_id):
+            CQT_sync = get_intensity(y, sr, beats, CQT=frontend.cqt())
+        with profiler.stage("hpss", file_id):
+            C_sync = get_pitch(frontend.harmonic(), sr, beats)
+        with profiler.stage("mel", file_id):
+            M_sync = get_timbre(y, sr, beats, S=frontend.mel())
+        return CQT_sync, C_sync, M_sync
+    def features():
+        print('4/8 feature extraction')
+        with profiler.stage("features", file_id):
+            return cache.run("features", dict({"hop_length": BEAT_HOP_LENGTH}, **stream_params), (lambda: stream_features(load(), beats_stage.result()[1])) if stream else extract_features)
+    features_stage = submit("features", features, (beats_stage,))
+
+    def volume():
+        print('5/8 volume')
+        with profiler.stage("volume", file_id):
+            return cache.run("volume", dict({"sr": 22050}, **stream_params), lambda: stream_volume(load()) if stream else get_volume(load()))
+    volume_stage = submit("volume", volume)
+
+    analysis = (segments_stage, pitch_stage, beats_stage, features_stage, volume_stage)
+    gpu = cuda.is_available()
+    def cleanup():
+        del decoded[:]
+        if gpu and not gpu_models_resident():
+            print('Cleaning up GPU memory')
+            device = cuda.get_current_device()
+            device.reset()
+    # the reset waits for the tensorflow and demucs stages of every track in the scheduler
+    cleanup_stage = scheduler.submit("cleanup", cleanup, analysis, resource="gpu" if gpu else None)
+
+    # on the cpu demucs separates while the track is analysed, on the gpu after its memory is cleaned up
+    def stems():
+        print('7/8 split stems')
+        split_stems(file, file_id, cache, demucs_model=demucs_model, separation=separation)
+    stems_stage = submit("stems", stems, (cleanup_stage,) if gpu else ())
+    outputs = [stems_stage]
     if extractMidi:
-        audiofilepaths = []
-        stems = ['bass', 'drums', 'guitar', 'other', 'piano', 'vocals']
-        for stem in stems:
-            path = os.path.join(os.getcwd(), 'separated', 'htdemucs_6s', file_id, stem +'.wav')
-            audiofilepaths.append(path)
-        output_dir = os.path.join(os.getcwd(), 'separated', 'htdemucs_6s', file_id)
-        extractMIDI(audiofilepaths, output_dir)
-
-    audio_features = {
-        "id":file_id,
-        "tempo":tempo,
-        "duration":song_duration,
-        "timbre":np.mean(timbre_frames),
-        "timbre_frames":timbre_frames,
-        "pitch":np.mean(pitch_frames),
-        "pitch_frames":pitch_frames,
-        "intensity":np.mean(intensity_frames),
-        "intensity_frames":intensity_frames,
-        "volume": volume,
-        "avg_volume": avg_volume,
-        "loudness": loudness,
-        "beats":librosa.frames_to_time(beats, sr=sr),
-        "segments_boundaries":segments_boundaries,
-        "segments_labels":segments_labels,
-        "frequency_frames":frequency_frames,
-        "frequency":average_frequency,
-        "key":average_key
-    }
-    return audio_features
+        def midi():
+            print('8/8 extract midi')
+            transcribe_stems(file_id, cache, demucs_model=demucs_model)
+        outputs.append(submit("midi", midi, (stems_stage,)))
+
+    def aggregate():
+        print('6/8 feature aggregation')
+        segments_boundaries, segments_labels = segments_stage.result()
+        frequency_frames = pitch_stage.result()
+        average_frequency,average_key = get_average_pitch(frequency_frames)
+        tempo, beats, sr, song_duration = beats_stage.result()
+        CQT_sync, C_sync, M_sync = features_stage.result()
+        volume, avg_volume, loudness = volume_stage.result()
+        intensity_frames = np.matrix(CQT_sync).getT()
+        pitch_frames = np.matrix(C_sync).getT()
+        timbre_frames = np.matrix(M_sync).getT()
+        for stage in outputs:
+            stage.result()
+
+        audio_features = {
+            "id":file_id,
+            "tempo":tempo,
+            "duration":song_duration,
+            "timbre":np.mean(timbre_frames),
+            "timbre_frames":timbre_frames,
+            "pitch":np.mean(pitch_frames),
+            "pitch_frames":pitch_frames,
+            "intensity":np.mean(intensity_frames),
+            "intensity_frames":intensity_frames,
+            "volume": volume,
+            "avg_volume": avg_volume,
+            "loudness": loudness,
+            "beats":librosa.frames_to_time(beats, sr=sr, hop_length=BEAT_HOP_LENGTH),
+            "beats_sr":sr,
+            "beats_hop_length":BEAT_HOP_LENGTH,
+            "segments_boundaries":segments_boundaries,
+            "segments_labels":segments_labels,
+            "frequency_frames":frequency_frames,
+            "frequency":average_frequency,
+            "key":average_key
+        }
+        return audio_features
+    return scheduler.submit("aggregate", aggregate, analysis + (cleanup_stage,) + tuple(outputs))
+
+def get_audio_features(file,file_id,extractMidi = False, audio = None, crepe_capacity = CREPE_CAPACITY, demucs_model = DEMUCS_MODEL, separation = None, budgets = None):
+    scheduler = StageScheduler(budgets)
+    return submit_audio_features(scheduler, file, file_id, extractMidi=extractMidi, audio=audio, crepe_capacity=crepe_capacity, demucs_model=demucs_model, separation=separation).result()
+
+################## PARALLEL ANALYSIS ##################
+
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMEXPR_NUM_THREADS", "NUMBA_NUM_THREADS", "TF_NUM_INTRAOP_THREADS", "TF_NUM_INTEROP_THREADS")
+
+@contextmanager
+def thread_limits(threads):
+    # worker processes are spawned fresh, so BLAS/TF/numba pick up these limits on import
+    saved_env = {name: os.environ.get(name) for name in THREAD_ENV_VARS}
+    os.environ.update({name: str(threads) for name in THREAD_ENV_VARS})
+    try:
+        yield
+    finally:
+        for name, value in saved_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+def analyse_track(file, file_id, extractMidi=False, crepe_capacity=CREPE_CAPACITY, separation=None, profile_run=None, budgets=None):
+    # runs in a worker process: frames go straight to the feature store, scalars and stage metrics back to the parent
+    if profile_run is not None and not profiler.enabled:
+        profiler.start(run=profile_run)
+    profiler.rows = []
+    audio_features = get_audio_features(file=file, file_id=file_id, extractMidi=extractMidi, crepe_capacity=crepe_capacity, separation=separation, budgets=budgets)
+    store = FeatureStore()
+    store.put_frames(file_id, audio_features)
+    scalars = {name: audio_features[name] for name in SCALAR_FEATURES + ("key",)}
+    scalars["segments_boundaries"] = audio_features["segments_boundaries"]
+    return scalars, profiler.rows
+
+ANALYSE_POOL_RETRIES = 2 # fresh pools for the tracks left when a worker dies
+
+def analyse_library(videos, store, jobs, extractMidi=False, crepe_capacity=CREPE_CAPACITY, separation=None, budgets=None):
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from concurrent.futures.process import BrokenProcessPool
+    threads = max(1, (os.cpu_count() or 1) // jobs)
+    # every worker schedules its stages within its share of the memory budget
+    budgets = dict(budgets or {})
+    if budgets.get("memory") is None:
+        available = available_memory()
+        budgets["memory"] = int(available * 0.75) if available is not None else None
+    if budgets["memory"] is not None:
+        budgets["memory"] //= jobs
+    print(f"Analysing {len(videos)} files with {jobs} workers, {threads} threads each")
+    failed = []
+    pending = list(videos)
+    for attempt in range(ANALYSE_POOL_RETRIES + 1):
+        broken = []
+        with thread_limits(threads):
+            with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("spawn")) as executor:
+                futures = {executor.submit(analyse_track, get_audio_file(vid), vid.id, extractMidi, crepe_capacity, separation, profiler.run if profiler.enabled else None, budgets): vid for vid in pending}
+                for future in as_completed(futures):
+                    vid = futures[future]
+                    try:
+                        scalars, rows = future.result()
+                    except BrokenProcessPool:
+                        # a worker died (out of memory, crash), its track and the ones not yet run are retried
+                        broken.append(vid)
+                        continue
+                    except Exception as e:
+                        sys.stderr.write(f"Failed to analyse {vid.id}: {e}\n")
+                        failed.append(vid.id)
+                        continue
+                    profiler.rows += rows
+                    # save after every track, so a crash keeps everything finished so far
+                    store.put_scalars(vid.id, scalars)
+                    store.save()
+                    print(f"Analysed {vid.id} ({len(store)} in store, {len(failed)} failed)")
+        if len(broken) == 0:
+            break
+        broken_ids = {vid.id for vid in broken}
+        pending = [vid for vid in pending if vid.id in broken_ids]
+        if attempt < ANALYSE_POOL_RETRIES:
+            print(f"A worker process died, retrying {len(pending)} files on a fresh pool")
+    else:
+        for vid in pending:
+            sys.stderr.write(f"Failed to analyse {vid.id}: worker process died\n")
+            failed.append(vid.id)
+    return failed
+
+STAGE_TRACKS_AHEAD = 1
+
+def pipeline_tracks(tracks, submit, ahead=STAGE_TRACKS_AHEAD):
+    # yields (track, stage) in order with the stages of the next tracks already queued,
+    # so demucs separates one track while the next one is analysed
+    pending = []
+    for track in tracks:
+        pending.append((track, submit(track)))
+        if len(pending) > ahead:
+            yield pending.pop(0)
+    while pending:
+        yield pending.pop(0)
+
+PITCH_BATCH_TRACKS = 4
+
+def analyse_batch(videos, store, extractMidi=False, crepe_capacity=CREPE_CAPACITY, batch_tracks=PITCH_BATCH_TRACKS, separation=None, budgets=None):
+    # decode a few tracks at a time and let the ones without cached pitch share crepe batches,
+    # the ones without cached stems go through the resident demucs model together
+    tracker = PitchTracker(model_capacity=crepe_capacity)
+    scheduler = StageScheduler(budgets)
+    pitch_params = {"capacity": crepe_capacity, "viterbi": True, "step_size": 10}
+    for start in range(0, len(videos), batch_tracks):
+        group = videos[start:start + batch_tracks]
+        files = [get_audio_file(vid) for vid in group]
+        caches = [StageCache(file, vid.id) for file, vid in zip(files, group)]
+        keys = [cache.key("pitch", pitch_params) for cache in caches]
+        audios = [None] * len(group)
+        missing = [i for i in range(len(group)) if caches[i].load("pitch", keys[i]) is None]
+        if len(missing) > 0:
+            print(f"pitch tracking {len(missing)} files in shared batches")
+            for i in missing:
+                # long tracks are decoded to disk, crepe reads them chunk by chunk
+                audios[i] = StreamedAudio(files[i]) if scheduler.streams(decoded_size(files[i])) else decode_audio(files[i])
+            pitches = tracker.track_many([audios[i].resampled(CREPE_SR) for i in missing])
+            for i, pitch in zip(missing, pitches):
+                caches[i].save("pitch", keys[i], pitch)
+        if extractMidi:
+            separate_group(group, files, caches, separation)
+            transcribe_group(group, caches)
+        def submit(i):
+            stage = submit_audio_features(scheduler, files[i], group[i].id, extractMidi=extractMidi, audio=audios[i], crepe_capacity=crepe_capacity, separation=separation)
+            audios[i] = None
+            return stage
+        for i, stage in pipeline_tracks(range(len(group)), submit):
+            store.put(group[i].id, stage.result())
+            store.save()
+
+def separate_group(videos, files, caches, separation=None, demucs_model=DEMUCS_MODEL):
+    # stems of tracks whose stems stage is stale, separated in one pass of the engine
+    params = separation_params(demucs_model, separation)
+    keys = [cache.key("stems", params) for cache in caches]
+    missing = [i for i, vid in enumerate(videos) if caches[i].load("stems", keys[i]) is None or not stems_valid(vid.id, demucs_model)]
+    if len(missing) > 0:
+        print(f"separating {len(missing)} files with {demucs_model}")
+        engine = get_separation_engine(demucs_model, **(separation or {}))
+        engine.separate_many([(files[i], videos[i].id) for i in missing])
+        for i in missing:
+            caches[i].save("stems", keys[i], True)
+
+def transcribe_group(videos, caches, demucs_model=DEMUCS_MODEL):
+    # midi of all stems of tracks whose midi stage is stale, in shared basic pitch batches
+    keys = [cache.key("midi", {}) for cache in caches]
+    missing = [i for i, vid in enumerate(videos) if caches[i].load("midi", keys[i]) is None or not midi_valid(vid.id, demucs_model)]
+    if len(missing) > 0:
+        transcriber = get_midi_transcriber()
+        for i in missing:
+            extractMIDI(stem_paths(videos[i].id, demucs_model), stem_directory(videos[i].id, demucs_model), transcriber)
+        transcriber.flush()
+        for i in missing:
+            caches[i].save("midi", keys[i], True)
+
+def refresh_library(videos, store, extractMidi=False, crepe_capacity=CREPE_CAPACITY, separation=None, budgets=None):
+    # runs every track through the stage cache, only stale or missing stages are computed
+    scheduler = StageScheduler(budgets)
+    submit = lambda vid: submit_audio_features(scheduler, get_audio_file(vid), vid.id, extractMidi=extractMidi, crepe_capacity=crepe_capacity, separation=separation)
+    for vid, stage in pipeline_tracks(videos, submit):
+        store.put(vid.id, stage.result())
+        store.save()
+
+def extract_library_midi(videos, extractMidi=True, separation=None, batch_tracks=PITCH_BATCH_TRACKS):
+    # stems and midi for tracks analysed earlier, e.g. without --midi
+    for start in range(0, len(videos), batch_tracks):
+        group = videos[start:start + batch_tracks]
+        files = [get_audio_file(vid) for vid in group]
+        caches = [StageCache(file, vid.id) for file, vid in zip(files, group)]
+        separate_group(group, files, caches, separation)
+        if extractMidi:
+            transcribe_group(group, caches)
+        for file, vid, cache in zip(files, group, caches):
+            get_stems(file, vid.id, cache, extractMidi=extractMidi, separation=separation)
 
 ################## SEARCH NEAREST AUDIO ##################
 
-previous_list = []
-
-def get_nearest(query,videos,querybpm, searchforbpm):
-    global previous_list
-    # print("Search: query:", query.name, '- Incl. BPM in search:', searchforbpm)
-    nearest = {}
-    smallest = 1000000000
-    smallestBPM = 1000000000
-    smallestTimbre = 1000000000
-    smallestIntensity = 1000000000
-    for vid in videos:
-        if vid.id != query.id:
-            comp_bpm = abs(querybpm - vid.audio_features['tempo'])
-            comp_timbre = abs(query.audio_features["timbre"] - vid.audio_features['timbre'])
-            comp_intensity = abs(query.audio_features["intensity"] - vid.audio_features['intensity'])
-            #comp = abs(query.audio_features["pitch"] - vid.audio_features['pitch'])
-            comp = abs(query.audio_features["frequency"] - vid.audio_features['frequency'])
-
-            if searchforbpm:
-                if vid.id not in previous_list and comp < smallest and comp_bpm < smallestBPM:# and comp_timbre < smallestTimbre:
-                    smallest = comp
-                    smallestBPM = comp_bpm
-                    smallestTimbre = comp_timbre
-                    nearest = vid
+INDEX_FEATURES = ("frequency", "tempo", "timbre", "intensity", "pitch", "loudness")
+DEFAULT_SEARCH_WEIGHTS = {"frequency": 1.0, "tempo": 1.0, "timbre": 1.0, "intensity": 1.0}
+
+class FeatureIndex:
+    """Feature matrix over the library's scalar audio features for batched nearest neighbour queries"""
+    def __init__(self, videos):
+        self.videos = list(videos)
+        self.ids = [vid.id for vid in self.videos]
+        self.rows = {file_id: i for i, file_id in enumerate(self.ids)}
+        self.matrix = np.array([[vid.audio_features.get(name, np.nan) for name in INDEX_FEATURES] for vid in self.videos], dtype=np.float64).reshape(len(self.videos), len(INDEX_FEATURES))
+        # column scale for weighted distances, so no feature dominates by its unit
+        scale = np.nanstd(self.matrix, axis=0) if len(self.videos) > 0 else np.ones(len(INDEX_FEATURES))
+        self.scale = np.where((scale > 0) & np.isfinite(scale), scale, 1.0)
+
+    def column(self, name):
+        return self.matrix[:, INDEX_FEATURES.index(name)]
+
+    def candidates(self, query_id, exclude, rows=None):
+        # mask over the given sorted rows (every track if None) without the query and excluded tracks
+        mask = np.ones(len(self.ids) if rows is None else len(rows), dtype=bool)
+        for file_id in list(exclude) + [query_id]:
+            row = self.rows.get(file_id)
+            if row is None:
+                continue
+            if rows is None:
+                mask[row] = False
+                continue
+            pos = np.searchsorted(rows, row)
+            if pos < len(rows) and rows[pos] == row:
+                mask[pos] = False
+        return mask
+
+    def video(self, pos, rows=None):
+        return self.videos[pos if rows is None else rows[pos]]
+
+    def nearest(self, query, querybpm, searchforbpm, exclude=(), rows=None):
+        # same result as scanning the library in order and keeping a track whenever it is strictly
+        # closer in frequency (and in tempo, if searchforbpm) than the current best
+        mask = self.candidates(query.id, exclude, rows)
+        if len(mask) == 0:
+            return None
+        frequency, tempo = self.column("frequency"), self.column("tempo")
+        if rows is not None:
+            frequency, tempo = frequency[rows], tempo[rows]
+        comp = np.abs(query.audio_features["frequency"] - frequency)
+        comp = np.where(mask & np.isfinite(comp), comp, np.inf)
+        if not searchforbpm:
+            best = int(np.argmin(comp))
+            return self.video(best, rows) if comp[best] < 1000000000 else None
+        comp_bpm = np.abs(querybpm - tempo)
+        comp_bpm = np.where(np.isfinite(comp_bpm), comp_bpm, np.inf)
+        best = None
+        smallest = smallestBPM = 1000000000
+        start = 0
+        while True:
+            better = np.flatnonzero((comp[start:] < smallest) & (comp_bpm[start:] < smallestBPM))
+            if len(better) == 0:
+                break
+            best = start + int(better[0])
+            smallest, smallestBPM = comp[best], comp_bpm[best]
+            start = best + 1
+        return self.video(best, rows) if best is not None else None
+
+    def distances(self, query, weights=DEFAULT_SEARCH_WEIGHTS, querybpm=None, exclude=(), rows=None):
+        # weighted euclidean distance over the standardized feature columns, inf for excluded tracks,
+        # for the given rows only if there are any
+        w = np.array([weights.get(name, 0.0) for name in INDEX_FEATURES])
+        used = w > 0
+        q = np.array([query.audio_features.get(name, np.nan) for name in INDEX_FEATURES], dtype=np.float64)
+        if querybpm is not None:
+            q[INDEX_FEATURES.index("tempo")] = querybpm
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        diff = (matrix[:, used] - q[used]) / self.scale[used]
+        dist = np.sqrt(np.sum(w[used] * diff * diff, axis=1))
+        mask = self.candidates(query.id, exclude, rows)
+        return np.where(mask & np.isfinite(dist), dist, np.inf)
+
+    def query(self, query, k=1, weights=DEFAULT_SEARCH_WEIGHTS, querybpm=None, exclude=(), rows=None):
+        dist = self.distances(query, weights, querybpm, exclude, rows)
+        k = min(k, int(np.count_nonzero(np.isfinite(dist))))
+        if k <= 0:
+            return []
+        order = np.argpartition(dist, k - 1)[:k]
+        order = order[np.lexsort((order, dist[order]))]
+        return [self.video(i, rows) for i in order]
+
+class RangeIndex:
+    """Sorted tempo and duration columns and key buckets over a FeatureIndex, to filter candidates before ranking"""
+    def __init__(self, index):
+        self.index = index
+        self.tempo = index.column("tempo")
+        self.tempo_order = np.argsort(self.tempo, kind="stable")
+        self.tempo_sorted = self.tempo[self.tempo_order]
+        self.duration = np.array([vid.audio_features.get("duration", np.nan) for vid in index.videos], dtype=np.float64)
+        self.duration_order = np.argsort(self.duration, kind="stable")
+        self.duration_sorted = self.duration[self.duration_order]
+        self.keys = np.array([key_class(vid.audio_features.get("key", "")) for vid in index.videos], dtype=np.int64)
+        self.key_buckets = {c: np.flatnonzero(self.keys == c) for c in range(12)}
+
+    def between(self, order, values, lo, hi):
+        # rows with lo <= value <= hi, nan sorts last and never matches
+        start, end = np.searchsorted(values, lo, "left"), np.searchsorted(values, hi, "right")
+        return order[start:end]
+
+    def filter(self, tempo=None, duration=None, key=None, key_steps=1):
+        # sorted rows within the tempo range (or its half and double time), the duration range
+        # and the keys compatible with key, None if there are no filters
+        filters = [] # (rows passing one filter, test of the other filters on a row array)
+        if tempo is not None:
+            lo, hi = tempo
+            rows = np.concatenate([self.between(self.tempo_order, self.tempo_sorted, lo * f, hi * f) for f in (0.5, 1.0, 2.0)])
+            def test(rows):
+                t = self.tempo[rows]
+                return ((t >= lo * 0.5) & (t <= hi * 0.5)) | ((t >= lo) & (t <= hi)) | ((t >= lo * 2) & (t <= hi * 2))
+            filters.append((rows, test))
+        if duration is not None:
+            rows = self.between(self.duration_order, self.duration_sorted, *duration)
+            filters.append((rows, lambda rows: (self.duration[rows] >= duration[0]) & (self.duration[rows] <= duration[1])))
+        if key is not None:
+            classes = compatible_keys(key, key_steps)
+            rows = np.concatenate([self.key_buckets[c] for c in classes] + [np.array([], dtype=np.int64)])
+            filters.append((rows, lambda rows: np.isin(self.keys[rows], classes)))
+        if len(filters) == 0:
+            return None
+        # only the most selective filter is read from its index, the others are checked on its rows
+        filters.sort(key=lambda f: len(f[0]))
+        rows = filters[0][0]
+        for _, test in filters[1:]:
+            rows = rows[test(rows)]
+        return np.unique(rows).astype(np.int64)
+
+### Sequence Search
+
+SEQUENCE_FEATURES = ("timbre_frames", "pitch_frames", "intensity_frames")
+SEQUENCE_MODES = ("transition", "track")
+SEQUENCE_STEPS = 32 # steps per compared sequence
+SEQUENCE_BEATS_PER_STEP = 4 # beats averaged into one step in transition mode, about a bar
+SEQUENCE_BAND = 4 # steps a DTW path may drift from the diagonal
+SEQUENCE_CHUNK = 256 # candidates compared per vectorized DTW call
+SEQUENCE_STATS_TRACKS = 64
+# scalar part of the distance, it is also the first lower bound for pruning
+SEQUENCE_SCALAR_WEIGHTS = {"tempo": 1.0, "frequency": 1.0}
+
+def beat_sequence(frames, steps, beats=None, part="track"):
+    # beat-synced frames averaged into a fixed number of steps: the first or last `beats` beats, or the whole track
+    frames = np.asarray(frames, dtype=np.float64)
+    if beats is not None and part == "head":
+        frames = frames[:beats]
+    elif beats is not None and part == "tail":
+        frames = frames[-beats:]
+    if len(frames) == 0:
+        return None
+    edges = np.linspace(0, len(frames), steps + 1)
+    starts = np.minimum(np.floor(edges[:-1]).astype(int), len(frames) - 1)
+    ends = np.maximum(np.ceil(edges[1:]).astype(int), starts + 1)
+    sums = np.concatenate([np.zeros((1, frames.shape[1])), np.cumsum(frames, axis=0)])
+    return (sums[ends] - sums[starts]) / (ends - starts)[:, None]
+
+def pool_octaves(frames):
+    # 84 cqt bins to 7 octave bands, so intensity does not outweigh timbre and chroma by its size
+    frames = np.asarray(frames)
+    if frames.shape[1] % 12 == 0:
+        return frames.reshape(len(frames), -1, 12).mean(axis=2)
+    return frames
+
+def band_mask(steps, band):
+    i, j = np.indices((steps, steps))
+    return np.abs(i - j) <= band
+
+def lb_keogh(q, C, band):
+    # lower bound of dtw_distances: every query step is matched within the band, at least the envelope distance away
+    padded = np.pad(C, ((0, 0), (band, band), (0, 0)), mode="edge")
+    windows = np.lib.stride_tricks.sliding_window_view(padded, 2 * band + 1, axis=1)
+    upper, lower = windows.max(axis=-1), windows.min(axis=-1)
+    outside = np.maximum(q - upper, 0) + np.maximum(lower - q, 0)
+    return np.sqrt(np.sum(outside * outside, axis=2)).sum(axis=1) / len(q)
+
+def dtw_distances(q, C, band):
+    # banded DTW of one query against a batch of equal length sequences, path cost per query step
+    steps = len(q)
+    sq = np.sum(q * q, axis=1)[None, :, None] + np.sum(C * C, axis=2)[:, None, :] - 2 * np.einsum("id,njd->nij", q, C)
+    cost = np.sqrt(np.maximum(sq, 0))
+    cost[:, ~band_mask(steps, band)] = np.inf
+    D = np.full((len(C), steps + 1, steps + 1), np.inf)
+    D[:, 0, 0] = 0
+    for i in range(1, steps + 1):
+        for j in range(max(1, i - band), min(steps, i + band) + 1):
+            D[:, i, j] = cost[:, i - 1, j - 1] + np.minimum(np.minimum(D[:, i - 1, j], D[:, i, j - 1]), D[:, i - 1, j - 1])
+    return D[:, steps, steps] / steps
+
+class SequenceIndex:
+    """DTW search over beat-synced timbre, chroma and intensity sequences, on top of a FeatureIndex.
+    The scalar distance is part of the total and bounds it from below, so frames are only read
+    for tracks that could still beat the current best; LB_Keogh prunes again before the exact DTW."""
+    def __init__(self, videos, mode="transition", scalar_index=None, weights=SEQUENCE_SCALAR_WEIGHTS, steps=SEQUENCE_STEPS, beats_per_step=SEQUENCE_BEATS_PER_STEP, band=SEQUENCE_BAND):
+        if mode not in SEQUENCE_MODES:
+            raise ValueError(f"unknown sequence search mode {mode}, use one of {', '.join(SEQUENCE_MODES)}")
+        self.scalar_index = scalar_index if scalar_index is not None else FeatureIndex(videos)
+        self.videos = self.scalar_index.videos
+        self.mode = mode
+        self.weights = weights
+        self.steps = steps
+        # transition mode compares the end of the query with the beginning of the candidates
+        self.beats = steps * beats_per_step if mode == "transition" else None
+        self.band = band
+        self.sequences = {}
+        self.mean, self.scale = self.feature_stats()
+
+    def frames(self, row):
+        try:
+            parts = [np.asarray(self.videos[row].audio_features[name]) for name in SEQUENCE_FEATURES]
+        except (KeyError, OSError):
+            return None
+        parts[2] = pool_octaves(parts[2])
+        beats = min(len(part) for part in parts)
+        if beats == 0:
+            return None
+        return [part[:beats] for part in parts]
+
+    def raw_sequence(self, row, part):
+        frames = self.frames(row)
+        if frames is None:
+            return None
+        return beat_sequence(np.hstack(frames), self.steps, self.beats, part)
+
+    def feature_stats(self):
+        # standardization from whole-track sequences of a few tracks spread over the library
+        rows = np.unique(np.linspace(0, len(self.videos) - 1, min(SEQUENCE_STATS_TRACKS, len(self.videos))).astype(int))
+        sample = []
+        for row in rows:
+            frames = self.frames(row)
+            if frames is not None:
+                sample.append(beat_sequence(np.hstack(frames), self.steps))
+                dims = [part.shape[1] for part in frames]
+        if len(sample) == 0:
+            return 0.0, 1.0
+        sample = np.concatenate(sample)
+        scale = sample.std(axis=0)
+        scale = np.where(scale > 0, scale, 1.0)
+        # every feature group weighs the same whatever its number of dimensions, and two unrelated
+        # steps are about 1 apart, on the same scale as the scalar distance
+        group_weight = np.concatenate([np.full(n, 1 / np.sqrt(2 * n * len(dims))) for n in dims])
+        return sample.mean(axis=0), scale / group_weight
+
+    def sequence(self, row, part):
+        if self.mode == "track":
+            part = "track"
+        if (row, part) not in self.sequences:
+            sequence = self.raw_sequence(row, part)
+            self.sequences[(row, part)] = None if sequence is None else (sequence - self.mean) / self.scale
+        return self.sequences[(row, part)]
+
+    def query(self, query, k=1, querybpm=None, exclude=(), rows=None):
+        if query.id not in self.scalar_index.rows:
+            return []
+        q = self.sequence(self.scalar_index.rows[query.id], "tail")
+        # positions in rows if the candidates are filtered, library rows otherwise
+        candidates = np.arange(len(self.videos)) if rows is None else np.asarray(rows)
+        scalar = self.scalar_index.distances(query, self.weights, querybpm, exclude, rows)
+        order = np.argsort(scalar, kind="stable")
+        order = order[np.isfinite(scalar[order])]
+        best = [] # (distance, row), sorted
+        for start in range(0, len(order), SEQUENCE_CHUNK):
+            chunk = order[start:start + SEQUENCE_CHUNK]
+            # every remaining candidate is at least its scalar distance away
+            if len(best) == k and scalar[chunk[0]] >= best[-1][0]:
+                break
+            if q is None:
+                dist = scalar[chunk]
             else:
-                if vid.id not in previous_list and comp < smallest:
-                    smallest = comp
-                    smallestBPM = comp_bpm
-                    smallestTimbre = comp_timbre
-                    nearest = vid
-            #print("--- result",i['file'],i['average_frequency'],i['average_key'],"diff",comp)
-    # print(nearest)
-    previous_list.append(nearest.id)
-   
-    if len(previous_list) >= len(videos)-1:
-        previous_list.pop(0)
-        # print("getNearestPitch: previous_list, pop first")
+                sequences = [self.sequence(candidates[pos], "head") for pos in chunk]
+                valid = np.array([sequence is not None for sequence in sequences], dtype=bool)
+                chunk = chunk[valid]
+                if len(chunk) == 0:
+                    continue
+                C = np.stack([sequence for sequence in sequences if sequence is not None])
+                dist = scalar[chunk] + lb_keogh(q, C, self.band)
+                if len(best) == k:
+                    keep = dist < best[-1][0]
+                    chunk, C, dist = chunk[keep], C[keep], dist[keep]
+                if len(chunk) > 0:
+                    dist = scalar[chunk] + dtw_distances(q, C, self.band)
+            best = sorted(best + list(zip(dist.tolist(), candidates[chunk].tolist())))[:k]
+        return [self.videos[row] for _, row in best]
+
+### Segment Index
+
+SEGMENT_HOP_SECONDS = 3072 / 22050 # sf_segmenter frame hop at the rate get_segments runs it
+SEGMENT_META_DTYPE = np.dtype([("track", np.int32), ("start", np.float32), ("end", np.float32), ("label", np.int16)])
+SEGMENT_TIMBRE_DIMS = 13 # static mfccs, the deltas average out over a segment
+SEGMENT_PROBES = 8 # k-means cells searched per query
+SEGMENT_TRAIN_ITERATIONS = 10
+
+def segment_embeddings(audio_features):
+    # mean timbre, chroma and octave intensity of the beats in each segment, with (start, end, label) in seconds
+    try:
+        boundaries = np.asarray(audio_features["segments_boundaries"], dtype=np.float64) * SEGMENT_HOP_SECONDS
+        labels = np.asarray(audio_features["segments_labels"])
+        beats = np.asarray(audio_features["beats"], dtype=np.float64)
+        timbre = np.asarray(audio_features["timbre_frames"])[:, :SEGMENT_TIMBRE_DIMS]
+        chroma = np.asarray(audio_features["pitch_frames"])
+        intensity = pool_octaves(audio_features["intensity_frames"])
+    except (KeyError, OSError):
+        return None, None
+    frames = np.hstack([part[:min(len(timbre), len(chroma), len(intensity))] for part in (timbre, chroma, intensity)]).astype(np.float64)
+    if len(boundaries) < 2 or len(frames) == 0:
+        return None, None
+    # frame r covers the audio between beat r-1 and beat r
+    starts = np.minimum(np.searchsorted(beats, boundaries[:-1], side="right"), len(frames) - 1)
+    ends = np.maximum(np.minimum(np.searchsorted(beats, boundaries[1:], side="right"), len(frames)), starts + 1)
+    sums = np.concatenate([np.zeros((1, frames.shape[1])), np.cumsum(frames, axis=0)])
+    embeddings = (sums[ends] - sums[starts]) / (ends - starts)[:, None]
+    meta = np.zeros(len(embeddings), dtype=SEGMENT_META_DTYPE)
+    meta["start"], meta["end"] = boundaries[:-1], boundaries[1:]
+    if len(labels) == len(meta):
+        meta["label"] = labels
+    return embeddings.astype(np.float32), meta
+
+def features_stamp(audio_features):
+    # changes whenever the feature store rewrites a track's frames
+    frames_dir = getattr(audio_features, "frames_dir", None)
+    if frames_dir is None or not os.path.isdir(frames_dir):
+        return 0
+    return os.stat(frames_dir).st_mtime_ns
+
+def kmeans(data, n_cells, iterations=SEGMENT_TRAIN_ITERATIONS, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), n_cells, replace=False)].copy()
+    for _ in range(iterations):
+        cells = nearest_centroids(data, centroids)
+        for cell in range(n_cells):
+            members = data[cells == cell]
+            if len(members) > 0:
+                centroids[cell] = members.mean(axis=0)
+    return centroids
+
+def nearest_centroids(data, centroids, chunk=65536):
+    cells = np.empty(len(data), dtype=np.int32)
+    norms = np.sum(centroids * centroids, axis=1)
+    for start in range(0, len(data), chunk):
+        block = data[start:start + chunk]
+        cells[start:start + chunk] = np.argmin(norms[None, :] - 2 * block @ centroids.T, axis=1)
+    return cells
+
+class SegmentIndex:
+    """Embeddings of every segment in the library as one contiguous array in library/features,
+    searched through an inverted file over k-means cells. Updated incrementally: only tracks
+    whose features changed are re-embedded, the cells are retrained when the index doubles."""
+    def __init__(self, directory=FEATURES_DIRECTORY):
+        self.directory = directory
+        self.tracks = []
+        self.stamps = []
+        self.embeddings = np.zeros((0, 0), dtype=np.float32)
+        self.meta = np.zeros(0, dtype=SEGMENT_META_DTYPE)
+        self.cells = np.zeros(0, dtype=np.int32)
+        self.mean = self.scale = self.centroids = None
+        self.trained_size = 0
+        if os.path.isfile(self.path("segments_model.npz")):
+            self.load()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def load(self):
+        model = np.load(self.path("segments_model.npz"))
+        self.mean, self.scale, self.centroids = model["mean"], model["scale"], model["centroids"]
+        self.trained_size = int(model["trained_size"])
+        self.embeddings = np.load(self.path("segments.npy"), mmap_mode="r")
+        self.meta = np.load(self.path("segments_meta.npy"))
+        self.cells = np.load(self.path("segments_cells.npy"))
+        with open(self.path("segments_tracks.txt")) as f:
+            lines = [line.rsplit("\t", 1) for line in f.read().splitlines()]
+        self.tracks = [line[0] for line in lines]
+        self.stamps = [int(line[1]) for line in lines]
+        self.build_lists()
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # every file goes through a temp name, the model last since its presence marks a complete index
+        for name, value in (("segments.npy", self.embeddings), ("segments_meta.npy", self.meta), ("segments_cells.npy", self.cells)):
+            np.save(self.path(name + ".tmp.npy"), value, allow_pickle=False)
+            os.replace(self.path(name + ".tmp.npy"), self.path(name))
+        with open(self.path("segments_tracks.txt.tmp"), "w") as f:
+            f.write("\n".join(f"{track}\t{stamp}" for track, stamp in zip(self.tracks, self.stamps)))
+        os.replace(self.path("segments_tracks.txt.tmp"), self.path("segments_tracks.txt"))
+        np.savez(self.path("segments_model.tmp.npz"), mean=self.mean, scale=self.scale, centroids=self.centroids, trained_size=self.trained_size)
+        os.replace(self.path("segments_model.tmp.npz"), self.path("segments_model.npz"))
+
+    def build_lists(self):
+        # segments sorted by cell, a cell's segments are order[offsets[c]:offsets[c + 1]]
+        self.order = np.argsort(self.cells, kind="stable")
+        n_cells = 0 if self.centroids is None else len(self.centroids)
+        self.offsets = np.searchsorted(self.cells[self.order], np.arange(n_cells + 1))
+        self.rows = {track: i for i, track in enumerate(self.tracks)}
+
+    def update(self, videos, known=None):
+        # (re)embeds the given tracks that are new or changed and drops tracks not in known
+        # (default: the given tracks), returns the number of tracks embedded
+        known = {vid.id for vid in videos} if known is None else known
+        stamps = {vid.id: features_stamp(vid.audio_features) for vid in videos}
+        kept = [i for i, track in enumerate(self.tracks) if track in known and stamps.get(track, self.stamps[i]) == self.stamps[i]]
+        kept_ids = {self.tracks[i] for i in kept}
+        new = [vid for vid in videos if vid.id not in kept_ids]
+        if len(new) == 0 and len(kept) == len(self.tracks):
+            return 0
+        # raw embeddings of the tracks that stay, back from their standardized form
+        keep_rows = np.isin(self.meta["track"], kept)
+        raw = [np.asarray(self.embeddings[keep_rows]) * self.scale + self.mean] if np.any(keep_rows) else []
+        remap = np.full(len(self.tracks) + 1, -1, dtype=np.int32)
+        remap[kept] = np.arange(len(kept))
+        meta = [self.meta[keep_rows]]
+        meta[0]["track"] = remap[meta[0]["track"]]
+        tracks = [self.tracks[i] for i in kept]
+        track_stamps = [self.stamps[i] for i in kept]
+        for vid in new:
+            embeddings, segments = segment_embeddings(vid.audio_features)
+            # a track without segments is recorded with none, so it is not embedded again until it changes
+            tracks.append(vid.id)
+            track_stamps.append(stamps[vid.id])
+            if embeddings is None:
+                continue
+            segments["track"] = len(tracks) - 1
+            raw.append(embeddings)
+            meta.append(segments)
+        self.set_segments(tracks, track_stamps, np.concatenate(raw) if raw else np.zeros((0, 0), np.float32), np.concatenate(meta))
+        self.save()
+        return len(new)
+
+    def set_segments(self, tracks, stamps, raw, meta):
+        self.tracks, self.stamps, self.meta = tracks, stamps, meta
+        if self.centroids is None or len(raw) > 2 * self.trained_size or raw.shape[1] != len(self.mean):
+            self.train(raw)
+        self.embeddings = ((raw - self.mean) / self.scale).astype(np.float32)
+        self.cells = nearest_centroids(self.embeddings, self.centroids) if len(raw) > 0 else np.zeros(0, dtype=np.int32)
+        self.build_lists()
+
+    def train(self, raw):
+        print(f"Segment index: training on {len(raw)} segments")
+        if len(raw) == 0:
+            self.mean, self.scale, self.centroids = np.zeros(0), np.ones(0), np.zeros((0, 0), np.float32)
+            self.trained_size = 0
+            return
+        self.mean = raw.mean(axis=0)
+        scale = raw.std(axis=0)
+        # timbre, chroma and intensity weigh the same
+        dims = [SEGMENT_TIMBRE_DIMS, 12, raw.shape[1] - SEGMENT_TIMBRE_DIMS - 12]
+        group_weight = np.concatenate([np.full(n, 1 / np.sqrt(n)) for n in dims if n > 0])
+        self.scale = np.where(scale > 0, scale, 1.0) / group_weight
+        data = ((raw - self.mean) / self.scale).astype(np.float32)
+        n_cells = int(np.clip(np.sqrt(len(data)), 1, 1024))
+        sample = data[np.random.default_rng(0).choice(len(data), min(len(data), 64 * n_cells), replace=False)]
+        self.centroids = kmeans(sample, n_cells)
+        self.trained_size = len(raw)
+
+    def search(self, vector, k=10, probes=SEGMENT_PROBES, exclude_track=None):
+        # approximate k nearest segments to a standardized embedding: (segment row, distance)
+        if len(self.cells) == 0:
+            return []
+        cells = np.argsort(np.sum((self.centroids - vector) ** 2, axis=1))[:probes]
+        rows = np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in cells])
+        # sorted rows read the memory-mapped embeddings front to back
+        rows = np.sort(rows)
+        if exclude_track is not None:
+            rows = rows[self.meta["track"][rows] != exclude_track]
+        if len(rows) == 0:
+            return []
+        dist = np.sqrt(np.sum((np.asarray(self.embeddings[rows]) - vector) ** 2, axis=1))
+        k = min(k, len(rows))
+        best = np.argpartition(dist, k - 1)[:k]
+        best = best[np.lexsort((rows[best], dist[best]))]
+        return [(int(rows[i]), float(dist[i])) for i in best]
+
+    def segments(self, file_id):
+        return np.flatnonzero(self.meta["track"] == self.rows[file_id])
+
+    def query(self, file_id, segment=0, k=10, probes=SEGMENT_PROBES, same_track=False):
+        # segments like the query track's n-th segment: [(track id, start, end, label, distance)]
+        rows = self.segments(file_id)
+        vector = np.asarray(self.embeddings[rows[segment]])
+        exclude = None if same_track else self.rows[file_id]
+        hits = self.search(vector, k + (1 if same_track else 0), probes, exclude_track=exclude)
+        results = []
+        for row, dist in hits:
+            if row == rows[segment]:
+                continue
+            m = self.meta[row]
+            results.append((self.tracks[m["track"]], float(m["start"]), float(m["end"]), int(m["label"]), dist))
+        return results[:k]
+
+def parse_search_weights(text):
+    # "frequency=1,timbre=0.5" -> {"frequency": 1.0, "timbre": 0.5}
+    weights = {}
+    for item in text.split(","):
+        name, value = item.split("=")
+        if name not in INDEX_FEATURES:
+            raise ValueError(f"unknown search feature {name}, use one of {', '.join(INDEX_FEATURES)}")
+        weights[name] = float(value)
+    return weights
+
+def parse_range(text):
+    # "124-130" -> (124.0, 130.0), "120" -> (120.0, 120.0)
+    lo, _, hi = text.partition("-")
+    lo = float(lo)
+    hi = float(hi) if hi else lo
+    if hi < lo:
+        raise ValueError(f"empty range {text}, use low-high")
+    return lo, hi
+
+class SearchHistory:
+    """Tracks already returned by one chain of get_nearest calls, not suggested again until most of the library was used"""
+    def __init__(self):
+        self.ids = []
+        self.seen = set()
+
+    def add(self, file_id, library_size):
+        self.ids.append(file_id)
+        self.seen.add(file_id)
+        if len(self.ids) >= library_size - 1:
+            self.seen.discard(self.ids.pop(0))
+
+def get_nearest(query,videos,querybpm, searchforbpm, index=None, weights=None, sequence_index=None, history=None, rows=None):
+    history = history if history is not None else SearchHistory()
+    # print("Search: query:", query.name, '- Incl. BPM in search:', searchforbpm)
+    with profiler.stage("search", query.id):
+        if index is None:
+            with profiler.stage("index", query.id):
+                index = FeatureIndex(videos)
+        if sequence_index is not None:
+            results = sequence_index.query(query, k=1, querybpm=querybpm if searchforbpm else None, exclude=history.seen, rows=rows)
+            nearest = results[0] if len(results) > 0 else None
+        elif weights is None:
+            nearest = index.nearest(query, querybpm, searchforbpm, exclude=history.seen, rows=rows)
+        else:
+            results = index.query(query, k=1, weights=weights, querybpm=querybpm if searchforbpm else None, exclude=history.seen, rows=rows)
+            nearest = results[0] if len(results) > 0 else None
+    # None once the filtered candidates are used up
+    if nearest is None:
+        return None
+    history.add(nearest.id, len(videos) if rows is None else len(rows))
     # print("get_nearest",nearest.id)
     return nearest
 
@@ -561,32 +2937,478 @@ def getNearest(k, array):
     return min(enumerate(array), key=lambda x: abs(x[1]-k))
 
 
-################## MAIN ##################
+### Playlist
+
+PLAYLIST_TIME_BUDGET = 2.0 # seconds spent improving the greedy order
+PLAYLIST_PENALTY = 1000.0 # added per broken tempo or key constraint, so violations are avoided first
+
+def fifths_steps(a, b):
+    # steps between pitch classes on the circle of fifths, 0 if either is unknown
+    d = ((b - a) * 7) % 12
+    steps = np.minimum(d, 12 - d)
+    return np.where((a < 0) | (b < 0), 0, steps)
+
+class PlaylistPlanner:
+    """Orders tracks so neighbours are close: greedy nearest neighbour, then 2-opt and Or-opt moves within a time budget"""
+    def __init__(self, index, weights=DEFAULT_SEARCH_WEIGHTS, max_tempo_change=None, max_key_steps=None):
+        self.index = index
+        w = np.array([weights.get(name, 0.0) for name in INDEX_FEATURES])
+        used = w > 0
+        # standardized and weighted, so plain euclidean distances are the weighted search distances
+        self.points = np.nan_to_num(index.matrix[:, used] / index.scale[used] * np.sqrt(w[used]))
+        self.tempo = index.column("tempo")
+        self.keys = np.array([key_class(vid.audio_features.get("key", "")) for vid in index.videos], dtype=np.int64)
+        self.max_tempo_change = max_tempo_change
+        self.max_key_steps = max_key_steps
+
+    def costs(self, a, b):
+        # transition costs from rows a to rows b, symmetric so a path can be reversed
+        pa, pb = self.points[a], self.points[b]
+        squared = np.sum(pa * pa, axis=1)[:, None] + np.sum(pb * pb, axis=1)[None, :] - 2 * pa @ pb.T
+        cost = np.sqrt(np.maximum(squared, 0))
+        if self.max_tempo_change is not None:
+            ta, tb = self.tempo[a][:, None], self.tempo[b][None, :]
+            change = np.abs(ta - tb) / np.minimum(ta, tb) * 100
+            cost += PLAYLIST_PENALTY * (change > self.max_tempo_change)
+        if self.max_key_steps is not None:
+            cost += PLAYLIST_PENALTY * (fifths_steps(self.keys[a][:, None], self.keys[b][None, :]) > self.max_key_steps)
+        return cost
+
+    def greedy(self, start, length, rows=None):
+        # nearest unvisited track each step, one vectorized row of costs at a time, from the given rows or all tracks
+        pool = np.arange(len(self.index.ids)) if rows is None else np.asarray(rows)
+        available = pool != start
+        path = [start]
+        while len(path) < length and available.any():
+            cost = self.costs(np.array([path[-1]]), pool)[0]
+            nxt = int(np.argmin(np.where(available, cost, np.inf)))
+            path.append(int(pool[nxt]))
+            available[nxt] = False
+        return path
+
+    def plan(self, start_id, length=None, time_budget=PLAYLIST_TIME_BUDGET, rows=None):
+        # rows of the playlist starting at start_id, all candidates if no length is given
+        start = self.index.rows[start_id]
+        length = len(self.index.ids) if length is None else length
+        order = np.array(self.greedy(start, length, rows))
+        D = self.costs(order, order)
+        path = improve_path(D, time.perf_counter() + time_budget)
+        return order[path], D[path[:-1], path[1:]]
+
+def path_cost(D, path):
+    return float(D[path[:-1], path[1:]].sum())
+
+def two_opt_pass(D, path, deadline):
+    # reverses path[i:j+1] where that shortens the path, the first track stays in place
+    n = len(path)
+    improved = False
+    for i in range(1, n - 1):
+        if time.perf_counter() > deadline:
+            break
+        a, b = path[i - 1], path[i]
+        j = np.arange(i + 1, n)
+        after = np.append(path[j[:-1] + 1], -1)
+        gain = D[a, b] - D[a, path[j]]
+        # the last track has no successor, reversing up to it only changes one edge
+        tail = np.where(after >= 0, D[path[j], np.maximum(after, 0)] - D[b, np.maximum(after, 0)], 0.0)
+        gain = gain + tail
+        best = int(np.argmax(gain))
+        if gain[best] > 1e-9:
+            path[i:j[best] + 1] = path[i:j[best] + 1][::-1].copy()
+            improved = True
+    return improved
+
+def or_opt_pass(D, path, deadline, max_segment=3):
+    # moves runs of up to max_segment tracks, possibly reversed, to the cheapest other place in the path
+    n = len(path)
+    improved = False
+    for length in range(1, max_segment + 1):
+        i = 1
+        while i + length <= n:
+            if time.perf_counter() > deadline:
+                return improved
+            segment = path[i:i + length]
+            rest = np.concatenate([path[:i], path[i + length:]])
+            prev = path[i - 1]
+            removed = D[prev, segment[0]]
+            if i + length < n:
+                removed += D[segment[-1], path[i + length]] - D[prev, path[i + length]]
+            # insert after rest[k], between rest[k] and rest[k + 1] or at the end
+            left, right = rest, np.append(rest[1:], -1)
+            has_right = right >= 0
+            right = np.maximum(right, 0)
+            best_gain, best = 1e-9, None
+            for seg in (segment, segment[::-1]):
+                added = D[left, seg[0]] + np.where(has_right, D[seg[-1], right] - D[left, right], 0.0)
+                k = int(np.argmin(added))
+                if removed - added[k] > best_gain:
+                    best_gain, best = removed - added[k], (k, seg)
+            if best is not None:
+                k, seg = best
+                path[:] = np.concatenate([rest[:k + 1], seg, rest[k + 1:]])
+                improved = True
+            else:
+                i += 1
+    return improved
+
+def improve_path(D, deadline):
+    # greedy order (the input order) improved by 2-opt and Or-opt passes until neither helps or time is up
+    path = np.arange(len(D))
+    if len(path) < 3:
+        return path
+    while time.perf_counter() < deadline:
+        improved = two_opt_pass(D, path, deadline)
+        improved = or_opt_pass(D, path, deadline) or improved
+        if not improved:
+            break
+    return path
+
+################## SERVER ##################
+
+SERVER_SOCKET = "library/polymath.sock"
+SERVER_JOBS = 2
+
+class ReadWriteLock:
+    """Any number of readers or one writer"""
+    def __init__(self):
+        self.changed = threading.Condition()
+        self.readers = 0
+        self.writing = False
+
+    @contextmanager
+    def hold(self, write):
+        with self.changed:
+            while self.writing or (write and self.readers > 0):
+                self.changed.wait()
+            if write:
+                self.writing = True
+            else:
+                self.readers += 1
+        try:
+            yield
+        finally:
+            with self.changed:
+                if write:
+                    self.writing = False
+                else:
+                    self.readers -= 1
+                self.changed.notify_all()
+
+class Job:
+    def __init__(self, job_id, argv):
+        self.id = job_id
+        self.argv = argv
+        self.state = "queued" # queued, waiting, running, done, failed
+        self.lines = []
+        self.error = None
+        self.created = time.time()
+        self.started = self.finished = None
+        self.changed = threading.Condition()
+
+    def write(self, text):
+        with self.changed:
+            self.lines.append(text)
+            self.changed.notify_all()
+
+    def set_state(self, state, error=None):
+        with self.changed:
+            self.state = state
+            self.error = error
+            if state == "running":
+                self.started = time.time()
+            elif state in ("done", "failed"):
+                self.finished = time.time()
+            self.changed.notify_all()
+
+    def status(self):
+        output = "".join(self.lines).strip().splitlines()
+        return {"job": self.id, "argv": self.argv, "state": self.state, "error": self.error, "lines": len(output),
+                "last": output[-1] if output else "", "created": self.created, "started": self.started, "finished": self.finished}
+
+def current_job():
+    # the server job the calling thread prints to, None outside a server job
+    output = sys.stdout
+    return getattr(output.local, "job", None) if isinstance(output, JobOutput) else None
+
+def carry_job(target):
+    # wraps target to print to the server job of the calling thread, for the threads a job starts
+    job = current_job()
+    if job is None:
+        return target
+    output = sys.stdout
+    def run(*args, **kwargs):
+        previous = getattr(output.local, "job", None)
+        output.local.job = job
+        try:
+            return target(*args, **kwargs)
+        finally:
+            output.local.job = previous
+    return run
+
+class JobOutput:
+    """sys.stdout of the server: prints from a job's thread go to that job, everything else to the terminal"""
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        job = getattr(self.local, "job", None)
+        if job is None:
+            return self.stream.write(text)
+        job.write(text)
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+def writes_library(args, session):
+    # these change the library or the stored features, so they run alone
+    if args.add or args.remove or args.refresh or args.midi:
+        return True
+    return any(vid.id not in session.store for vid in session.library)
+
+class Server:
+    """Runs polymath commands from clients one queue, with the library, features and models kept in memory"""
+    def __init__(self, session, jobs=SERVER_JOBS, socket_path=SERVER_SOCKET):
+        self.session = session
+        self.socket_path = socket_path
+        self.queue = queue.Queue()
+        self.jobs = {}
+        self.next_id = 1
+        self.jobs_lock = threading.Lock()
+        self.library_lock = ReadWriteLock()
+        self.output = JobOutput(sys.stdout)
+        self.workers = [threading.Thread(target=self.work, daemon=True) for _ in range(max(1, jobs))]
+
+    def submit(self, argv):
+        with self.jobs_lock:
+            job = Job(self.next_id, argv)
+            self.jobs[job.id] = job
+            self.next_id += 1
+        self.queue.put(job)
+        return job
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            self.run(job)
+
+    def run(self, job):
+        self.output.local.job = job
+        try:
+            args = build_parser().parse_args(job.argv)
+            job.set_state("waiting")
+            with self.library_lock.hold(write=writes_library(args, self.session)):
+                job.set_state("running")
+                run_command(args, self.session)
+            job.set_state("done")
+        except SystemExit as e:
+            job.set_state("failed", f"invalid arguments ({e.code})")
+        except Exception as e:
+            job.write(traceback.format_exc())
+            job.set_state("failed", str(e))
+        finally:
+            self.output.local.job = None
+
+    def serve(self):
+        server = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                request = json.loads(self.rfile.readline())
+                server.handle(request, self.wfile)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        sys.stdout = self.output
+        for worker in self.workers:
+            worker.start()
+        self.socket = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        print(f"Polymath server: {len(self.session.library)} files, {len(self.workers)} jobs at a time, listening on {self.socket_path}")
+        try:
+            self.socket.serve_forever()
+        finally:
+            self.socket.server_close()
+            os.remove(self.socket_path)
+            sys.stdout = self.output.stream
+
+    def stop(self):
+        # queued jobs finish first
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.socket.shutdown()
+
+    def handle(self, request, wfile):
+        def send(message):
+            wfile.write((json.dumps(message) + "\n").encode())
+            wfile.flush()
+        if request["op"] == "submit":
+            job = self.submit(request["argv"])
+            send({"job": job.id})
+            if request.get("detach"):
+                return
+            # stream the job's output until it finishes
+            sent = 0
+            while True:
+                with job.changed:
+                    while sent == len(job.lines) and job.state not in ("done", "failed"):
+                        job.changed.wait()
+                    lines, state, error = job.lines[sent:], job.state, job.error
+                sent += len(lines)
+                if lines:
+                    send({"output": "".join(lines)})
+                if state in ("done", "failed") and sent == len(job.lines):
+                    send({"state": state, "error": error})
+                    return
+        elif request["op"] == "status":
+            with self.jobs_lock:
+                jobs = list(self.jobs.values())
+            send({"jobs": [job.status() for job in jobs], "queued": self.queue.qsize()})
+        elif request["op"] == "stop":
+            send({"stopping": True})
+            threading.Thread(target=self.stop, daemon=True).start()
+
+def server_request(request, socket_path=SERVER_SOCKET):
+    # yields the server's replies, None if no server is listening
+    if not hasattr(socket, "AF_UNIX") or not os.path.exists(socket_path):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        client.close()
+        return None
+    client.sendall((json.dumps(request) + "\n").encode())
+    def replies():
+        with client, client.makefile("rb") as f:
+            for line in f:
+                yield json.loads(line)
+    return replies()
+
+def send_command(argv, detach=False, socket_path=SERVER_SOCKET):
+    # runs a command on the server and prints its output, False if no server is running
+    replies = server_request({"op": "submit", "argv": argv, "detach": detach}, socket_path)
+    if replies is None:
+        return False
+    for reply in replies:
+        if "job" in reply:
+            print(f"Polymath server: job {reply['job']}" + (" queued" if detach else ""))
+        elif "output" in reply:
+            sys.stdout.write(reply["output"])
+            sys.stdout.flush()
+        elif reply.get("state") == "failed":
+            print("Polymath server: job failed:", reply["error"])
+            sys.exit(1)
+    return True
+
+def print_server_status(socket_path=SERVER_SOCKET):
+    replies = server_request({"op": "status"}, socket_path)
+    if replies is None:
+        print("No polymath server running")
+        return
+    for reply in replies:
+        print(f"Polymath server: {reply['queued']} jobs queued")
+        for job in reply["jobs"]:
+            print(f"- job {job['job']} {job['state']}: {' '.join(job['argv'])} ({job['lines']} lines) {job['last'][:80]}")
 
-def main():
-    print("---------------------------------------------------------------------------- ")
-    print("--------------------------------- POLYMATH --------------------------------- ")
-    print("---------------------------------------------------------------------------- ")
-    # Load DB
-    videos = read_library()
+################## MAIN ##################
 
-    for directory in ("processed", "library", "separated", "separated/htdemucs_6s"):
-        os.makedirs(directory, exist_ok=True)
-    
-    # Parse command line input
+def build_parser():
     parser = argparse.ArgumentParser(description='polymath')
     parser.add_argument('-a', '--add', help='youtube id', required=False)
     parser.add_argument('-r', '--remove', help='youtube id', required=False)
+    parser.add_argument('-ph', '--pcmhash', help='detect already added audio files by their decoded audio instead of their file bytes', required=False, action="store_true", default=False)
     parser.add_argument('-v', '--videos', help='video db length', required=False)
     parser.add_argument('-t', '--tempo', help='quantize audio tempo in BPM', required=False, type=float)
     parser.add_argument('-q', '--quantize', help='quantize: id or "all"', required=False)
+    parser.add_argument('-qj', '--quantizejobs', help='stretch jobs (mix and stems of all files) running at the same time, default one per cpu', required=False, type=int)
     parser.add_argument('-k', '--quantizekeepbpm', help='quantize to the BPM of the original audio file"', required=False, action="store_true", default=False)
     parser.add_argument('-s', '--search', help='search for musically similar audio files, given a database id"', required=False)
     parser.add_argument('-sa', '--searchamount', help='amount of results the search returns"', required=False, type=int)
     parser.add_argument('-st', '--searchbpm', help='include BPM of audio files as similiarty search criteria"', required=False, action="store_true", default=False)
+    parser.add_argument('-sw', '--searchweights', help='weighted similarity search, e.g. "frequency=1,tempo=0.5,timbre=1,intensity=1,pitch=0,loudness=0"', required=False)
+    parser.add_argument('-sq', '--sequencesearch', help='compare beat-synced timbre, chroma and intensity sequences: "transition" matches the end of each song to the start of the next, "track" whole songs', required=False, choices=SEQUENCE_MODES)
+    parser.add_argument('-pl', '--playlist', help='with -s, order a playlist of -sa files in one go: greedy nearest neighbour improved by 2-opt and Or-opt moves', required=False, action="store_true", default=False)
+    parser.add_argument('-pt', '--playlisttime', help='seconds spent improving the playlist order', required=False, type=float, default=PLAYLIST_TIME_BUDGET)
+    parser.add_argument('-tc', '--tempochange', help='playlist: largest tempo change between neighbours in percent', required=False, type=float)
+    parser.add_argument('-ks', '--keysteps', help='playlist: largest key change between neighbours in steps on the circle of fifths', required=False, type=int)
+    parser.add_argument('-ft', '--filtertempo', help='with -s, only consider files with a tempo in this range or at half or double time, e.g. "124-130"', required=False)
+    parser.add_argument('-fk', '--filterkey', help='with -s, only consider files in keys next to the key of the searched file on the camelot wheel, N steps around it (default 1)', required=False, nargs='?', const=1, type=int)
+    parser.add_argument('-fd', '--filterduration', help='with -s, only consider files of this length in seconds, e.g. "120-360"', required=False)
+    parser.add_argument('-sg', '--segmentsearch', help='search for sections like a segment of a song: id, or id:n for its n-th segment', required=False)
+    parser.add_argument('-j', '--jobs', help='analyse audio files in N parallel worker processes', required=False, type=int, default=1)
+    parser.add_argument('-cc', '--crepecapacity', help='crepe pitch tracking model: tiny, small, medium, large or full', required=False, default=CREPE_CAPACITY)
+    parser.add_argument('-rf', '--refresh', help='recompute analysis stages that are missing or outdated for all audio files', required=False, action="store_true", default=False)
+    parser.add_argument('-ds', '--demucssegment', help='demucs chunk length in seconds, lower uses less memory', required=False, type=float)
+    parser.add_argument('-do', '--demucsoverlap', help='demucs overlap between chunks', required=False, type=float, default=0.25)
+    parser.add_argument('-dt', '--demucsthreads', help='torch threads used by demucs', required=False, type=int)
+    parser.add_argument('-db', '--demucsbatch', help='separate N audio files together, padded to the longest one', required=False, type=int, default=1)
+    parser.add_argument('-sb', '--stagebudgets', help='analysis stages running at the same time, e.g. "tf=1,blas=2,demucs=1,stages=4,memory=8192" (memory in MB), stages=1 runs them one after the other, stream=1 analyses every file in blocks of audio (by default only files too long for the memory budget)', required=False)
+    parser.add_argument('-pf', '--profile', help='write wall time, cpu time and peak memory of every stage to metrics/<run>.json and .csv', required=False, action="store_true", default=False)
+    parser.add_argument('-pc', '--cprofile', help='with --profile, also dump cProfile data to metrics/<run>.prof', required=False, action="store_true", default=False)
+    parser.add_argument('-wa', '--watch', help='keep watching the folders given with -a, new or changed audio files are added and analysed as they appear', required=False, action="store_true", default=False)
+    parser.add_argument('-wi', '--watchinterval', help='seconds between rescans of watched folders', required=False, type=float, default=WATCH_INTERVAL)
     parser.add_argument('-m', '--midi', help='extract midi from audio files"', required=False, action="store_true", default=False)
-
-    args = parser.parse_args()
+    parser.add_argument('-sv', '--server', help='run as a server that keeps the library and models loaded, later polymath commands in this directory are sent to it', required=False, action="store_true", default=False)
+    parser.add_argument('-sj', '--serverjobs', help='commands the server runs at the same time, commands that change the library always run alone', required=False, type=int, default=SERVER_JOBS)
+    parser.add_argument('-ss', '--serverstatus', help='show the jobs of the running server', required=False, action="store_true", default=False)
+    parser.add_argument('-sx', '--serverstop', help='stop the running server once its jobs are done', required=False, action="store_true", default=False)
+    parser.add_argument('-de', '--detach', help='send the command to the server and return without waiting for it', required=False, action="store_true", default=False)
+    parser.add_argument('-lo', '--local', help='run the command in this process even if a server is running', required=False, action="store_true", default=False)
+    return parser
+
+class Session:
+    """Library, feature store and search index of one process, the server keeps one for all its commands"""
+    def __init__(self):
+        self.library = read_library()
+        self.store = FeatureStore()
+        # the whole library, not just the songs the first command selects
+        migrate_feature_pickles(list(self.library), self.store)
+        self.index = None
+        self.index_key = None
+        self.ranges = None
+        self.segments = None
+        self.segments_lock = threading.Lock()
+
+    def feature_index(self, videos):
+        # rebuilt only when the songs or their features changed since the last search
+        key = (tuple(vid.id for vid in videos), self.store.version)
+        if key != self.index_key:
+            self.index = FeatureIndex(videos)
+            self.index_key = key
+            self.ranges = None
+        return self.index
+
+    def range_index(self, videos):
+        # sorted columns for filtered searches, rebuilt along with the feature index
+        index = self.feature_index(videos)
+        if self.ranges is None or self.ranges.index is not index:
+            self.ranges = RangeIndex(index)
+        return self.ranges
+
+    def remove(self, file_id):
+        # the song with its stored features and cached stages, the search indexes rebuild on the next search
+        # and the segment index drops it on its next update
+        removed = self.library.remove(file_id)
+        self.store.remove(file_id)
+        self.store.save()
+        shutil.rmtree(os.path.join(STAGE_CACHE_DIRECTORY, file_id), ignore_errors=True)
+        self.index = self.index_key = self.ranges = None
+        return removed
+
+    def segment_index(self, videos):
+        # loaded once and brought up to date before each segment search
+        with self.segments_lock:
+            if self.segments is None:
+                self.segments = SegmentIndex()
+            updated = self.segments.update(videos, known=self.library)
+        return self.segments, updated
+
+def run_command(args, session):
+    library = session.library
+    videos = list(library)
 
     # List of videos to use
     if args.videos is not None:
@@ -594,33 +3416,37 @@ def main():
         vids = args.videos.split(",")
         print("process selected videos only:",vids)
         for vid in vids:
-            v = [x for x in videos if x.id == vid][0]
-            finalvids.append(v)
+            if vid not in library:
+                print("not in db:",vid)
+                continue
+            finalvids.append(library.get(vid))
         videos = finalvids
 
     # List of videos to delete
     if args.remove is not None:
         print("remove video:",args.remove)
-        for vid in videos:
-            if vid.id == args.remove:
-                videos.remove(vid)
-                break
-        write_library(videos)
+        session.remove(args.remove)
+        videos = [vid for vid in videos if vid.id != args.remove]
 
     # List of videos to download
     newvids = []
     if args.add is not None:
         print("add video:",args.add,"to videos:",len(videos))
         vids = args.add.split(",")
-        if "/" in args.add and not (args.add.endswith(".wav") or args.add.endswith(".mp3")):
-            print('add directory with wav or mp3 files')
-            videos = audio_directory_process(vids,videos)
-        elif ".wav" in args.add or ".mp3" in args.add:
-            print('add wav or mp3 file')
-            videos = audio_process(vids,videos)
+        if "/" in args.add and not is_audio_file(args.add):
+            print('add directory with wav, mp3 or flac files')
+            added = audio_directory_process(vids,library,pcmhash=args.pcmhash,store=session.store)
+        elif any(is_audio_file(vid) for vid in vids):
+            print('add wav, mp3 or flac file')
+            added = audio_process(vids,library,pcmhash=args.pcmhash)
         else:
-            videos = video_process(vids,videos)
-        newvids = vids
+            added = video_process(vids,library)
+        selected = set(vid.id for vid in videos)
+        for vid in added:
+            if vid.id not in selected:
+                videos.append(vid)
+                selected.add(vid.id)
+        newvids = list(dict.fromkeys(vid.id for vid in added))
     
     # List of audio to quantize
     vidargs = []
@@ -633,8 +3459,14 @@ def main():
     # MIDI
     extractmidi = bool(args.midi)
     if extractmidi:
-        global basic_pitch_model
-        basic_pitch_model = tf.saved_model.load(str(ICASSP_2022_MODEL_PATH))
+        # loaded once per process, a server keeps it for later commands
+        get_midi_transcriber().load()
+
+    # Stem separation, the demucs model stays loaded for all audio files
+    separation = {"segment": args.demucssegment, "overlap": args.demucsoverlap, "threads": args.demucsthreads, "batch_size": args.demucsbatch}
+
+    # Stages of a track run side by side within these budgets
+    budgets = parse_stage_budgets(args.stagebudgets) if args.stagebudgets is not None else None
 
     # Tempo
     tempo = int(args.tempo or 120)
@@ -650,32 +3482,36 @@ def main():
     # Analyse to DB
     print(f"------------------------------ Files in DB: {len(videos)} ------------------------------")
     dump_db = False
+    store = session.store
+    failed = []
+    analysed = [vid for vid in videos if vid.id in store]
+    missing = [vid for vid in videos if vid.id not in store]
+    if args.refresh:
+        refresh_library(videos, store, extractMidi=extractmidi, crepe_capacity=args.crepecapacity, separation=separation, budgets=budgets)
+    elif args.jobs > 1 and len(missing) > 1:
+        failed = analyse_library(missing, store, args.jobs, extractMidi=extractmidi, crepe_capacity=args.crepecapacity, separation=separation, budgets=budgets)
+    elif len(missing) > 1:
+        analyse_batch(missing, store, extractMidi=extractmidi, crepe_capacity=args.crepecapacity, separation=separation, budgets=budgets)
+    if extractmidi and not args.refresh:
+        extract_library_midi(analysed, separation=separation)
     # get/detect audio metadata
     for vid in videos:
-        feature_file = f"library/{vid.id}.a"
         # load features from disk
-        if os.path.isfile(feature_file):
-            with open(feature_file, "rb") as f:
-                audio_features = pickle.load(f)
+        if vid.id in store:
+            audio_features = store.get(vid.id)
+        elif vid.id in failed:
+            print(vid.id, "analysis failed, skipped")
+            continue
         # extract features
         else:
-            # Is audio file from disk
-            if len(vid.id) > 12: 
-                print('is audio', vid.id, vid.name, vid.url)
-                file = vid.url
-                # if is mp3 file
-                if vid.url[-3:] == "mp3":
-                    file = os.path.join(os.getcwd(), 'library', vid.id + '.wav')
-            # Is audio file extracted from downloaded video
-            else:
-                file = os.path.join(os.getcwd(), 'library', vid.id + '.wav')
+            file = get_audio_file(vid)
 
             # Audio feature extraction
-            audio_features = get_audio_features(file=file,file_id=vid.id, extractMidi=extractmidi)
+            audio_features = get_audio_features(file=file,file_id=vid.id, extractMidi=extractmidi, crepe_capacity=args.crepecapacity, separation=separation, budgets=budgets)
 
             # Save to disk
-            with open(feature_file, "wb") as f:
-                pickle.dump(audio_features, f)
+            audio_features = store.put(vid.id, audio_features)
+            store.save()
         
         # assign features to video
         vid.audio_features = audio_features
@@ -686,30 +3522,35 @@ def main():
             "timbre", round(audio_features["timbre"], 2),
             "pitch", round(audio_features["pitch"], 2),
             "intensity", round(audio_features["intensity"], 2),
-            "segments", len(audio_features["segments_boundaries"]),
+            "segments", audio_features["segments"],
             "frequency", round(audio_features["frequency"], 2),
             "key", audio_features["key"],
             "name", vid.name,
         )
         #dump_db = True
     if dump_db:
-        write_library(videos)
+        library.compact()
+    videos = [vid for vid in videos if vid.id not in failed]
 
     print("--------------------------------------------------------------------------")
 
-    # Quantize audio
+    # Quantize audio, the mix and stems of all files are stretched together in a process pool
+    # and midi of all quantized stems is transcribed together at the end
+    transcriber = MidiTranscriber() if extractmidi else None
+    quantizer = QuantizeEngine(args.quantizejobs)
     if args.search is None:
         for vidarg in vidargs:
             for idx, vid in enumerate(videos):
                 if vid.id == vidarg:
-                    quantizeAudio(videos[idx], bpm=tempo, keepOriginalBpm = keepOriginalBpm, pitchShiftFirst = pitchShiftFirst, extractMidi = extractmidi)
+                    quantizer.add(videos[idx], bpm=tempo, keepOriginalBpm = keepOriginalBpm, pitchShiftFirst = pitchShiftFirst)
                     break
                 if vidarg == 'all' and len(newvids) == 0:
-                    quantizeAudio(videos[idx], bpm=tempo, keepOriginalBpm = keepOriginalBpm, pitchShiftFirst = pitchShiftFirst, extractMidi = extractmidi)
+                    quantizer.add(videos[idx], bpm=tempo, keepOriginalBpm = keepOriginalBpm, pitchShiftFirst = pitchShiftFirst)
 
     # Search
     searchamount = int(args.searchamount or 20)
     searchforbpm = bool(args.searchbpm)
+    searchweights = parse_search_weights(args.searchweights) if args.searchweights is not None else None
 
     if args.search is not None:
         for vid in videos:
@@ -722,21 +3563,143 @@ def main():
                     ' - ', query.name,
                 )
                 if args.quantize is not None:
-                    quantizeAudio(query, bpm=tempo, keepOriginalBpm = keepOriginalBpm, pitchShiftFirst = pitchShiftFirst, extractMidi = extractmidi)
-                i = 0
-                while i < searchamount:
-                    nearest = get_nearest(query, videos, tempo, searchforbpm)
-                    query = nearest
+                    quantizer.add(query, bpm=tempo, keepOriginalBpm = keepOriginalBpm, pitchShiftFirst = pitchShiftFirst)
+                index = session.feature_index(videos)
+                rows = None
+                if args.filtertempo is not None or args.filterkey is not None or args.filterduration is not None:
+                    # similarity is only ranked on the files that pass the filters
+                    with profiler.stage("filter", query.id):
+                        rows = session.range_index(videos).filter(
+                            tempo=parse_range(args.filtertempo) if args.filtertempo is not None else None,
+                            duration=parse_range(args.filterduration) if args.filterduration is not None else None,
+                            key=query.audio_features['key'] if args.filterkey is not None else None,
+                            key_steps=args.filterkey or 0,
+                        )
+                    print(f"{len(rows)} of {len(videos)} files pass the filters")
+                if args.playlist:
+                    # the whole playlist is ordered at once instead of chaining nearest tracks
+                    planner = PlaylistPlanner(index, weights=searchweights or DEFAULT_SEARCH_WEIGHTS, max_tempo_change=args.tempochange, max_key_steps=args.keysteps)
+                    with profiler.stage("playlist", query.id):
+                        order, costs = planner.plan(query.id, length=searchamount + 1, time_budget=args.playlisttime, rows=rows)
+                    related = [index.videos[row] for row in order[1:]]
+                    violations = np.floor(costs / PLAYLIST_PENALTY)
+                    distance = float(np.sum(costs - violations * PLAYLIST_PENALTY))
+                    print(f"Playlist of {len(order)} files, total distance {distance:.2f}, {int(np.count_nonzero(violations))} transitions break the tempo or key limits")
+                else:
+                    related = []
+                    history = SearchHistory()
+                    sequence_index = None
+                    if args.sequencesearch is not None:
+                        weights = searchweights if searchweights is not None else SEQUENCE_SCALAR_WEIGHTS
+                        sequence_index = SequenceIndex(videos, mode=args.sequencesearch, scalar_index=index, weights=weights)
+                    nearest = query
+                    for i in range(searchamount):
+                        nearest = get_nearest(nearest, videos, tempo, searchforbpm, index=index, weights=searchweights, sequence_index=sequence_index, history=history, rows=rows)
+                        if nearest is None:
+                            break
+                        related.append(nearest)
+                for nearest in related:
                     print(
-                        "- Relate:", query.id,
-                        "- Key:", query.audio_features['key'],
-                        "- Tempo:", int(query.audio_features['tempo']),
-                        ' - ', query.name,
+                        "- Relate:", nearest.id,
+                        "- Key:", nearest.audio_features['key'],
+                        "- Tempo:", int(nearest.audio_features['tempo']),
+                        ' - ', nearest.name,
                     )
                     if args.quantize is not None:
-                        quantizeAudio(query, bpm=tempo, keepOriginalBpm = keepOriginalBpm, pitchShiftFirst = pitchShiftFirst, extractMidi = extractmidi)
-                    i += 1
+                        quantizer.add(nearest, bpm=tempo, keepOriginalBpm = keepOriginalBpm, pitchShiftFirst = pitchShiftFirst)
                 break
+    quantizer.run(extractMidi = extractmidi, transcriber = transcriber)
+
+    # Segment search
+    if args.segmentsearch is not None:
+        file_id, _, segment = args.segmentsearch.partition(":")
+        segment = segment or "0"
+        names = {vid.id: vid.name for vid in videos}
+        with profiler.stage("segment_index"):
+            segment_index, updated = session.segment_index(videos)
+        if updated > 0:
+            print(f"Segment index: {updated} songs added or updated, {len(segment_index.meta)} segments in total")
+        rows = segment_index.segments(file_id) if file_id in segment_index.rows else []
+        if len(rows) == 0:
+            print("No segments for", file_id)
+        elif not segment.isdigit() or int(segment) >= len(rows):
+            print(f"No segment {segment} in {file_id}, it has {len(rows)} segments (0-{len(rows) - 1})")
+        else:
+            segment = int(segment)
+            query = segment_index.meta[rows[segment]]
+            print(f"Sections like {file_id} segment {segment}/{len(rows)} ({query['start']:.1f}-{query['end']:.1f}s) - {names.get(file_id, '')}")
+            with profiler.stage("segment_search", file_id):
+                hits = segment_index.query(file_id, segment, k=searchamount)
+            for hit_id, start, end, label, distance in hits:
+                print(f"- Section: {hit_id} {start:.1f}-{end:.1f}s label {label} distance {distance:.3f} - {names.get(hit_id, '')}")
+
+    if transcriber is not None:
+        transcriber.flush()
+
+    # Watch folders
+    if args.watch:
+        directories = [vid for vid in args.add.split(",") if os.path.isdir(vid)] if args.add is not None else []
+        if len(directories) == 0:
+            print("-wa needs the folders to watch in -a")
+        else:
+            watch_folders(directories, session, args, separation, budgets)
+
+def watch_folders(directories, session, args, separation, budgets=None):
+    # files are added and analysed a batch at a time as the scanner finds them, until interrupted
+    library, store = session.library, session.store
+    manifest = ScanManifest()
+    watcher = FolderWatcher(directories, library, manifest, interval=args.watchinterval)
+    extractmidi = bool(args.midi)
+    print(f"Watching {', '.join(directories)} for new or changed audio files every {args.watchinterval} seconds")
+    watcher.start()
+    try:
+        for batch in watcher.batches(max(args.jobs, PITCH_BATCH_TRACKS)):
+            added = ingest_files(batch, library, manifest, store=store, pcmhash=args.pcmhash)
+            missing = list({vid.id: vid for vid in added if vid.id not in store}.values())
+            try:
+                if args.jobs > 1 and len(missing) > 1:
+                    analyse_library(missing, store, args.jobs, extractMidi=extractmidi, crepe_capacity=args.crepecapacity, separation=separation, budgets=budgets)
+                elif len(missing) > 0:
+                    analyse_batch(missing, store, extractMidi=extractmidi, crepe_capacity=args.crepecapacity, separation=separation, budgets=budgets)
+            except Exception as e:
+                sys.stderr.write(f"Failed to analyse {len(missing)} files: {e}\n")
+            print(f"Watch: {len(added)} files added, {len(library)} in library, {watcher.queue.qsize()} queued")
+    except KeyboardInterrupt:
+        print("Stopped watching")
+    finally:
+        watcher.stop()
+
+def main(argv=None):
+    print("---------------------------------------------------------------------------- ")
+    print("--------------------------------- POLYMATH --------------------------------- ")
+    print("---------------------------------------------------------------------------- ")
+    argv = sys.argv[1:] if argv is None else argv
+    args = build_parser().parse_args(argv)
+
+    if args.serverstatus:
+        return print_server_status()
+    if args.serverstop:
+        replies = server_request({"op": "stop"})
+        print("Polymath server stopping" if replies is not None and next(replies, None) else "No polymath server running")
+        return
+
+    # a running server has the library and models loaded already, watching folders stays in this process
+    # profiling measures this process, so the server runs the command without it
+    if not args.server and not args.local and not args.watch:
+        if send_command([arg for arg in argv if arg not in ("-de", "--detach", "-pf", "--profile", "-pc", "--cprofile")], detach=args.detach):
+            if args.profile or args.cprofile:
+                print("Profiling is not done on the server, the command ran without it: add -lo to profile it in this process")
+            return
+
+    for directory in ("processed", "library", "separated", "separated/htdemucs_6s"):
+        os.makedirs(directory, exist_ok=True)
+    if args.profile:
+        profiler.start(cprofile=args.cprofile)
+    if args.server:
+        Server(Session(), jobs=args.serverjobs).serve()
+    else:
+        run_command(args, Session())
+    profiler.save()
 
 if __name__ == "__main__":
     main()